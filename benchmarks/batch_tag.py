@@ -0,0 +1,59 @@
+"""Measure the time taken to tag and untag many directories read from stdin.
+
+The directories are created in a temporary home directory and passed to
+"tag --stdin" and "untag --stdin" as NUL-delimited paths. Usage:
+
+    python benchmarks/batch_tag.py [-d DIRS]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+
+def run_command(name: str, args: List[str], stdin: bytes, env: Dict[str, str]) -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", f"from dtags.commands.{name} import execute; execute()"]
+        + args,
+        input=stdin,
+        stdout=subprocess.DEVNULL,
+        env=env,
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-d", "--dirs", type=int, default=100000, help="directories")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home)
+        dirs = [
+            Path(home, f"group{num // 1000}", f"dir{num}") for num in range(args.dirs)
+        ]
+        for dirpath in dirs:
+            dirpath.mkdir(parents=True)
+        stdin = b"".join(os.fsencode(dirpath) + b"\0" for dirpath in dirs)
+
+        for name, extra_args in [
+            ("tag", ["-t", "batch"]),
+            ("tag", []),
+            ("untag", []),
+        ]:
+            elapsed = run_command(
+                name, ["-y", "--stdin", "-0"] + extra_args, stdin, env
+            )
+            command = " ".join([name, "--stdin"] + extra_args)
+            print(f"{command:<24} {elapsed:6.2f} s for {args.dirs} directories")
+
+
+if __name__ == "__main__":
+    main()
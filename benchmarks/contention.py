@@ -0,0 +1,80 @@
+"""Measure the throughput of concurrent dtags writers.
+
+Each writer process tags its own directory repeatedly against a shared config
+in a temporary home directory, then the config is checked for lost updates.
+Usage:
+
+    python benchmarks/contention.py [-w WRITERS] [-n UPDATES]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+WRITER_CODE = """
+import sys
+from dtags.commands.tag import tag_directories
+
+for num in range(int(sys.argv[2])):
+    tag_directories(dirs=[sys.argv[1]], tags=[f"tag{num}"])
+"""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-w", "--writers", type=int, default=8, help="processes")
+    parser.add_argument("-n", "--updates", type=int, default=50, help="per writer")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home)
+        dirs = [Path(home, f"dir{num}") for num in range(args.writers)]
+        for dirpath in dirs:
+            dirpath.mkdir()
+
+        start = time.perf_counter()
+        processes = [
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-c",
+                    WRITER_CODE,
+                    dirpath.as_posix(),
+                    str(args.updates),
+                ],
+                stdout=subprocess.DEVNULL,
+                env=env,
+            )
+            for dirpath in dirs
+        ]
+        failed = any([process.wait() != 0 for process in processes])
+        elapsed = time.perf_counter() - start
+
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                "-c",
+                "from dtags.commands.tags import execute; execute()",
+                "--json",
+            ],
+            env=env,
+        )
+        tag_config = json.loads(output)
+        lost = sum(
+            args.updates - len(tag_config.get(dirpath.resolve().as_posix(), []))
+            for dirpath in dirs
+        )
+
+    total = args.writers * args.updates
+    print(f"{total} updates by {args.writers} writers in {elapsed:.2f} s")
+    print(f"{total / elapsed:.1f} updates/s, {lost} lost")
+    sys.exit(1 if failed or lost else 0)
+
+
+if __name__ == "__main__":
+    main()
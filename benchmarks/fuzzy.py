@@ -0,0 +1,74 @@
+"""Measure fuzzy tag matching against the trigram index.
+
+An index with N random tags is built in a temporary directory, then similar
+tags are looked up for mistyped, prefix and unknown values. Usage:
+
+    python benchmarks/fuzzy.py [-t TAGS] [-n RUNS]
+"""
+
+import argparse
+import random
+import string
+import tempfile
+import timeit
+from contextlib import closing
+from pathlib import Path
+from typing import List, Set
+
+from dtags import index
+
+
+def random_word(rng: random.Random) -> str:
+    length = rng.randint(3, 9)
+    return "".join(rng.choices(string.ascii_lowercase, k=length))
+
+
+def random_tags(rng: random.Random, count: int) -> List[str]:
+    # Tags are mostly directory basenames, often sharing words (e.g. "api-v2")
+    words = [random_word(rng) for _ in range(count // 5)]
+    tags: Set[str] = set()
+    while len(tags) < count:
+        parts = rng.choices(words, k=rng.randint(1, 3))
+        if rng.random() < 0.3:
+            parts.append(str(rng.randint(1, 99)))
+        tags.add("-".join(parts))
+    return sorted(tags)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-t", "--tags", type=int, default=50000, help="tag count")
+    parser.add_argument("-n", "--runs", type=int, default=200, help="runs per query")
+    parser.add_argument("-s", "--min-score", type=float, default=0.3, help="cutoff")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    tags = random_tags(rng, args.tags)
+    tag_config = {Path(f"/tmp/{num}"): {tag} for num, tag in enumerate(tags)}
+    known = tags[len(tags) // 2]
+
+    queries = {
+        "typo": known[:-2] + known[-1],
+        "prefix": known[:-2],
+        "short": known[:2],
+        "unknown": "zzzzzz",
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with closing(index.connect(Path(tmpdir) / "index.db")) as conn:
+            build_time = timeit.timeit(
+                lambda: index.rebuild(conn, tag_config, "1"), number=1
+            )
+            print(f"built index of {len(tags)} tags in {build_time:.2f} s")
+
+            for name, value in queries.items():
+                timing = timeit.timeit(
+                    lambda: index.select_similar_tags(conn, value, 3, args.min_score),
+                    number=args.runs,
+                )
+                matches = index.select_similar_tags(conn, value, 3, args.min_score)
+                best = matches[0][1] if matches else "-"
+                print(f"{name:<10} {timing * 1000 / args.runs:8.3f} ms  {best}")
+
+
+if __name__ == "__main__":
+    main()
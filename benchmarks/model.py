@@ -0,0 +1,96 @@
+"""Measure the memory and load time of the in-memory tag config.
+
+A config with the given number of directories (with 1-3 tags each) is loaded
+from JSON into {Path: set} dictionaries (the previous model) and into interned
+tag tables, and the memory held by each is measured with tracemalloc. Usage:
+
+    python benchmarks/model.py [-s SIZE [SIZE ...]]
+"""
+
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+from dtags.model import TagMap, TagTable
+
+
+def make_config_data(size: int) -> str:
+    random.seed(0)
+    words = [f"word{num}" for num in range(max(size // 10, 10))]
+    tags = {
+        f"/home/user/src/{random.choice(words)}/project-{num}": random.sample(
+            words[:100], random.randint(1, 3)
+        )
+        for num in range(size)
+    }
+    return json.dumps({"version": 1, "tags": tags}, sort_keys=True)
+
+
+def load_dicts(data: str) -> Any:
+    return {Path(d): set(tags) for d, tags in json.loads(data)["tags"].items()}
+
+
+def load_table(data: str) -> Any:
+    return TagMap(TagTable(json.loads(data)["tags"].items()))
+
+
+def measure(func: Callable[[str], Any], data: str) -> Tuple[float, float, Any]:
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(data)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return elapsed, memory / 1024 / 1024, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10000, 100000, 1000000],
+        help="numbers of directories",
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'size':>8} {'model':<8} {'load (s)':>9} {'memory (MB)':>12} {'list (s)':>9}"
+    )
+    for size in args.sizes:
+        data = make_config_data(size)
+        models: List[Tuple[str, Callable[[str], Any]]] = [
+            ("dict", load_dicts),
+            ("table", load_table),
+        ]
+        results: Dict[str, Any] = {}
+        for name, func in models:
+            # tracemalloc slows down allocations, so time the load separately
+            elapsed = min(timer(func, data) for _ in range(3))
+            _, memory, results[name] = measure(func, data)
+
+            start = time.perf_counter()
+            for _ in results[name].items():
+                pass
+            listing = time.perf_counter() - start
+            print(f"{size:>8} {name:<8} {elapsed:9.3f} {memory:12.1f} {listing:9.3f}")
+            del results[name]
+
+
+def timer(func: Callable[[str], Any], data: str) -> float:
+    start = time.perf_counter()
+    func(data)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
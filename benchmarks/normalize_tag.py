@@ -0,0 +1,49 @@
+"""Measure the per-tag cost of normalize_tag on different kinds of input.
+
+Each input is normalized repeatedly, with and without the memo cache, and
+compared against calling slugify directly. Usage:
+
+    python benchmarks/normalize_tag.py [-n RUNS]
+"""
+
+import argparse
+import timeit
+
+from slugify import slugify
+
+from dtags.commons import normalize_tag, slugify_tag
+
+INPUTS = {
+    "ascii": "my-project-2",
+    "ascii-spaces": "My Project 2",
+    "unicode": "Ünïcödé Prøjéct",
+    "cjk": "日本語のプロジェクト",
+    "pathological": "-_" * 500 + "x" + "!@#$%^&*()" * 100,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--runs", type=int, default=10000, help="calls per input")
+    args = parser.parse_args()
+
+    print(f"{'input':<16} {'slugify':>10} {'uncached':>10} {'cached':>10}  (us/tag)")
+    for name, value in INPUTS.items():
+        baseline = timeit.timeit(
+            lambda: slugify(value, lowercase=False, regex_pattern=r"[^-a-zA-Z0-9]+"),
+            number=args.runs,
+        )
+
+        def uncached() -> None:
+            slugify_tag.cache_clear()
+            normalize_tag(value)
+
+        uncached_time = timeit.timeit(uncached, number=args.runs)
+        cached_time = timeit.timeit(lambda: normalize_tag(value), number=args.runs)
+
+        timings = [t * 1e6 / args.runs for t in (baseline, uncached_time, cached_time)]
+        print(f"{name:<16} {timings[0]:>10.2f} {timings[1]:>10.2f} {timings[2]:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
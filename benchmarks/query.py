@@ -0,0 +1,77 @@
+"""Measure the cost of evaluating tag queries over many directories.
+
+Random tags are assigned to generated directory paths, which are written to an
+index in a temporary directory. Each query is timed on its own (the set algebra
+on the bitsets), and end to end (loading the bitsets of its tags from the index,
+evaluating it, and loading the paths of the directories matched). Usage:
+
+    python benchmarks/query.py [-d DIRS] [-t TAGS] [-n RUNS]
+"""
+
+import argparse
+import random
+import tempfile
+import timeit
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, Set
+
+from dtags import index
+from dtags.query import evaluate_query, get_query_tags, parse_query
+
+QUERIES = [
+    "tag0 & tag1",
+    "tag0 & tag1 & !tag2",
+    "(tag0 | tag1 | tag2) & !(tag3 | tag4)",
+    "tag0 | !tag1",
+]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-d", "--dirs", type=int, default=10000, help="directories")
+    parser.add_argument("-t", "--tags", type=int, default=20, help="distinct tags")
+    parser.add_argument("-n", "--runs", type=int, default=100, help="runs per query")
+    args = parser.parse_args()
+
+    random.seed(0)
+    tag_config: Dict[Path, Set[str]] = {
+        Path(f"/home/user/src/project{num}"): {
+            f"tag{tag}" for tag in random.sample(range(args.tags), 3)
+        }
+        for num in range(args.dirs)
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with closing(index.connect(Path(tmpdir, "index.db"))) as conn:
+            index.rebuild(conn, tag_config, "benchmark")
+
+            def get_all_bits() -> int:
+                return index.select_all_bits(conn)
+
+            print(f"{args.dirs} directories, {args.tags} tags")
+            print(f"{'query':<40} {'ms/eval':>8} {'ms/query':>8} {'matches':>8}")
+            for value in QUERIES:
+                query = parse_query(value)
+                tag_to_bits = index.select_bitsets(conn, get_query_tags(query))
+                all_bits = get_all_bits()
+                eval_timing = timeit.timeit(
+                    lambda: evaluate_query(query, tag_to_bits, lambda: all_bits),
+                    number=args.runs,
+                )
+
+                def run_query() -> Set[Path]:
+                    tags = get_query_tags(query)
+                    tag_to_bits = index.select_bitsets(conn, tags)
+                    bits = evaluate_query(query, tag_to_bits, get_all_bits)
+                    return index.select_bitset_dirpaths(conn, bits)
+
+                timing = timeit.timeit(run_query, number=args.runs)
+                print(
+                    f"{value:<40} {eval_timing * 1000 / args.runs:8.3f} "
+                    f"{timing * 1000 / args.runs:8.3f} {len(run_query()):8}"
+                )
+
+
+if __name__ == "__main__":
+    main()
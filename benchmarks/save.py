@@ -0,0 +1,114 @@
+"""Measure the time taken by each tag command on a large config.
+
+Directories are created in a temporary home directory and tagged all at once
+with "tag --stdin". Then more directories are tagged one at a time, each with
+its own default tag. The time per tag command and per save of the config
+(including the files derived from it), and the bytes written, are printed.
+Usage:
+
+    python benchmarks/save.py [-d DIRS] [-n SAVES]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+CODE = """
+import sys
+import time
+from pathlib import Path
+
+from dtags.commands import tag
+from dtags.files import save_config_diffs
+
+config_dir = Path.home() / ".dtags"
+save_timings = []
+
+
+def timed_save_config_diffs(*args):
+    start = time.perf_counter()
+    save_config_diffs(*args)
+    save_timings.append(time.perf_counter() - start)
+
+
+tag.save_config_diffs = timed_save_config_diffs
+
+
+def get_bytes_written():
+    # Files which are replaced get a new inode, while appends grow files
+    return {
+        path.name: (path.stat().st_ino, path.stat().st_size)
+        for path in config_dir.iterdir()
+    }
+
+
+timings = []
+written = 0
+for dirpath in sys.argv[1:]:
+    before = get_bytes_written()
+    start = time.perf_counter()
+    tag.tag_directories(dirs=[dirpath])
+    timings.append(time.perf_counter() - start)
+    for name, (ino, size) in get_bytes_written().items():
+        prev_ino, prev_size = before.get(name, (None, 0))
+        written += size if ino != prev_ino else max(size - prev_size, 0)
+
+for name, values in [("tag", timings), ("save", save_timings)]:
+    values.sort()
+    print(
+        f"  {name:<5} {sum(values) * 1000 / len(values):7.2f} ms/save "
+        f"(median {values[len(values) // 2] * 1000:.2f} ms, "
+        f"max {values[-1] * 1000:.2f} ms)",
+        file=sys.stderr,
+    )
+print(f"  {written // len(timings)} bytes written/save", file=sys.stderr)
+"""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-d", "--dirs", type=int, default=20000, help="directories")
+    parser.add_argument("-n", "--saves", type=int, default=500, help="saves")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home)
+        dirs = [
+            Path(home, f"group{num // 1000}", f"project-{num}")
+            for num in range(args.dirs + args.saves)
+        ]
+        for dirpath in dirs:
+            dirpath.mkdir(parents=True)
+
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "from dtags.commands.tag import execute; execute()",
+                "-y",
+                "--stdin",
+                "-0",
+            ],
+            input=b"".join(os.fsencode(d) + b"\0" for d in dirs[: args.dirs]),
+            stdout=subprocess.DEVNULL,
+            env=env,
+            check=True,
+        )
+        print(f"{args.dirs} directories, {args.saves} saves:", flush=True)
+        subprocess.run(
+            [sys.executable, "-c", CODE]
+            + [dirpath.as_posix() for dirpath in dirs[args.dirs :]],
+            stdout=subprocess.DEVNULL,
+            env=env,
+            check=True,
+        )
+
+        for path in sorted(Path(home, ".dtags").iterdir()):
+            print(f"  {path.name:<20} {path.stat().st_size:>10} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Measure the startup time of dtags console entry points.
+
+Each entry point is run with --version in a fresh interpreter, which covers
+the imports and argument parsing done before any real work. Usage:
+
+    python benchmarks/startup.py [-n RUNS] [--max-ms MS]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from typing import List
+
+ENTRY_POINTS = ["activate", "complete", "d", "run", "tag", "tags", "untag"]
+
+
+def measure(code: str, runs: int) -> List[float]:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", code],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--runs", type=int, default=20, help="runs per entry")
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        help="fail if any entry point exceeds the baseline by this many ms",
+    )
+    args = parser.parse_args()
+
+    baseline = statistics.median(measure("pass", args.runs))
+    print(f"{'python -c pass':<20} {baseline:8.1f} ms")
+
+    failed = False
+    for name in ENTRY_POINTS:
+        code = f"from dtags.commands.{name} import execute; execute(['--version'])"
+        median = statistics.median(measure(code, args.runs))
+        overhead = median - baseline
+        print(f"{name:<20} {median:8.1f} ms (+{overhead:.1f} ms)")
+        if args.max_ms is not None and overhead > args.max_ms:
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Measure the time and peak memory of listing a large config with "tags".
+
+A config with the given number of directories is written to a temporary home
+directory, and each output mode of "tags" is run with its output discarded.
+Usage:
+
+    python benchmarks/tags_output.py [-d DIRS]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+CODE = "from dtags.commands.tags import execute; execute()"
+
+MODES = [
+    [],
+    ["--reverse"],
+    ["--json"],
+    ["--json", "--reverse"],
+    ["--ndjson"],
+]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-d", "--dirs", type=int, default=1000000, help="directories")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home)
+        config_dir = Path(home, ".dtags")
+        config_dir.mkdir()
+        tags = {
+            f"/home/user/src/group{num // 1000}/project-{num}": sorted(
+                {f"tag{num % 100}", f"group{num // 1000}"}
+            )
+            for num in range(args.dirs)
+        }
+        with open(config_dir / "config.json", "w") as fp:
+            json.dump({"version": 1, "tags": tags}, fp, indent=2, sort_keys=True)
+        del tags
+
+        # Build the index and the other files once, outside of the timings
+        subprocess.run(
+            [sys.executable, "-c", CODE, "-t", "tag0"],
+            stdout=subprocess.DEVNULL,
+            env=env,
+            check=True,
+        )
+
+        print(f"{'mode':<20} {'time (s)':>9} {'peak RSS (MB)':>14}")
+        for mode in MODES:
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                [sys.executable, "-c", CODE] + mode,
+                stdout=subprocess.DEVNULL,
+                env=env,
+            )
+            _, _, rusage = os.wait4(process.pid, 0)
+            elapsed = time.perf_counter() - start
+            peak = rusage.ru_maxrss / 1024  # kilobytes on Linux
+            print(f"{' '.join(mode) or '(text)':<20} {elapsed:9.2f} {peak:14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,11 @@ unalias untag > /dev/null 2>&1
 unalias tags > /dev/null 2>&1
 unalias d > /dev/null 2>&1
 unalias run > /dev/null 2>&1
+if [[ -n "${ZSH_VERSION}" ]]
+then
+    zmodload zsh/datetime 2> /dev/null
+fi
+typeset -gA _DTAGS_LOOKUP _DTAGS_OVERLAY 2> /dev/null
 d() {
     if [[ $# -eq 1 ]] && [[ -d $1 ]]
     then
@@ -17,13 +22,179 @@ d() {
     elif [[ $# -eq 1 ]] && [[ $1 = - ]]
     then
         cd -
+    elif [[ $# -eq 1 ]] && _dtags_resolve "$1"
+    then
+        cd "${_DTAGS_DEST}" && _dtags_log_visit "$1"
+    else
+        local dest
+        dest="$(DTAGS_DEST_FD=3 dtags-d "$@" 3>&1 1>&2)" || return
+        if [[ -n "${dest}" ]]
+        then
+            cd "${dest}"
+        fi
+    fi
+}
+_dtags_log_visit() {
+    local now="${EPOCHSECONDS}"
+    if [[ "$1" == */* ]] || [[ ! -d ~/.dtags ]]
+    then
+        return 0
+    fi
+    if [[ -z "${now}" ]]
+    then
+        printf -v now '%(%s)T' -1 2> /dev/null || now="$(date +%s)"
+    fi
+    printf '%s %s\n' "${now}" "${PWD}" >> ~/.dtags/visits
+    if (( ++_DTAGS_VISITS % 100 == 0 )) &&
+        [[ -n "$(find ~/.dtags/visits -size +256k 2> /dev/null)" ]]
+    then
+        mv -f ~/.dtags/visits ~/.dtags/visits.1
+    fi
+    return 0
+}
+_dtags_resolve() {
+    local stamp tag="${1%%/*}"
+    if [[ ! -f ~/.dtags/lookup.sh ]] ||
+        [[ ~/.dtags/config.json -nt ~/.dtags/lookup.sh ]] ||
+        [[ -z "${tag}" || "${tag}" == *[!-a-zA-Z0-9]* ]]
+    then
+        return 1
+    fi
+    read -r stamp < ~/.dtags/lookup.sh
+    if [[ "${stamp}" != "${_DTAGS_LOOKUP_STAMP}" ]]
+    then
+        . ~/.dtags/lookup.sh || return 1
+        _DTAGS_LOOKUP_STAMP="${stamp}"
+    fi
+    _dtags_load_overlay "${stamp}" || return 1
+    if [[ -n "${_DTAGS_OVERLAY[${tag}]+set}" ]]
+    then
+        _DTAGS_DEST="${_DTAGS_OVERLAY[${tag}]}"
     else
-        dtags-d "$@"
-        if [[ -f ~/.dtags/destination ]]
+        _DTAGS_DEST="${_DTAGS_LOOKUP[${tag}]}"
+    fi
+    [[ -n "${_DTAGS_DEST}" ]] || return 1
+    if [[ "${tag}" != "$1" ]]
+    then
+        _DTAGS_DEST="${_DTAGS_DEST}/${1#*/}"
+        [[ -d "${_DTAGS_DEST}" ]]
+    fi
+}
+_dtags_load_overlay() {
+    local stamp=""
+    if [[ -f ~/.dtags/lookup-overlay.sh ]]
+    then
+        read -r stamp < ~/.dtags/lookup-overlay.sh
+    fi
+    if [[ "${stamp}" != "$1 "* ]]
+    then
+        stamp=""
+    fi
+    if [[ "${stamp}" != "${_DTAGS_OVERLAY_STAMP}" ]]
+    then
+        if [[ -n "${stamp}" ]]
+        then
+            . ~/.dtags/lookup-overlay.sh || return 1
+        else
+            _DTAGS_OVERLAY=()
+        fi
+        _DTAGS_OVERLAY_STAMP="${stamp}"
+    fi
+}
+_dtags_complete_subdirs() {
+    local IFS=$'\n' tag="${1%%/*}" rest="${1#*/}" sub=""
+    if [[ "${rest}" == */* ]]
+    then
+        sub="${rest%/*}/"
+    fi
+    _dtags_resolve "${tag}" || return 1
+    if [[ "${_DTAGS_DEST}/${sub}" != "${_DTAGS_DIRS_KEY}" ]] ||
+        (( SECONDS - _DTAGS_DIRS_TIME > 10 ))
+    then
+        _DTAGS_DIRS_KEY="${_DTAGS_DEST}/${sub}"
+        _DTAGS_DIRS_TIME="${SECONDS}"
+        _DTAGS_DIRS="$(cd "${_DTAGS_DIRS_KEY}" 2> /dev/null && compgen -d -- "")"
+    fi
+    COMPREPLY+=($(compgen -P "${tag}/${sub}" -S / -W "${_DTAGS_DIRS}" -- "${rest##*/}"))
+    compopt -o filenames -o nospace 2> /dev/null
+}
+_dtags_load_tags() {
+    local stamp log="" tags
+    if [[ ! -f ~/.dtags/completion ]]
+    then
+        return 1
+    fi
+    read -r stamp < ~/.dtags/completion
+    if [[ -f ~/.dtags/completion.log ]]
+    then
+        read -r -d '' log < ~/.dtags/completion.log
+    fi
+    if [[ "${log%%$'\n'*}" != "${stamp}" ]]
+    then
+        log=""
+    fi
+    if [[ "${stamp} ${#log}" != "${_DTAGS_TAGS_STAMP}" ]]
+    then
+        if [[ -n "${log}" ]]
+        then
+            tags="$(dtags-complete "" 2> /dev/null)" || return 1
+        else
+            {
+                read -r _
+                read -r -d '' tags
+            } < ~/.dtags/completion
+        fi
+        if [[ -n "${ZSH_VERSION}" ]]
+        then
+            _DTAGS_TAGS=(${(f)tags})
+        else
+            IFS=$'\n' read -r -d '' -a _DTAGS_TAGS <<< "${tags}"
+        fi
+        _DTAGS_TAGS_STAMP="${stamp} ${#log}"
+    fi
+}
+_dtags_complete_tags() {
+    if [[ "$1" == -* ]] || ! _dtags_load_tags
+    then
+        return 0
+    elif [[ -n "${ZSH_VERSION}" ]]
+    then
+        COMPREPLY+=(${(M)_DTAGS_TAGS:#${(b)1}*})
+        return 0
+    fi
+    # The tag names are sorted, so the matches are found by binary search
+    local LC_ALL=C lo=0 hi="${#_DTAGS_TAGS[@]}" mid start
+    while (( lo < hi ))
+    do
+        mid=$(( (lo + hi) / 2 ))
+        if [[ "${_DTAGS_TAGS[mid]}" < "$1" ]]
+        then
+            lo=$(( mid + 1 ))
+        else
+            hi="${mid}"
+        fi
+    done
+    start="${lo}"
+    hi="${#_DTAGS_TAGS[@]}"
+    while (( lo < hi ))
+    do
+        mid=$(( (lo + hi) / 2 ))
+        if [[ "${_DTAGS_TAGS[mid]}" == "$1"* ]]
         then
-            cd "$(cat ~/.dtags/destination)"
-            rm -f ~/.dtags/destination
+            lo=$(( mid + 1 ))
+        else
+            hi="${mid}"
         fi
+    done
+    # Slices expand the whole array, so only take one for many matches
+    if (( lo - start > 500 ))
+    then
+        COMPREPLY+=("${_DTAGS_TAGS[@]:start:lo - start}")
+    else
+        while (( start < lo ))
+        do
+            COMPREPLY+=("${_DTAGS_TAGS[start++]}")
+        done
     fi
 }
 _dtags_elem_not_in () {
@@ -34,14 +205,16 @@ _dtags_elem_not_in () {
 }
 _dtags_d() {
     declare CWORD="${COMP_WORDS[COMP_CWORD]}"
-    if [[ -f ~/.dtags/completion ]]
+    if [[ "${CWORD}" == */* ]] && _dtags_complete_subdirs "${CWORD}"
     then
-        COMPREPLY+=($(compgen -W "$(cat ~/.dtags/completion)" -- "${CWORD}"))
+        return 0
     fi
+    _dtags_complete_tags "${CWORD}"
     if _dtags_elem_not_in "-t" "${COMP_WORDS[@]}"
     then
         COMPREPLY+=($(compgen -W "-t" -- "${CWORD}"))
     fi
+    COMPREPLY+=($(compgen -W "-i --interactive" -- "${CWORD}"))
     if [[ ${COMP_CWORD} -eq 1 ]]
     then
         COMPREPLY+=($(compgen -W "-h --help -v --version" -- "${CWORD}"))
@@ -49,15 +222,12 @@ _dtags_d() {
 }
 _dtags_tag() {
     declare CWORD="${COMP_WORDS[COMP_CWORD]}"
-    if [[ -f ~/.dtags/completion ]]
-    then
-        COMPREPLY+=($(compgen -W "$(cat ~/.dtags/completion)" -- "${CWORD}"))
-    fi
+    _dtags_complete_tags "${CWORD}"
     if _dtags_elem_not_in "-t" "${COMP_WORDS[@]}"
     then
         COMPREPLY+=($(compgen -W "-t" -- "${CWORD}"))
     fi
-    COMPREPLY+=($(compgen -W "-y --yes -r --replace" -- "${CWORD}"))
+    COMPREPLY+=($(compgen -W "-y --yes -r --replace --stdin -0 --null" -- "${CWORD}"))
     if [[ ${COMP_CWORD} -eq 1 ]]
     then
         COMPREPLY+=($(compgen -W "-h --help -v --version" -- "${CWORD}"))
@@ -65,15 +235,12 @@ _dtags_tag() {
 }
 _dtags_untag() {
     declare CWORD="${COMP_WORDS[COMP_CWORD]}"
-    if [[ -f ~/.dtags/completion ]]
-    then
-        COMPREPLY+=($(compgen -W "$(cat ~/.dtags/completion)" -- "${CWORD}"))
-    fi
+    _dtags_complete_tags "${CWORD}"
     if _dtags_elem_not_in "-t" "${COMP_WORDS[@]}"
     then
         COMPREPLY+=($(compgen -W "-t" -- "${CWORD}"))
     fi
-    COMPREPLY+=($(compgen -W "-y --yes" -- "${CWORD}"))
+    COMPREPLY+=($(compgen -W "-y --yes --stdin -0 --null" -- "${CWORD}"))
     if [[ ${COMP_CWORD} -eq 1 ]]
     then
         COMPREPLY+=($(compgen -W "-h --help -v --version" -- "${CWORD}"))
@@ -81,12 +248,10 @@ _dtags_untag() {
 }
 _dtags_tags() {
     declare CWORD="${COMP_WORDS[COMP_CWORD]}"
-    if [[ -f ~/.dtags/completion ]]
-    then
-        COMPREPLY+=($(compgen -W "$(cat ~/.dtags/completion)" -- "${CWORD}"))
-    fi
-    COMPREPLY+=($(compgen -W "-j --json -r --reverse -y --yes" -- "${CWORD}"))
-    COMPREPLY+=($(compgen -W "-c --clean -p --purge -t" -- "${CWORD}"))
+    _dtags_complete_tags "${CWORD}"
+    COMPREPLY+=($(compgen -W "-j --json -n --ndjson -r --reverse" -- "${CWORD}"))
+    COMPREPLY+=($(compgen -W "-y --yes" -- "${CWORD}"))
+    COMPREPLY+=($(compgen -W "-c --clean -p --purge -f --fix -t" -- "${CWORD}"))
     if [[ ${COMP_CWORD} -eq 1 ]]
     then
         COMPREPLY+=($(compgen -W "-h --help -v --version" -- "${CWORD}"))
@@ -94,13 +259,12 @@ _dtags_tags() {
 }
 _dtags_run() {
     declare CWORD="${COMP_WORDS[COMP_CWORD]}"
-    if [[ -f ~/.dtags/completion ]]
-    then
-        COMPREPLY+=($(compgen -W "$(cat ~/.dtags/completion)" -- "${CWORD}"))
-    fi
+    _dtags_complete_tags "${CWORD}"
     if _dtags_elem_not_in "-c" "${COMP_WORDS[@]}"
     then
-        COMPREPLY+=($(compgen -W "-c" -- "${CWORD}"))
+        COMPREPLY+=($(compgen -W "-c -j --jobs -s --stream" -- "${CWORD}"))
+        COMPREPLY+=($(compgen -W "--timeout --retries --fail-fast" -- "${CWORD}"))
+        COMPREPLY+=($(compgen -W "--report" -- "${CWORD}"))
     fi
     if [[ ${COMP_CWORD} -eq 1 ]]
     then
@@ -131,15 +295,106 @@ function d
         else if [ $argv[1] = "-" ]
             cd -
             return 0
+        else if __dtags_resolve $argv[1]
+            cd $__dtags_dest; and __dtags_log_visit $argv[1]
+            return 0
+        end
+    end
+    set -lx DTAGS_DEST_FD 3
+    set -l dest (dtags-d $argv 3>&1 1>&2); or return
+    if test -n "$dest"
+        cd $dest
+    end
+end
+
+function __dtags_log_visit
+    if string match -q -- '*/*' $argv[1]; or not test -d ~/.dtags
+        return 0
+    end
+    printf '%s %s\n' (date +%s) $PWD >> ~/.dtags/visits
+    set -q __dtags_visits; or set -g __dtags_visits 0
+    set -g __dtags_visits (math $__dtags_visits + 1)
+    if [ (math $__dtags_visits % 100) -eq 0 ]
+        set -l large (command find ~/.dtags/visits -size +256k 2> /dev/null)
+        if set -q large[1]
+            command mv -f ~/.dtags/visits ~/.dtags/visits.1
+        end
+    end
+    return 0
+end
+
+function __dtags_resolve
+    # Not all fish versions support -nt in the builtin test
+    if not test -f ~/.dtags/lookup.fish
+        or command test ~/.dtags/config.json -nt ~/.dtags/lookup.fish
+        return 1
+    end
+    set -l parts (string split -m 1 / -- $argv[1])
+    if not string match -qr -- '^[-a-zA-Z0-9]+$' $parts[1]
+        return 1
+    end
+    read -l stamp < ~/.dtags/lookup.fish
+    if [ "$stamp" != "$__dtags_lookup_stamp" ]
+        source ~/.dtags/lookup.fish; or return 1
+        set -g __dtags_lookup_stamp $stamp
+    end
+    __dtags_load_overlay $stamp; or return 1
+    set -l name (string replace -a -- - _ $parts[1])
+    set -l var __dtags_overlay__$name
+    if not set -q $var
+        set var __dtags_lookup__$name
+    end
+    set -q $var; and [ -n "$$var" ]; or return 1
+    set -g __dtags_dest $$var
+    if [ (count $parts) -eq 2 ]
+        set -g __dtags_dest $__dtags_dest/$parts[2]
+        test -d $__dtags_dest
+    end
+end
+
+function __dtags_load_overlay
+    set -l stamp ""
+    if test -f ~/.dtags/lookup-overlay.fish
+        read stamp < ~/.dtags/lookup-overlay.fish
+    end
+    if not string match -q -- "$argv[1] *" $stamp
+        set stamp ""
+    end
+    if [ "$stamp" != "$__dtags_overlay_stamp" ]
+        if [ -n "$stamp" ]
+            source ~/.dtags/lookup-overlay.fish; or return 1
+        else
+            set -l names (set -n | string match -- '__dtags_overlay__*')
+            set -q names[1]; and set -e $names
+        end
+        set -g __dtags_overlay_stamp $stamp
+    end
+end
+
+function __dtags_complete_subdirs
+    set -l parts (string split -m 1 / -- (commandline -ct))
+    if [ (count $parts) -ne 2 ]
+        return
+    end
+    set -l sub (string replace -r '[^/]*$' '' -- $parts[2])
+    __dtags_resolve $parts[1]; or return
+    if [ "$__dtags_dest/$sub" != "$__dtags_dirs_key" ]
+        set -g __dtags_dirs_key $__dtags_dest/$sub
+        set -l entries $__dtags_dirs_key*/ $__dtags_dirs_key.*/
+        set -g __dtags_dirs
+        if set -q entries[1]
+            set -g __dtags_dirs (string replace -- $__dtags_dirs_key '' $entries)
         end
     end
-    dtags-d $argv
-    if test -f ~/.dtags/destination
-        cd (cat ~/.dtags/destination)
-        rm -f ~/.dtags/destination
+    for entry in $__dtags_dirs
+        echo $parts[1]/$sub$entry
     end
 end
 
+function __dtags_clear_dirs --on-event fish_prompt
+    set -e __dtags_dirs_key
+end
+
 function __dtags_cond_no_args
     set cmd (commandline -opc)
     if [ (count $cmd) -eq 1 ]
@@ -149,9 +404,38 @@ function __dtags_cond_no_args
     end
 end
 
+function __dtags_load_tags
+    if not test -f ~/.dtags/completion
+        return 1
+    end
+    read -l stamp < ~/.dtags/completion
+    set -l log ""
+    if test -f ~/.dtags/completion.log
+        read -l -z log < ~/.dtags/completion.log
+    end
+    set -l lines (string split -m 1 \\n -- $log)
+    if [ "$lines[1]" != "$stamp" ]
+        set log ""
+    end
+    set -l key "$stamp "(string length -- "$log")
+    if [ "$key" != "$__dtags_tags_stamp" ]
+        if [ -n "$log" ]
+            set -g __dtags_tags (dtags-complete "" 2> /dev/null); or return 1
+        else
+            begin
+                read -l stamp
+                read -l -z tags
+                set -g __dtags_tags (string split -n \\n -- $tags)
+            end < ~/.dtags/completion
+        end
+        set -g __dtags_tags_stamp $key
+    end
+end
+
 function __dtags_complete_tags
-    if test -f ~/.dtags/completion
-        string split ' ' (cat ~/.dtags/completion)
+    set -l token (commandline -ct)
+    if not string match -q -- '-*' $token; and __dtags_load_tags
+        string match -- "$token*" $__dtags_tags
     end
 end
 
@@ -162,6 +446,8 @@ complete -c tag -n '__dtags_cond_no_args' -s v -l version -d 'Flag'
 complete -c tag -s t -d 'Flag'
 complete -c tag -s y -l yes -d 'Flag'
 complete -c tag -s r -l replace -d 'Flag'
+complete -c tag -l stdin -d 'Flag'
+complete -c tag -s 0 -l null -d 'Flag'
 
 complete -c untag -a '(__dtags_complete_tags)' -d 'Tag'
 complete -c untag -a '(__fish_complete_directories)'
@@ -169,28 +455,40 @@ complete -c untag -n '__dtags_cond_no_args' -s h -l help -d 'Flag'
 complete -c untag -n '__dtags_cond_no_args' -s v -l version -d 'Flag'
 complete -c untag -s t -d 'Flag'
 complete -c untag -s y -l yes -d 'Flag'
+complete -c untag -l stdin -d 'Flag'
+complete -c untag -s 0 -l null -d 'Flag'
 
 complete -c tags -a '(__dtags_complete_tags)' -d 'Tag'
 complete -c tags -n '__dtags_cond_no_args' -s h -l help -d 'Flag'
 complete -c tags -n '__dtags_cond_no_args' -s v -l version -d 'Flag'
 complete -c tags -s t -d 'Flag'
 complete -c tags -s j -l json -d 'Flag'
+complete -c tags -s n -l ndjson -d 'Flag'
 complete -c tags -s c -l clean -d 'Flag'
 complete -c tags -s p -l purge -d 'Flag'
+complete -c tags -s f -l fix -d 'Flag'
 complete -c tags -s r -l reverse -d 'Flag'
 complete -c tags -s y -l yes -d 'Flag'
 
 complete -c d -a '(__dtags_complete_tags)' -d 'Tag'
+complete -c d -a '(__dtags_complete_subdirs)'
 complete -c d -a '(__fish_complete_directories)'
 complete -c d -n '__dtags_cond_no_args' -s h -l help -d 'Flag'
 complete -c d -n '__dtags_cond_no_args' -s v -l version -d 'Flag'
 complete -c d -s t -l tag -d 'Flag'
+complete -c d -s i -l interactive -d 'Flag'
 
 complete -c run -a '(__dtags_complete_tags)' -d 'Tag'
 complete -c run -a '(__fish_complete_directories)'
 complete -c run -n '__dtags_cond_no_args' -s h -l help -d 'Flag'
 complete -c run -n '__dtags_cond_no_args' -s v -l version -d 'Flag'
 complete -c run -s c -l cmd -d 'Flag'
+complete -c run -s j -l jobs -d 'Flag'
+complete -c run -s s -l stream -d 'Flag'
+complete -c run -l timeout -d 'Flag'
+complete -c run -l retries -d 'Flag'
+complete -c run -l fail-fast -d 'Flag'
+complete -c run -l report -a 'json' -d 'Flag'
 """
 
 
@@ -0,0 +1,47 @@
+import sys
+from typing import List, Optional
+
+from dtags import style
+from dtags.commons import dtags_command, get_argparser
+from dtags.files import find_completion_tags
+
+USAGE = "dtags-complete [PREFIX]"
+DESCRIPTION = f"""
+Print tag names starting with a prefix, one per line.
+
+Tag names are looked up in the sorted completion index without loading
+the config file. The shell completion functions run this on every TAB.
+
+examples:
+
+  # print tag names starting with "wo"
+  {style.command("dtags-complete wo")}
+
+  # print all tag names
+  {style.command("dtags-complete")}
+"""
+
+
+@dtags_command
+def execute(args: Optional[List[str]] = None) -> None:
+    args = sys.argv[1:] if args is None else args
+
+    # Skip argument parsing altogether as this runs on every keystroke
+    if len(args) <= 1 and not (args and args[0].startswith("-")):
+        return complete_tags(args[0] if args else "")
+
+    parser = get_argparser(prog="dtags-complete", desc=DESCRIPTION, usage=USAGE)
+    parser.add_argument(
+        "prefix",
+        metavar="PREFIX",
+        nargs="?",
+        default="",
+        help="tag name prefix",
+    )
+    parsed_args = parser.parse_args(args)
+    complete_tags(parsed_args.prefix)
+
+
+def complete_tags(prefix: str) -> None:
+    for tag in find_completion_tags(prefix):
+        print(tag)
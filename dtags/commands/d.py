@@ -1,18 +1,43 @@
+import os
 import sys
 from pathlib import Path
-from typing import List, Optional
+from time import time
+from typing import List, Optional, Tuple
 
 from dtags import style
-from dtags.commons import dtags_command, get_argparser
+from dtags.commons import dtags_command, get_argparser, normalize_dir
 from dtags.exceptions import DtagsError
-from dtags.files import load_config_file, save_destination_file
-
-USAGE = "d [-t] DEST"
+from dtags.files import (
+    FrecencyType,
+    find_similar_tags,
+    load_dirpaths,
+    load_frecency_file,
+    load_query_dirpaths,
+    load_stat_cache,
+    load_visit_log,
+    lock_frecency_file,
+    save_destination_file,
+    save_frecency_file,
+    save_stat_cache,
+)
+from dtags.query import is_query, parse_query
+
+# Number of directories to remember visits for
+FRECENCY_MAX_ENTRIES = 1000
+
+# Minimum similarity for a tag to be used in place of a mistyped one
+FUZZY_MATCH_SCORE = 0.5
+
+USAGE = "d [-t] [-i] DEST"
 DESCRIPTION = f"""
 Change directory by path or tag.
 
 Tag names are automatically slugified (e.g "foo bar" to "foo-bar").
 Paths take precedence over tags on name collisions.
+Tags can be combined with & (and), | (or), ! (not) and parentheses.
+If no tag matches exactly, the most similar tag is used if there is one.
+If a tag points to several directories, the one visited most frequently
+and recently (frecency) is chosen. Use -i/--interactive to choose manually.
 
 examples:
 
@@ -22,13 +47,28 @@ examples:
   # change directory by tag
   {style.command("d my-tag")}
 
+  # change directory to a subdirectory of a tagged directory
+  {style.command("d my-tag/src/app")}
+
+  # change directory to one tagged "work" and "python" but not "archived"
+  {style.command("d 'work & python & !archived'")}
+
   # use -t/--tag to always interpret the argument as a tag
   {style.command("d -t foo")}
+
+  # use -i/--interactive to always choose from multiple directories
+  {style.command("d -i foo")}
 """
 
 
 @dtags_command
 def execute(args: Optional[List[str]] = None) -> None:
+    args = sys.argv[1:] if args is None else args
+
+    # Skip argument parsing altogether for the common case of "d DEST"
+    if len(args) == 1 and args[0] and not args[0].startswith("-"):
+        return change_directory(args[0])
+
     parser = get_argparser(prog="d", desc=DESCRIPTION, usage=USAGE)
     parser.add_argument(
         "destination",
@@ -42,29 +82,147 @@ def execute(args: Optional[List[str]] = None) -> None:
         dest="tag",
         help="assume the argument is a tag",
     )
-    parsed_args = parser.parse_args(sys.argv[1:] if args is None else args)
+    parser.add_argument(
+        "-i",
+        "--interactive",
+        action="store_true",
+        dest="interactive",
+        help="prompt to choose from multiple directories",
+    )
+    parsed_args = parser.parse_args(args)
 
     if parsed_args.destination:
-        change_directory(parsed_args.destination, parsed_args.tag)
+        change_directory(
+            parsed_args.destination,
+            is_tag=parsed_args.tag,
+            interactive=parsed_args.interactive,
+        )
 
 
-def change_directory(dest: str, is_tag: bool = False) -> None:
-    config = load_config_file()
-    tag_config = config["tags"]
-
-    dirpaths = {dirpath for dirpath, tags in tag_config.items() if dest in tags}
+def change_directory(
+    dest: str, is_tag: bool = False, interactive: bool = False
+) -> None:
+    # Tag names never contain slashes, so paths like ~/foo skip the index
+    dirpaths = set() if "/" in dest else load_dirpaths([dest]).get(dest, set())
 
     if not is_tag:
-        path = Path(dest).expanduser()
-        if path.is_dir():
-            dirpaths.add(path.resolve())
+        stat_cache = load_stat_cache()
+        prev_stat_cache = stat_cache.copy()
+        dirpath = normalize_dir(dest, stat_cache)
+        if dirpath is not None:
+            dirpaths.add(dirpath)
+        if stat_cache != prev_stat_cache:
+            save_stat_cache(stat_cache)
+
+    # Tag queries are given as e.g. "work & python & !archived"
+    if not dirpaths and is_query(dest):
+        dirpaths = load_query_dirpaths(parse_query(dest))
+
+    # Subdirectories of tagged directories are given as "tag/sub/dir"
+    elif not dirpaths and "/" in dest:
+        tag, subpath = dest.split("/", 1)
+        dirpaths = {
+            (dirpath / subpath).resolve()
+            for dirpath in load_dirpaths([tag]).get(tag, set())
+            if (dirpath / subpath).is_dir()
+        }
+
+    # Fall back to the most similar tag (e.g. for typos or prefixes)
+    elif not dirpaths and "/" not in dest:
+        matches = find_similar_tags(dest)
+        if matches and matches[0][0] >= FUZZY_MATCH_SCORE:
+            if len(matches) == 1 or matches[1][0] < matches[0][0]:
+                tag = matches[0][1]
+                print(f"Using {style.tag(tag)}", file=sys.stderr)
+                dirpaths = load_dirpaths([tag]).get(tag, set())
+
+        if not dirpaths and matches:
+            suggestions = ", ".join(style.tag(tag) for _, tag in matches)
+            raise DtagsError(f"Invalid destination: {dest} (similar: {suggestions})")
 
     if not dirpaths:
         raise DtagsError(f"Invalid destination: {dest}")
-    elif len(dirpaths) == 1:
-        save_destination_file(dirpaths.pop())
-    else:  # pragma: no cover
-        save_destination_file(prompt_user_selection(sorted(dirpaths)))
+
+    if len(dirpaths) == 1:
+        dirpath = dirpaths.pop()
+    else:
+        frecency = update_frecency()
+        if interactive or frecency.keys().isdisjoint(dirpaths):
+            dirpath = prompt_user_selection(sorted(dirpaths))
+        else:
+            now = time()
+            dirpath = max(
+                sorted(dirpaths),
+                key=lambda d: get_frecency_score(*frecency.get(d, (0, 0.0)), now=now),
+            )
+
+    update_frecency(dirpath)
+    output_destination(dirpath)
+
+
+def update_frecency(dirpath: Optional[Path] = None) -> FrecencyType:
+    """Fold the visits logged by the shell into the frecency file and return it.
+
+    A visit to the directory is recorded as well, if one is given. The file is
+    updated under a lock, so that concurrent d commands do not lose visits,
+    and only if anything changed.
+    """
+    with lock_frecency_file():
+        frecency = load_frecency_file()
+        visits = load_visit_log()
+        for visited_dirpath, visited_at in visits:
+            record_visit(frecency, visited_dirpath, visited_at)
+        if dirpath is not None:
+            record_visit(frecency, dirpath, time())
+        if visits or dirpath is not None:
+            save_frecency_file(frecency)
+    return frecency
+
+
+def get_frecency_score(
+    visits: int, visited_at: float, now: float
+) -> Tuple[float, float]:
+    """Return the sort key of a directory, weighing its visits by their recency."""
+    age = now - visited_at
+    if age < 3600:
+        weight = 4.0
+    elif age < 86400:
+        weight = 2.0
+    elif age < 604800:
+        weight = 0.5
+    else:
+        weight = 0.25
+    return visits * weight, visited_at  # the last visit breaks ties
+
+
+def record_visit(frecency: FrecencyType, dirpath: Path, visited_at: float) -> None:
+    visits, last_visited_at = frecency.pop(dirpath, (0, 0.0))
+    frecency[dirpath] = (visits + 1, max(visited_at, last_visited_at))
+
+    # Forget the least frequently and recently visited other directories
+    if len(frecency) > FRECENCY_MAX_ENTRIES:
+        now = time()
+        stale_dirpaths = sorted(
+            (d for d in frecency if d != dirpath),
+            key=lambda d: get_frecency_score(*frecency[d], now=now),
+        )
+        for stale_dirpath in stale_dirpaths[: len(frecency) - FRECENCY_MAX_ENTRIES]:
+            del frecency[stale_dirpath]
+
+
+def output_destination(dirpath: Path) -> None:
+    """Pass the destination to the shell function which changes directory.
+
+    The activate scripts set DTAGS_DEST_FD to a file descriptor which they
+    capture. Shells activated by older versions read the destination file.
+    """
+    fd = os.environ.get("DTAGS_DEST_FD")
+    if not fd:
+        return save_destination_file(dirpath)
+    try:
+        os.write(int(fd), os.fsencode(dirpath))
+    except (ValueError, OSError) as err:
+        raise DtagsError(f"Bad value for DTAGS_DEST_FD: {fd} ({err})")
 
 
 def prompt_user_selection(dirpaths: List[Path]) -> Path:  # pragma: no cover
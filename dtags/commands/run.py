@@ -1,26 +1,71 @@
-import argparse
-import subprocess
+import os
 import sys
-from typing import List, Optional
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
 
 from dtags import style
 from dtags.commons import (
     dtags_command,
     fix_color_for_windows,
     get_argparser,
+    is_dir,
+    is_windows,
     normalize_dir,
     normalize_tag,
-    reverse_map,
 )
-from dtags.files import load_config_file
+from dtags.files import (
+    find_similar_tags,
+    load_dirpaths,
+    load_query_dirpaths,
+    load_stat_cache,
+    load_tags,
+    save_stat_cache,
+)
+from dtags.query import is_query, parse_query
+
+if TYPE_CHECKING:  # pragma no cover
+    from subprocess import Popen
+    from threading import Timer
+
+STREAM_CHUNK_SIZE = 65536
+STREAM_LINE_LIMIT = 65536
+REPORT_SLOWEST_COUNT = 10
 
-USAGE = "run DEST [DEST ...] -c ..."
+# Failed commands are retried after 1, 2, 4 ... seconds (up to the maximum)
+RETRY_BACKOFF = 1.0
+RETRY_BACKOFF_MAX = 60.0
+
+USAGE = (
+    "run [-j N] [-s] [--timeout SECS] [--retries N] [--fail-fast] "
+    "[--report FORMAT] DEST [DEST ...] -c ..."
+)
 DESCRIPTION = f"""
 Execute a command in one or more directories.
 
 Target directories are iterated in alphabetical order.
 Paths take precedence over tags on name collisions.
+Tags can be combined with & (and), | (or), ! (not) and parentheses.
 The command is run only once per directory in subprocesses.
+With -j/--jobs, output is buffered and printed one directory at a time.
+With -s/--stream, output lines are printed live with directory prefixes.
+With --report json, output is printed to stderr and a report with the exit
+code, wall time, CPU time and output size of each directory (and the slowest
+directories) is printed to stdout.
+With --timeout, the process group of a command is killed after SECS seconds.
+With --retries, failed commands are retried up to N times with backoff.
+With --fail-fast, running commands are killed and the rest are skipped after
+the first failure.
 
 examples:
 
@@ -32,11 +77,31 @@ examples:
 
   # run "git status" in directories tagged "work" and in ~/foo
   {style.command("run work ~/foo -c git status")}
+
+  # run "pytest" in directories tagged "work" and "python" but not "archived"
+  {style.command("run 'work & python & !archived' -c pytest")}
+
+  # run "git fetch" in up to 8 directories at a time with -j/--jobs
+  {style.command("run -j 8 work -c git fetch")}
+
+  # watch "make" output from up to 8 directories live with -s/--stream
+  {style.command("run -j 8 -s work -c make")}
+
+  # run "git pull" with a 2-minute timeout and up to 3 retries per directory
+  {style.command("run -j 8 --timeout 120 --retries 3 work -c git pull")}
+
+  # stop running "pytest" in directories tagged "work" after the first failure
+  {style.command("run -j 4 --fail-fast work -c pytest")}
+
+  # save timings of "git gc" in directories tagged "work" as JSON
+  {style.command("run -j 8 --report json work -c git gc > report.json")}
 """
 
 
 @dtags_command
 def execute(args: Optional[List[str]] = None) -> None:
+    import argparse
+
     parser = get_argparser(prog="run", desc=DESCRIPTION, usage=USAGE)
     parser.add_argument(
         "destinations",
@@ -44,6 +109,50 @@ def execute(args: Optional[List[str]] = None) -> None:
         nargs="+",
         help="directory path or tag",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        type=int,
+        default=1,
+        dest="jobs",
+        help="number of directories to run in parallel",
+    )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        action="store_true",
+        dest="stream",
+        help="stream output lines prefixed with directory paths",
+    )
+    parser.add_argument(
+        "--timeout",
+        metavar="SECS",
+        type=float,
+        dest="timeout",
+        help="kill commands still running after this many seconds",
+    )
+    parser.add_argument(
+        "--retries",
+        metavar="N",
+        type=int,
+        default=0,
+        dest="retries",
+        help="number of times to retry failed commands",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        dest="fail_fast",
+        help="stop at the first failure",
+    )
+    parser.add_argument(
+        "--report",
+        metavar="FORMAT",
+        choices=["json"],
+        dest="report",
+        help="print a report of exit codes and timings (format: json)",
+    )
     parser.add_argument(
         "-c",
         "--cmd",
@@ -56,46 +165,582 @@ def execute(args: Optional[List[str]] = None) -> None:
 
     if not parsed_args.command:
         parser.error("the following arguments are required: -c/--cmd")
+    elif parsed_args.jobs < 1:
+        parser.error("argument -j/--jobs: must be a positive integer")
+    elif parsed_args.timeout is not None and not parsed_args.timeout > 0:
+        parser.error("argument --timeout: must be a positive number")
+    elif parsed_args.retries < 0:
+        parser.error("argument --retries: must be a non-negative integer")
+    elif parsed_args.stream and is_windows:  # pragma no cover
+        parser.error("argument -s/--stream: not supported on Windows")
+    elif parsed_args.report and parsed_args.stream:
+        parser.error("argument --report: not allowed with argument -s/--stream")
+    elif parsed_args.report and is_windows:  # pragma no cover
+        parser.error("argument --report: not supported on Windows")
     else:
-        run_command(parsed_args.destinations, parsed_args.command)
+        run_command(
+            destinations=parsed_args.destinations,
+            command=parsed_args.command,
+            jobs=parsed_args.jobs,
+            stream=parsed_args.stream,
+            report=parsed_args.report,
+            timeout=parsed_args.timeout,
+            retries=parsed_args.retries,
+            fail_fast=parsed_args.fail_fast,
+        )
 
 
-def run_command(destinations: List[str], command: List[str]) -> None:
-    config = load_config_file()
-    tag_config = config["tags"]
-
-    tag_to_dirpaths = reverse_map(tag_config)
+def run_command(
+    destinations: List[str],
+    command: List[str],
+    jobs: int = 1,
+    stream: bool = False,
+    report: Optional[str] = None,
+    timeout: Optional[float] = None,
+    retries: int = 0,
+    fail_fast: bool = False,
+) -> None:
     dirpaths = set()
+    tags = set()
+    query_dirpaths = set()
+    stat_cache = load_stat_cache()
+    prev_stat_cache = stat_cache.copy()
 
     for dest in destinations:
-        dirpath = normalize_dir(dest)
+        dirpath = normalize_dir(dest, stat_cache)
         if dirpath is not None:
             dirpaths.add(dirpath)
+        elif is_query(dest):
+            query_dirpaths.update(load_query_dirpaths(parse_query(dest)))
         else:
-            tag = normalize_tag(dest)
-            if tag in tag_to_dirpaths:
-                for dirpath in tag_to_dirpaths[tag]:
-                    if dirpath.is_dir():
-                        dirpaths.add(dirpath)
+            tags.add(normalize_tag(dest))
 
-    return_code = 0
-    for dirpath in sorted(dirpaths):
-        tags = tag_config.get(dirpath, set())
+    tag_to_dirpaths = load_dirpaths(tags)
+    for tag_dirpaths in [query_dirpaths, *tag_to_dirpaths.values()]:
+        for dirpath in tag_dirpaths:
+            if is_dir(dirpath, stat_cache):
+                dirpaths.add(dirpath)
 
-        fix_color_for_windows()
-        print(f"\n{style.mapping(dirpath, tags)}:")
-        try:
-            process = subprocess.run(
+    # Commands are never run in similar tags, but they are suggested
+    for tag in sorted(tags - tag_to_dirpaths.keys()):
+        matches = find_similar_tags(tag)
+        if matches:
+            suggestions = ", ".join(style.tag(t) for _, t in matches)
+            print(f"Unknown tag: {tag} (similar: {suggestions})", file=sys.stderr)
+
+    if stat_cache != prev_stat_cache:
+        save_stat_cache(stat_cache)
+
+    tag_config = load_tags(dirpaths)
+    policy = RunPolicy(timeout=timeout, retries=retries, fail_fast=fail_fast)
+
+    if report:
+        return_code = run_report(sorted(dirpaths), tag_config, command, jobs, policy)
+    elif stream:
+        return_code = run_streaming(sorted(dirpaths), command, jobs, policy)
+    elif jobs > 1:
+        return_code = run_parallel(sorted(dirpaths), tag_config, command, jobs, policy)
+    else:
+        return_code = run_serial(sorted(dirpaths), tag_config, command, policy)
+
+    sys.exit(return_code)
+
+
+class RunResult(NamedTuple):
+    exit_code: Optional[int]  # None if the command was never run to completion
+    attempts: int  # 0 if the directory was skipped after a failure
+    timed_out: bool = False
+    cancelled: bool = False
+    error: str = ""
+
+
+class RunPolicy:
+    """Timeout, retry and fail-fast settings shared by the directories of a run.
+
+    With a timeout or fail-fast, commands are started in new sessions so that
+    their whole process groups (e.g. "git" and its "ssh") can be killed. The
+    policy also keeps track of running processes, so that they are killed when
+    the run is cancelled by a failure or interrupted (e.g. with Ctrl-C).
+    """
+
+    def __init__(
+        self,
+        timeout: Optional[float] = None,
+        retries: int = 0,
+        fail_fast: bool = False,
+    ) -> None:
+        import threading
+
+        self.timeout = timeout
+        self.retries = retries
+        self.fail_fast = fail_fast
+        self.new_session = (timeout is not None or fail_fast) and not is_windows
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.processes: Dict["Popen[bytes]", Optional["Timer"]] = {}
+        self.expired: Set["Popen[bytes]"] = set()
+
+    def __enter__(self) -> "RunPolicy":
+        return self
+
+    def __exit__(self, exc_type: Any, *_: Any) -> None:
+        if exc_type is not None:
+            self.cancel()
+
+    def start(
+        self, command: List[str], dirpath: Path, **kwargs: Any
+    ) -> Optional["Popen[bytes]"]:
+        """Start the command in the directory, or return None if cancelled."""
+        import subprocess
+        import threading
+
+        with self.lock:
+            if self.cancelled.is_set():
+                return None
+            process = subprocess.Popen(
                 command,
                 cwd=dirpath,
-                stderr=subprocess.STDOUT,
+                start_new_session=self.new_session,
+                **kwargs,
             )
-        except FileNotFoundError:
-            print(f"Invalid command: {command[0]}", file=sys.stderr)
-        except NotADirectoryError:  # pragma no cover
-            print(f"Not a directory: {dirpath.as_posix()}", file=sys.stderr)
-        else:
-            if process.returncode != 0:
+            if self.timeout is None:
+                self.processes[process] = None
+            else:
+                timer = threading.Timer(self.timeout, self.expire, [process])
+                timer.daemon = True
+                timer.start()
+                self.processes[process] = timer
+        return process
+
+    def wait(
+        self,
+        process: "Popen[bytes]",
+        reap: Optional[Callable[["Popen[bytes]"], int]] = None,
+    ) -> Tuple[int, bool, bool]:
+        """Wait for the process and return (exit code, timed out, cancelled)."""
+        try:
+            exit_code = process.wait() if reap is None else reap(process)
+        finally:
+            with self.lock:
+                timer = self.processes.pop(process)
+                if timer is not None:
+                    timer.cancel()
+        timed_out = process in self.expired
+        self.expired.discard(process)
+        return exit_code, timed_out, self.cancelled.is_set() and exit_code < 0
+
+    def run(
+        self,
+        dirpath: Path,
+        command: List[str],
+        reap: Optional[Callable[["Popen[bytes]"], int]] = None,
+        **kwargs: Any,
+    ) -> RunResult:
+        """Run the command until it succeeds or no retries are left."""
+        attempt = 0
+        while True:
+            try:
+                process = self.start(command, dirpath, **kwargs)
+            except (FileNotFoundError, NotADirectoryError):
+                self.fail()
+                return RunResult(None, attempt + 1, error=get_error(dirpath, command))
+            if process is None:
+                return RunResult(None, attempt, cancelled=True)
+
+            attempt += 1
+            exit_code, timed_out, cancelled = self.wait(process, reap)
+            result = RunResult(exit_code, attempt, timed_out, cancelled)
+            delay = self.get_retry_delay(result)
+            if delay is None:
+                break
+
+            print(self.get_retry_message(dirpath, result, delay), file=sys.stderr)
+            if self.cancelled.wait(delay):
+                break
+
+        if exit_code != 0:
+            self.fail()
+        return result
+
+    def get_retry_delay(self, result: RunResult) -> Optional[float]:
+        """Return seconds to wait before retrying, or None if not retrying."""
+        if result.exit_code == 0 or result.cancelled or self.cancelled.is_set():
+            return None
+        if result.attempts > self.retries:
+            return None
+        return min(RETRY_BACKOFF * 2.0 ** (result.attempts - 1), RETRY_BACKOFF_MAX)
+
+    def get_retry_message(self, dirpath: Path, result: RunResult, delay: float) -> str:
+        reason = self.get_error(result) or f"Exit code {result.exit_code}"
+        return (
+            f"{reason}, retrying in {delay:g}s "
+            f"(attempt {result.attempts + 1} of {self.retries + 1}): "
+            f"{dirpath.as_posix()}"
+        )
+
+    def get_error(self, result: RunResult) -> str:
+        if result.timed_out:
+            return f"Timed out after {self.timeout:g}s"
+        if result.cancelled and result.attempts > 0:
+            return "Cancelled"
+        return result.error
+
+    def expire(self, process: "Popen[bytes]") -> None:
+        with self.lock:
+            if process in self.processes:
+                self.expired.add(process)
+                self.kill(process)
+
+    def fail(self) -> None:
+        if self.fail_fast:
+            self.cancel()
+
+    def cancel(self) -> None:
+        with self.lock:
+            self.cancelled.set()
+            for process in self.processes:
+                self.kill(process)
+
+    def kill(self, process: "Popen[bytes]") -> None:
+        import signal
+
+        if process.returncode is not None:
+            return
+        try:
+            if self.new_session:
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except ProcessLookupError:  # pragma no cover
+            pass
+
+
+def print_skipped(count: int) -> None:
+    if count > 0:
+        print(f"Skipped directories after a failure: {count}", file=sys.stderr)
+
+
+def run_serial(
+    dirpaths: List[Path],
+    tag_config: Dict[Path, Set[str]],
+    command: List[str],
+    policy: RunPolicy,
+) -> int:
+    import subprocess
+
+    return_code = 0
+    with policy:
+        for num, dirpath in enumerate(dirpaths):
+            if policy.cancelled.is_set():
+                print_skipped(len(dirpaths) - num)
+                break
+
+            tags = tag_config.get(dirpath, set())
+
+            fix_color_for_windows()
+            print(f"\n{style.mapping(dirpath, tags)}:", flush=True)
+            result = policy.run(dirpath, command, stderr=subprocess.STDOUT)
+            error = policy.get_error(result)
+            if error:
+                print(error, file=sys.stderr)
+            if result.exit_code or result.error:
                 return_code = 1
 
-    sys.exit(return_code)
+    return return_code
+
+
+def get_error(dirpath: Path, command: List[str]) -> str:
+    # The directory may have been removed since it was checked (or cached)
+    if not dirpath.is_dir():
+        return f"Not a directory: {dirpath.as_posix()}"
+    return f"Invalid command: {command[0]}"
+
+
+def run_parallel(
+    dirpaths: List[Path],
+    tag_config: Dict[Path, Set[str]],
+    command: List[str],
+    jobs: int,
+    policy: RunPolicy,
+) -> int:
+    from concurrent.futures import ThreadPoolExecutor
+    from functools import partial
+
+    return_code = 0
+    skipped = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor, policy:
+        results = executor.map(
+            partial(capture_output, command=command, policy=policy), dirpaths
+        )
+
+        # Results are yielded in order so output blocks remain alphabetical
+        for dirpath, (result, output) in zip(dirpaths, results):
+            if result.attempts == 0:
+                skipped += 1
+                continue
+
+            tags = tag_config.get(dirpath, set())
+            error = policy.get_error(result)
+
+            fix_color_for_windows()
+            print(f"\n{style.mapping(dirpath, tags)}:")
+            if output:
+                print(output, end="", flush=True)
+            if error:
+                print(error, file=sys.stderr)
+            if result.exit_code or result.error:
+                return_code = 1
+
+    print_skipped(skipped)
+    return return_code
+
+
+def capture_output(
+    dirpath: Path, command: List[str], policy: RunPolicy
+) -> Tuple[RunResult, str]:
+    """Run the command and return (result, output)."""
+    import subprocess
+    import tempfile
+
+    # Output is spooled to a file, which (unlike a pipe) needs no reader while
+    # waiting for the process and keeps the output of all attempts
+    with tempfile.TemporaryFile() as output:
+        result = policy.run(
+            dirpath,
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=output,
+            stderr=subprocess.STDOUT,
+        )
+        output.seek(0)
+        return result, output.read().decode(errors="replace")
+
+
+def run_report(
+    dirpaths: List[Path],
+    tag_config: Dict[Path, Set[str]],
+    command: List[str],
+    jobs: int,
+    policy: RunPolicy,
+) -> int:
+    import json
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from functools import partial
+
+    return_code = 0
+    entries = []
+    start_time = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor, policy:
+        results = executor.map(
+            partial(measure_command, command=command, policy=policy), dirpaths
+        )
+
+        # Command output goes to stderr so that stdout is left to the report
+        for dirpath, (entry, output) in zip(dirpaths, results):
+            tags = tag_config.get(dirpath, set())
+            entry = {"dir": dirpath.as_posix(), "tags": sorted(tags), **entry}
+            entries.append(entry)
+            if entry["attempts"] == 0:
+                continue
+
+            print(f"\n{style.mapping(dirpath, tags)}:", file=sys.stderr)
+            if output:
+                print(output, end="", file=sys.stderr, flush=True)
+            if entry["error"]:
+                print(entry["error"], file=sys.stderr)
+            if entry["exit_code"] or entry["error"]:
+                return_code = 1
+
+    slowest = sorted(entries, key=lambda e: (-e["wall_time"], e["dir"]))
+    summary = {
+        "directories": len(entries),
+        "failed": sum(1 for entry in entries if entry["exit_code"]),
+        "errors": sum(
+            1 for entry in entries if entry["exit_code"] is None and entry["attempts"]
+        ),
+        "timed_out": sum(1 for entry in entries if entry["timed_out"]),
+        "skipped": sum(1 for entry in entries if entry["attempts"] == 0),
+        "wall_time": round(time.perf_counter() - start_time, 6),
+        "cpu_time": round(sum(entry["cpu_time"] for entry in entries), 6),
+        "slowest": [
+            {"dir": entry["dir"], "wall_time": entry["wall_time"]}
+            for entry in slowest[:REPORT_SLOWEST_COUNT]
+        ],
+    }
+    report = {"command": command, "directories": entries, "summary": summary}
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return return_code
+
+
+def measure_command(
+    dirpath: Path, command: List[str], policy: RunPolicy
+) -> Tuple[Dict[str, Any], str]:
+    """Run the command and return (report entry, output).
+
+    The child is reaped with os.wait4 to get its own resource usage, which
+    unlike resource.getrusage(RUSAGE_CHILDREN) is not mixed up with other
+    children running in parallel. Output is spooled to temporary files so
+    that its size is known without holding pipes open. Times and sizes add
+    up over all attempts.
+    """
+    import subprocess
+    import tempfile
+    import time
+
+    user_time = system_time = 0.0
+
+    def reap(process: "Popen[bytes]") -> int:
+        nonlocal user_time, system_time
+
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = get_exit_code(status)
+        user_time += rusage.ru_utime
+        system_time += rusage.ru_stime
+        return process.returncode
+
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        start_time = time.perf_counter()
+        result = policy.run(
+            dirpath,
+            command,
+            reap=reap,
+            stdin=subprocess.DEVNULL,
+            stdout=stdout,
+            stderr=stderr,
+        )
+        entry = {
+            "exit_code": result.exit_code,
+            "attempts": result.attempts,
+            "timed_out": result.timed_out,
+            "cancelled": result.cancelled,
+            "error": policy.get_error(result) or None,
+            "wall_time": round(time.perf_counter() - start_time, 6),
+            "user_time": round(user_time, 6),
+            "system_time": round(system_time, 6),
+            "cpu_time": round(user_time + system_time, 6),
+            "stdout_bytes": os.fstat(stdout.fileno()).st_size,
+            "stderr_bytes": os.fstat(stderr.fileno()).st_size,
+        }
+        stdout.seek(0)
+        stderr.seek(0)
+        output = stdout.read() + stderr.read()
+
+    return entry, output.decode(errors="replace")
+
+
+def get_exit_code(status: int) -> int:
+    # Same as os.waitstatus_to_exitcode, which requires Python 3.9
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_streaming(
+    dirpaths: List[Path], command: List[str], jobs: int, policy: RunPolicy
+) -> int:
+    import heapq
+    import selectors
+    import subprocess
+    import time
+    from collections import deque
+
+    return_code = 0
+    queue: Deque[Tuple[Path, int]] = deque((dirpath, 0) for dirpath in dirpaths)
+    retries: List[Tuple[float, Path, int]] = []  # (start time, dirpath, attempts)
+    selector = selectors.DefaultSelector()
+
+    with policy:
+        while True:
+            while retries and retries[0][0] <= time.monotonic():
+                _, dirpath, attempts = heapq.heappop(retries)
+                queue.append((dirpath, attempts))
+
+            while queue and len(selector.get_map()) < jobs:
+                dirpath, attempts = queue[0]
+                try:
+                    process = policy.start(
+                        command,
+                        dirpath,
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                    )
+                except (FileNotFoundError, NotADirectoryError):
+                    print(get_error(dirpath, command), file=sys.stderr)
+                    queue.popleft()
+                    return_code = 1
+                    policy.fail()
+                    continue
+                if process is None:
+                    break
+
+                queue.popleft()
+                assert process.stdout is not None
+                os.set_blocking(process.stdout.fileno(), False)
+                prefix = f"{style.path(dirpath)}: "
+                state = (process, prefix, bytearray(), dirpath, attempts + 1)
+                selector.register(process.stdout, selectors.EVENT_READ, state)
+
+            if not selector.get_map():
+                if policy.cancelled.is_set() or not retries:
+                    break
+                time.sleep(max(retries[0][0] - time.monotonic(), 0))
+                continue
+
+            timeout = None
+            if retries and len(selector.get_map()) < jobs:
+                timeout = max(retries[0][0] - time.monotonic(), 0)
+
+            for key, _ in selector.select(timeout):
+                process, prefix, buffer, dirpath, attempts = key.data
+                try:
+                    chunk = os.read(key.fd, STREAM_CHUNK_SIZE)
+                except BlockingIOError:  # pragma no cover
+                    continue
+
+                if chunk:
+                    buffer.extend(chunk)
+                    write_lines(prefix, buffer, final=False)
+                    continue
+
+                write_lines(prefix, buffer, final=True)
+                selector.unregister(key.fileobj)
+                process.stdout.close()
+                exit_code, timed_out, cancelled = policy.wait(process)
+                result = RunResult(exit_code, attempts, timed_out, cancelled)
+                delay = policy.get_retry_delay(result)
+                if delay is not None:
+                    message = policy.get_retry_message(dirpath, result, delay)
+                    print(message, file=sys.stderr)
+                    heapq.heappush(
+                        retries, (time.monotonic() + delay, dirpath, attempts)
+                    )
+                    continue
+
+                error = policy.get_error(result)
+                if error:
+                    print(f"{prefix}{error}", file=sys.stderr)
+                if exit_code != 0:
+                    return_code = 1
+                    policy.fail()
+
+    selector.close()
+    print_skipped(len(queue) + len(retries))
+    return return_code
+
+
+def write_lines(prefix: str, buffer: bytearray, final: bool) -> None:
+    """Write complete lines from the buffer and keep the partial remainder.
+
+    Partial lines longer than STREAM_LINE_LIMIT are flushed to bound memory.
+    """
+    end = len(buffer) if final else buffer.rfind(b"\n") + 1
+    if not final and end == 0 and len(buffer) > STREAM_LINE_LIMIT:
+        end = len(buffer)
+    if end > 0:
+        for line in bytes(buffer[:end]).splitlines():
+            sys.stdout.write(f"{prefix}{line.decode(errors='replace')}\n")
+        sys.stdout.flush()
+        del buffer[:end]
@@ -1,19 +1,20 @@
 import sys
 from pathlib import Path
-from typing import List, Optional, Set, Tuple
+from typing import List, Optional
 
 from dtags import style
 from dtags.commons import (
     dtags_command,
     get_argparser,
-    normalize_dirs,
+    normalize_dirs_parallel,
     normalize_tag,
     normalize_tags,
     prompt_user,
+    read_values,
 )
-from dtags.files import load_config_file, save_config_file
+from dtags.files import ConfigDiffType, load_config_snapshot, save_config_diffs
 
-USAGE = "tag [-y] [-r] DIR [DIR ...] -t TAG [TAG ...]"
+USAGE = "tag [-y] [-r] [--stdin [-0]] DIR [DIR ...] -t TAG [TAG ...]"
 DESCRIPTION = f"""
 Tag directories.
 
@@ -33,6 +34,9 @@ examples:
 
   # skip confirmation prompts with -y/--yes
   {style.command("tag -y ~/foo -t work app")}
+
+  # tag directories read from stdin (one per line, or NUL-delimited with -0)
+  {style.command("find ~/src -mindepth 1 -type d -print0 | tag -y --stdin -0")}
 """
 
 
@@ -53,10 +57,23 @@ def execute(args: Optional[List[str]] = None) -> None:
         dest="replace",
         help="replace existing tags",
     )
+    parser.add_argument(
+        "--stdin",
+        action="store_true",
+        dest="stdin",
+        help="read more directories from stdin (requires -y)",
+    )
+    parser.add_argument(
+        "-0",
+        "--null",
+        action="store_true",
+        dest="null",
+        help="directories from stdin are NUL-delimited",
+    )
     parser.add_argument(
         "dirs",
         metavar="DIR",
-        nargs="+",
+        nargs="*",
         help="directories or tags",
     )
     parser.add_argument(
@@ -68,12 +85,20 @@ def execute(args: Optional[List[str]] = None) -> None:
     )
     parsed_args = parser.parse_args(sys.argv[1:] if args is None else args)
 
-    tag_directories(
-        dirs=parsed_args.dirs,
-        tags=parsed_args.tags,
-        replace=parsed_args.replace,
-        skip_prompts=parsed_args.yes,
-    )
+    dirs = parsed_args.dirs
+    if parsed_args.stdin and not parsed_args.yes:
+        parser.error("argument --stdin: cannot prompt without -y/--yes")
+    elif not parsed_args.stdin and not dirs:
+        parser.error("the following arguments are required: DIR")
+    else:
+        if parsed_args.stdin:
+            dirs += read_values(sys.stdin, parsed_args.null)
+        tag_directories(
+            dirs=dirs,
+            tags=parsed_args.tags,
+            replace=parsed_args.replace,
+            skip_prompts=parsed_args.yes,
+        )
 
 
 def tag_directories(
@@ -82,15 +107,16 @@ def tag_directories(
     replace: bool = False,
     skip_prompts: bool = True,
 ) -> None:
-    config = load_config_file()
-    tag_config = config["tags"]
-
-    norm_dirs = normalize_dirs(dirs)
+    norm_dirs = normalize_dirs_parallel(dirs or [])
     norm_tags = normalize_tags(tags)
 
-    diffs: List[Tuple[Path, Set[str], Set[str]]] = []
+    config, signature = load_config_snapshot()
+    tag_config = config["tags"]
+
+    diffs: ConfigDiffType = []
 
-    for dirpath in sorted(norm_dirs):
+    # Sort as in the config file, by string instead of slower Path comparisons
+    for dirpath in sorted(norm_dirs, key=Path.as_posix):
         cur_tags = tag_config.get(dirpath, set())
         new_tags = norm_tags or {normalize_tag(dirpath.name)}
         add_tags = new_tags - cur_tags
@@ -107,5 +133,5 @@ def tag_directories(
             print(style.diff(dirpath, add_tags, del_tags))
 
         if skip_prompts or prompt_user():
-            save_config_file(config)
+            save_config_diffs(config, diffs, signature)
             print("Tags saved successfully")
@@ -1,19 +1,34 @@
-import json
 import sys
-from pathlib import Path
-from typing import List, Optional, Set, Tuple
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
 
 from dtags import style
 from dtags.commons import (
+    check_dirs,
     dtags_command,
     get_argparser,
+    normalize_tag,
     normalize_tags,
     prompt_user,
-    reverse_map,
+    update_stat_cache,
+    write_output,
 )
-from dtags.files import get_new_config, load_config_file, save_config_file
+from dtags.files import (
+    ConfigDiffType,
+    get_new_config,
+    iter_config_tags,
+    iter_tag_dirpaths,
+    load_config_file,
+    load_config_snapshot,
+    load_query_dirpaths,
+    load_stat_cache,
+    lock_config_file,
+    save_config_diffs,
+    save_config_file,
+    save_stat_cache,
+)
+from dtags.query import QueryType, get_query_tags, is_query, parse_query
 
-USAGE = "tags [-j] [-r] [-y] [-c] [-p] [-t TAG [TAG ...]]"
+USAGE = "tags [-j | -n] [-r] [-y] [-c] [-p] [-f] [-t TAG [TAG ...]]"
 DESCRIPTION = f"""
 Manage directory tags.
 
@@ -25,18 +40,27 @@ examples:
   # show tags in JSON format with -j/--json
   {style.command("tags --json")}
 
+  # show tags as one JSON object per line with -n/--ndjson (e.g. for jq)
+  {style.command("tags --ndjson | jq -r .dir")}
+
   # show reverse mapping with -r/--reverse
   {style.command("tags --reverse")}
 
   # filter specific tags with -t
   {style.command("tags -t foo bar baz")}
 
-  # clean invalid directories with -c/--clean
+  # filter with & (and), | (or), ! (not) and parentheses
+  {style.command("tags -t 'work & !archived'")}
+
+  # clean missing directories with -c/--clean (unreachable ones are kept)
   {style.command("tags --clean")}
 
   # purge all tags with -p/--purge
   {style.command("tags --purge")}
 
+  # re-slugify tag names after an upgrade or a manual edit with -f/--fix
+  {style.command("tags --fix")}
+
   # skip confirmation prompts with -y/--yes
   {style.command("tags --clean --yes")}
 """
@@ -54,6 +78,13 @@ def execute(args: Optional[List[str]] = None) -> None:
         dest="json",
         help="show tags in JSON format",
     )
+    parser.add_argument(
+        "-n",
+        "--ndjson",
+        action="store_true",
+        dest="ndjson",
+        help="show tags as newline-delimited JSON",
+    )
     parser.add_argument(
         "-r",
         "--reverse",
@@ -82,6 +113,13 @@ def execute(args: Optional[List[str]] = None) -> None:
         dest="purge",
         help="purge all tags",
     )
+    arg_group.add_argument(
+        "-f",
+        "--fix",
+        action="store_true",
+        dest="fix",
+        help="re-normalize all tag names",
+    )
     arg_group.add_argument(
         "-t",
         metavar="TAG",
@@ -99,15 +137,30 @@ def execute(args: Optional[List[str]] = None) -> None:
         parser.error("argument -j/--json: not allowed with argument -c/--clean")
     elif parsed_args.json and parsed_args.purge:
         parser.error("argument -j/--json: not allowed with argument -p/--purge")
+    elif parsed_args.reverse and parsed_args.fix:
+        parser.error("argument -r/--reverse: not allowed with argument -f/--fix")
+    elif parsed_args.json and parsed_args.fix:
+        parser.error("argument -j/--json: not allowed with argument -f/--fix")
+    elif parsed_args.ndjson and parsed_args.json:
+        parser.error("argument -n/--ndjson: not allowed with argument -j/--json")
+    elif parsed_args.ndjson and parsed_args.clean:
+        parser.error("argument -n/--ndjson: not allowed with argument -c/--clean")
+    elif parsed_args.ndjson and parsed_args.purge:
+        parser.error("argument -n/--ndjson: not allowed with argument -p/--purge")
+    elif parsed_args.ndjson and parsed_args.fix:
+        parser.error("argument -n/--ndjson: not allowed with argument -f/--fix")
     elif parsed_args.clean:
         clean_tags(skip_prompts=parsed_args.yes)
     elif parsed_args.purge:
         purge_tags(skip_prompts=parsed_args.yes)
+    elif parsed_args.fix:
+        repair_tags(skip_prompts=parsed_args.yes)
     else:
         show_tags(
             filters=parsed_args.tags,
             in_json=parsed_args.json,
             in_reverse=parsed_args.reverse,
+            in_ndjson=parsed_args.ndjson,
         )
 
 
@@ -115,63 +168,114 @@ def show_tags(
     filters: Optional[List[str]] = None,
     in_json: bool = False,
     in_reverse: bool = False,
+    in_ndjson: bool = False,
 ) -> None:
-    config = load_config_file()
-    tag_config = config["tags"]
+    query = parse_filters(filters)
+    query_dirpaths = None
+    if query is not None:
+        query_dirpaths = {dirpath.as_posix() for dirpath in load_query_dirpaths(query)}
 
-    tag_filters = None if filters is None else normalize_tags(filters)
-
-    if in_json and in_reverse:
-        raw_data = {
-            tag: sorted(dirpath.as_posix() for dirpath in dirpaths)
-            for tag, dirpaths in reverse_map(tag_config).items()
-            if not tag_filters or tag in tag_filters
-        }
-        print(json.dumps(raw_data, indent=2, sort_keys=True))
-
-    elif in_json and not in_reverse:
-        raw_data = {
-            dirpath.as_posix(): sorted(tags)
-            for dirpath, tags in tag_config.items()
-            if not tag_filters or tags.intersection(tag_filters)
-        }
-        print(json.dumps(raw_data, indent=2, sort_keys=True))
-
-    elif not in_json and in_reverse:
-        tag_to_dirpaths = reverse_map(tag_config)
-        for tag in sorted(tag_to_dirpaths):
-            if not tag_filters or tag in tag_filters:
-                print(style.tag(tag))
-                for dirpath in sorted(tag_to_dirpaths[tag]):
-                    print("  " + style.path(dirpath))
+    if in_reverse:
+        entries = iter_tag_dirpaths(None if query is None else get_query_tags(query))
+        if query_dirpaths is not None:
+            entries = filter_tag_dirpaths(entries, query_dirpaths)
     else:
-        for dirpath, tags in tag_config.items():
-            if not tag_filters or tags.intersection(tag_filters):
-                print(style.mapping(dirpath, tags))
+        entries = iter_config_tags()
+        if query_dirpaths is not None:
+            entries = (entry for entry in entries if entry[0] in query_dirpaths)
+
+    if in_json:
+        write_output(format_json(entries))
+    elif in_ndjson:
+        write_output(format_ndjson(entries, in_reverse))
+    elif in_reverse:
+        write_output(
+            f"{style.tag(tag)}\n" + "".join(f"  {style.path(d)}\n" for d in dirpaths)
+            for tag, dirpaths in entries
+        )
+    else:
+        write_output(f"{style.mapping(d, tags)}\n" for d, tags in entries)
+
+
+def filter_tag_dirpaths(
+    entries: Iterable[Tuple[str, List[str]]], dirpaths: Set[str]
+) -> Iterator[Tuple[str, List[str]]]:
+    for tag, tag_dirpaths in entries:
+        tag_dirpaths = [dirpath for dirpath in tag_dirpaths if dirpath in dirpaths]
+        if tag_dirpaths:
+            yield tag, tag_dirpaths
+
+
+def format_json(entries: Iterable[Tuple[str, List[str]]]) -> Iterator[str]:
+    """Yield the text of json.dumps(dict(entries), indent=2) piece by piece."""
+    import json
+
+    separator = "\n"
+    yield "{"
+    for key, values in entries:
+        yield f"{separator}  {json.dumps(key)}: "
+        if values:
+            yield "[\n" + ",\n".join(f"    {json.dumps(v)}" for v in values) + "\n  ]"
+        else:
+            yield "[]"
+        separator = ",\n"
+    yield "}\n" if separator == "\n" else "\n}\n"
+
+
+def format_ndjson(
+    entries: Iterable[Tuple[str, List[str]]], in_reverse: bool = False
+) -> Iterator[str]:
+    """Yield one JSON object per line (e.g. for jq)."""
+    import json
+
+    key, values_key = ("tag", "dirs") if in_reverse else ("dir", "tags")
+    for value, values in entries:
+        yield json.dumps({key: value, values_key: values}) + "\n"
+
+
+def parse_filters(filters: Optional[List[str]]) -> Optional[QueryType]:
+    """Combine the tag names and queries given to -t into one query (a union)."""
+    query = None
+    for value in filters or []:
+        operand = parse_query(value) if is_query(value) else normalize_tag(value)
+        if operand:
+            query = operand if query is None else ("|", query, operand)
+    return query
 
 
 def clean_tags(skip_prompts: bool = True) -> None:
-    config = load_config_file()
+    config, signature = load_config_snapshot()
     tag_config = config["tags"]
 
-    diffs: List[Tuple[Path, Set[str]]] = [
-        (dirpath, tags) for dirpath, tags in tag_config.items() if not dirpath.is_dir()
+    # Always check directories afresh, and refresh the cache for run and d
+    dir_status = check_dirs(tag_config.keys())
+    stat_cache = load_stat_cache()
+    update_stat_cache(stat_cache, dir_status)
+    save_stat_cache(stat_cache)
+
+    for dirpath, is_dir in dir_status.items():
+        if is_dir is None:
+            print(f"Skipped unreachable {style.path(dirpath)}", file=sys.stderr)
+
+    diffs: ConfigDiffType = [
+        (dirpath, set(), tags)
+        for dirpath, tags in tag_config.items()
+        if dir_status[dirpath] is False
     ]
     if not diffs:
         print("Nothing to clean")
     else:
-        for dirpath, tags in diffs:
-            print(style.diff(dirpath, del_tags=tags))
+        for dirpath, _, del_tags in diffs:
+            print(style.diff(dirpath, del_tags=del_tags))
             del tag_config[dirpath]
 
         if skip_prompts or prompt_user():
-            save_config_file(config)
+            save_config_diffs(config, diffs, signature)
             print("Tags cleaned successfully")
 
 
 def purge_tags(skip_prompts: bool = True) -> None:
-    config = load_config_file()
-    tag_config = config["tags"]
+    tag_config = load_config_file()["tags"]
 
     if not tag_config:
         print("Nothing to purge")
@@ -180,5 +284,29 @@ def purge_tags(skip_prompts: bool = True) -> None:
             print(style.diff(dirpath, del_tags=tags))
 
         if skip_prompts or prompt_user():
-            save_config_file(get_new_config())
+            with lock_config_file():
+                save_config_file(get_new_config())
             print("Tags purged successfully")
+
+
+def repair_tags(skip_prompts: bool = True) -> None:
+    config, signature = load_config_snapshot()
+    tag_config = config["tags"]
+
+    diffs: ConfigDiffType = []
+
+    for dirpath, tags in tag_config.items():
+        norm_tags = normalize_tags(list(tags))
+        if norm_tags != tags:
+            diffs.append((dirpath, norm_tags - tags, tags - norm_tags))
+            tag_config[dirpath] = norm_tags
+
+    if not diffs:
+        print("Nothing to repair")
+    else:
+        for dirpath, add_tags, del_tags in diffs:
+            print(style.diff(dirpath, add_tags, del_tags))
+
+        if skip_prompts or prompt_user():
+            save_config_diffs(config, diffs, signature)
+            print("Tags repaired successfully")
@@ -1,18 +1,19 @@
 import sys
 from pathlib import Path
-from typing import List, Optional, Set, Tuple
+from typing import List, Optional
 
 from dtags import style
 from dtags.commons import (
     dtags_command,
     get_argparser,
-    normalize_dirs,
+    normalize_dirs_parallel,
     normalize_tags,
     prompt_user,
+    read_values,
 )
-from dtags.files import load_config_file, save_config_file
+from dtags.files import ConfigDiffType, load_config_snapshot, save_config_diffs
 
-USAGE = "untag [-y] [DIR ...] [-t TAG [TAG ...]]"
+USAGE = "untag [-y] [--stdin [-0]] [DIR ...] [-t TAG [TAG ...]]"
 DESCRIPTION = f"""
 Untag directories.
 
@@ -33,6 +34,9 @@ examples:
 
   # skip confirmation prompts with -y/--yes
   {style.command("untag -y ~/foo -t work app")}
+
+  # untag directories read from stdin (one per line, or NUL-delimited with -0)
+  {style.command("untag -y --stdin -t work < dirs.txt")}
 """
 
 
@@ -52,6 +56,19 @@ def execute(args: Optional[List[str]] = None) -> None:
         dest="yes",
         help="assume yes to prompts",
     )
+    parser.add_argument(
+        "--stdin",
+        action="store_true",
+        dest="stdin",
+        help="read more directories from stdin (requires -y)",
+    )
+    parser.add_argument(
+        "-0",
+        "--null",
+        action="store_true",
+        dest="null",
+        help="directories from stdin are NUL-delimited",
+    )
     parser.add_argument(
         "-t",
         dest="tags",
@@ -61,11 +78,19 @@ def execute(args: Optional[List[str]] = None) -> None:
     )
     parsed_args = parser.parse_args(sys.argv[1:] if args is None else args)
 
-    if not parsed_args.dirs and not parsed_args.tags:
+    dirs = parsed_args.dirs
+    if parsed_args.stdin and not parsed_args.yes:
+        parser.error("argument --stdin: cannot prompt without -y/--yes")
+    elif not parsed_args.stdin and not dirs and not parsed_args.tags:
         parser.error("one of the following arguments are required: DIR, -t")
     else:
+        if parsed_args.stdin:
+            dirs += read_values(sys.stdin, parsed_args.null)
+            if not dirs:
+                print("Nothing to do")  # never untag all directories by accident
+                return
         untag_directories(
-            dirs=parsed_args.dirs,
+            dirs=dirs,
             tags=parsed_args.tags,
             skip_prompts=parsed_args.yes,
         )
@@ -76,28 +101,29 @@ def untag_directories(
     tags: Optional[List[str]] = None,
     skip_prompts: bool = True,
 ) -> None:
-    config = load_config_file()
+    config, signature = load_config_snapshot()
     tag_config = config["tags"]
 
-    norm_dirs = normalize_dirs(dirs) if dirs else tag_config.keys()
+    norm_dirs = normalize_dirs_parallel(dirs) if dirs else tag_config.keys()
     norm_tags = normalize_tags(tags)
 
-    diffs: List[Tuple[Path, Set[str]]] = []
+    diffs: ConfigDiffType = []
 
-    for dirpath in sorted(norm_dirs):
+    # Sort as in the config file, by string instead of slower Path comparisons
+    for dirpath in sorted(norm_dirs, key=Path.as_posix):
         cur_tags = tag_config.get(dirpath, set())
         del_tags = cur_tags.intersection(norm_tags) if norm_tags else cur_tags
 
         if del_tags:
-            diffs.append((dirpath, del_tags))
+            diffs.append((dirpath, set(), del_tags))
             tag_config[dirpath] = cur_tags - del_tags
 
     if not diffs:
         print("Nothing to do")
     else:
-        for dirpath, del_tags in diffs:
+        for dirpath, _, del_tags in diffs:
             print(style.diff(dirpath, del_tags=del_tags))
 
         if skip_prompts or prompt_user():
-            save_config_file(config)
+            save_config_diffs(config, diffs, signature)
             print("Tags removed successfully")
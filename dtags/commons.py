@@ -1,20 +1,56 @@
 import os
+import re
 import sys
-from argparse import ArgumentParser, RawDescriptionHelpFormatter
-from distutils.util import strtobool
-from functools import wraps
+from functools import lru_cache, wraps
 from pathlib import Path
-from typing import Callable, Dict, List, Optional, Set
-
-from pkg_resources import get_distribution
-from slugify import slugify
+from time import time
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+)
 
 from dtags.exceptions import DtagsError
 
+if TYPE_CHECKING:  # pragma no cover
+    from argparse import ArgumentParser
+
 is_windows = os.name == "nt"
 is_mingw = is_windows and bool(os.environ.get("DTAGS_GIT_BASH"))
 
+YES_ANSWERS = {"y", "yes", "t", "true", "on", "1"}
+NO_ANSWERS = {"n", "no", "f", "false", "off", "0"}
+
+# Directories which cannot be checked within this many seconds (e.g. on a hung
+# network mount) are reported as unreachable instead of missing
+DIR_CHECK_TIMEOUT = 5.0
+DIR_CHECK_WORKERS = 16
+
+# Output is written to stdout once this many characters are generated
+OUTPUT_BUFFER_SIZE = 64 * 1024
+
+# Directories read in bulk (e.g. from stdin) are normalized in chunks this size
+NORMALIZE_DIRS_CHUNK_SIZE = 1000
+READ_CHUNK_SIZE = 64 * 1024
+
+# Tags which slugify leaves unchanged (no leading, trailing or repeated dashes)
+NORMALIZED_TAG_PATTERN = re.compile(r"[a-zA-Z0-9]+(?:-[a-zA-Z0-9]+)*")
+NORMALIZE_TAG_CACHE_SIZE = 4096
+
+# Directories found by normalize_dir are trusted for this many seconds
+STAT_CACHE_TTL = 60.0
+
 DtagsCommandType = Callable[[Optional[List[str]]], None]
+StatCacheType = Dict[str, Tuple[str, float]]  # path -> resolved path, check time
 
 
 def fix_color_for_windows() -> None:  # pragma no cover
@@ -39,7 +75,38 @@ def dtags_command(func: DtagsCommandType) -> DtagsCommandType:
     return wrapped
 
 
-def get_argparser(prog: str, desc: str, usage: str) -> ArgumentParser:
+def get_version() -> str:
+    # Avoid pkg_resources here as it scans every installed distribution
+    try:
+        from dtags.version import version  # generated by setuptools_scm
+
+        return str(version)
+    except ImportError:  # pragma no cover
+        pass
+    try:
+        from importlib.metadata import version as get_distribution_version
+    except ImportError:  # pragma no cover
+        from pkg_resources import get_distribution
+
+        return str(get_distribution("dtags").version)
+    else:  # pragma no cover
+        return get_distribution_version("dtags")
+
+
+def get_argparser(prog: str, desc: str, usage: str) -> "ArgumentParser":
+    from argparse import SUPPRESS, Action, ArgumentParser, RawDescriptionHelpFormatter
+
+    class VersionAction(Action):
+        """Show the version, which is looked up only when requested."""
+
+        def __init__(self, option_strings: List[str], **kwargs: Any) -> None:
+            kwargs.update(dest=SUPPRESS, default=SUPPRESS, nargs=0)
+            super().__init__(option_strings, **kwargs)
+
+        def __call__(self, parser: ArgumentParser, *_: Any) -> None:
+            print(get_version())
+            parser.exit()
+
     parser = ArgumentParser(
         prog=prog,
         description=desc,
@@ -49,8 +116,7 @@ def get_argparser(prog: str, desc: str, usage: str) -> ArgumentParser:
     parser.add_argument(
         "-v",
         "--version",
-        action="version",
-        version=get_distribution("dtags").version,
+        action=VersionAction,
         help="show version",
     )
     return parser
@@ -73,13 +139,40 @@ def get_mingw_path(value: str) -> Optional[Path]:  # pragma no cover
 def prompt_user() -> bool:  # pragma no cover
     while True:
         print("\nApply changes? [y/n] ", end="")
-        try:
-            return strtobool(input().lower())
-        except ValueError:
+        answer = input().lower()
+        if answer in YES_ANSWERS:
+            return True
+        elif answer in NO_ANSWERS:
+            return False
+        else:
             print('Please respond with "y" or "n"')
 
 
-def reverse_map(config: Dict[Path, Set[str]]) -> Dict[str, Set[Path]]:
+def write_output(chunks: Iterable[str]) -> None:
+    """Write chunks of text to stdout in batches as they are generated.
+
+    Writing once per batch keeps the number of flushes down when stdout is a
+    terminal (line buffered), without holding the whole output in memory.
+    """
+    write = sys.stdout.write
+    batch: List[str] = []
+    size = 0
+    try:
+        for chunk in chunks:
+            batch.append(chunk)
+            size += len(chunk)
+            if size >= OUTPUT_BUFFER_SIZE:
+                write("".join(batch))
+                batch.clear()
+                size = 0
+        write("".join(batch))
+        sys.stdout.flush()
+    except BrokenPipeError:  # pragma no cover
+        # The reader exited early (e.g. head), so discard the rest quietly
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
+def reverse_map(config: Mapping[Path, Set[str]]) -> Dict[str, Set[Path]]:
     result: Dict[str, Set[Path]] = {}
 
     for dirpath, tags in config.items():
@@ -92,18 +185,257 @@ def reverse_map(config: Dict[Path, Set[str]]) -> Dict[str, Set[Path]]:
     return result
 
 
-def normalize_dir(value: str) -> Optional[Path]:
+def normalize_dir(value: str, cache: Optional[StatCacheType] = None) -> Optional[Path]:
     path = Path(value).expanduser()
-    return path.resolve() if path.is_dir() else get_mingw_path(value)
+    if cache is None:
+        return path.resolve() if path.is_dir() else get_mingw_path(value)
+
+    # Only existing directories are cached, so that new ones are found at once
+    key = os.path.abspath(path)
+    now = time()
+    if key in cache and 0 <= now - cache[key][1] < STAT_CACHE_TTL:
+        return Path(cache[key][0])
+
+    dirpath = path.resolve() if path.is_dir() else get_mingw_path(value)
+    if dirpath is None:
+        cache.pop(key, None)
+    else:
+        cache[key] = (dirpath.as_posix(), now)
+    return dirpath
+
+
+def normalize_dirs(
+    values: Optional[List[str]], cache: Optional[StatCacheType] = None
+) -> Set[Path]:
+    if not values:
+        return set()
+    return set(d for d in (normalize_dir(v, cache) for v in values) if d)
+
+
+def normalize_dirs_parallel(
+    values: Iterable[str],
+    workers: int = DIR_CHECK_WORKERS,
+) -> Set[Path]:
+    """Normalize many directory paths (e.g. read from stdin) in parallel.
+
+    Each parent directory is resolved only once, so a directory which is not a
+    symlink costs a single lstat. Chunks of paths are normalized in threads to
+    overlap the filesystem latency (e.g. on network mounts).
+    """
+    import stat
+    from concurrent.futures import ThreadPoolExecutor
+
+    parents: Dict[str, str] = {}
+
+    def normalize(value: str) -> Optional[Path]:
+        path = os.path.expanduser(value)
+        if is_windows or ".." in path.split(os.sep):
+            return normalize_dir(value)
+        path = os.path.abspath(path)
+        try:
+            if not stat.S_ISDIR(os.lstat(path).st_mode):
+                return normalize_dir(value)  # symlinks are resolved as usual
+        except OSError:
+            return normalize_dir(value)
+
+        parent, name = os.path.split(path)
+        if parent not in parents:
+            parents[parent] = os.path.realpath(parent)
+        return Path(parents[parent], name)
+
+    def normalize_chunk(chunk: List[str]) -> List[Optional[Path]]:
+        return [normalize(value) for value in chunk]
+
+    unique_values = list(dict.fromkeys(values))
+    chunks = [
+        unique_values[i : i + NORMALIZE_DIRS_CHUNK_SIZE]
+        for i in range(0, len(unique_values), NORMALIZE_DIRS_CHUNK_SIZE)
+    ]
+    if workers > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(min(workers, len(chunks))) as executor:
+            results = list(executor.map(normalize_chunk, chunks))
+    else:
+        results = [normalize_chunk(chunk) for chunk in chunks]
+    return set(d for result in results for d in result if d)
+
 
+def read_values(stream: IO[str], null: bool = False) -> Iterator[str]:
+    """Yield the non-empty newline or NUL-delimited values read from a stream."""
+    separator = "\0" if null else "\n"
+    remainder = ""
+    for chunk in iter(lambda: stream.read(READ_CHUNK_SIZE), ""):
+        *values, remainder = (remainder + chunk).split(separator)
+        yield from filter(None, values)
+    if remainder:
+        yield remainder
 
-def normalize_dirs(values: Optional[List[str]]) -> Set[Path]:
-    return set() if not values else set(d for d in map(normalize_dir, values) if d)
+
+def is_dir(dirpath: Path, cache: Optional[StatCacheType] = None) -> bool:
+    """Check if the tagged (i.e. already resolved) directory exists."""
+    if cache is None:
+        return dirpath.is_dir()
+
+    key = dirpath.as_posix()
+    if key in cache and 0 <= time() - cache[key][1] < STAT_CACHE_TTL:
+        return True
+
+    update_stat_cache(cache, {dirpath: dirpath.is_dir()})
+    return key in cache
+
+
+def update_stat_cache(
+    cache: StatCacheType, dir_status: Dict[Path, Optional[bool]]
+) -> None:
+    """Update the cache with the results of directory checks."""
+    now = time()
+    for dirpath, exists in dir_status.items():
+        key = dirpath.as_posix()
+        if exists:
+            cache[key] = (cache[key][0] if key in cache else key, now)
+        elif exists is False:
+            cache.pop(key, None)
 
 
 def normalize_tag(value: str) -> str:
+    # Most tags are already normalized and slugify would return them as is
+    if NORMALIZED_TAG_PATTERN.fullmatch(value):
+        return value
+    return slugify_tag(value)
+
+
+@lru_cache(maxsize=NORMALIZE_TAG_CACHE_SIZE)
+def slugify_tag(value: str) -> str:
+    from slugify import slugify
+
     return slugify(value, lowercase=False, regex_pattern=r"[^-a-zA-Z0-9]+")
 
 
 def normalize_tags(values: Optional[List[str]]) -> Set[str]:
     return set() if not values else set(t for t in map(normalize_tag, values) if t)
+
+
+def check_dirs(
+    dirpaths: Iterable[Path],
+    timeout: float = DIR_CHECK_TIMEOUT,
+    workers: int = DIR_CHECK_WORKERS,
+) -> Dict[Path, Optional[bool]]:
+    """Check in parallel whether directories exist.
+
+    Return a mapping of each path to True if it is a directory, False if it is
+    missing, or None if it is unreachable. A path is unreachable if its check
+    fails with an I/O error or takes longer than the timeout. Once a check
+    hangs, the remaining paths on its mount (or in its parent directory if the
+    mount table is not available) are treated as unreachable without checking.
+    Checks are run in daemon threads so that the ones stuck on a hung mount
+    never block exit.
+    """
+    import threading
+    from collections import deque
+    from time import monotonic
+
+    pending = deque(dict.fromkeys(dirpaths))
+    result: Dict[Path, Optional[bool]] = {}
+    started: Dict[int, Tuple[Path, float]] = {}  # thread ID -> path, start time
+    hung_keys: Set[str] = set()  # mount points or parents of hung checks
+    mount_points: List[str] = []
+    condition = threading.Condition()
+
+    def is_hung(dirpath: Path) -> bool:
+        return bool(hung_keys) and get_hang_key(dirpath, mount_points) in hung_keys
+
+    def check_dir(dirpath: Path) -> Optional[bool]:
+        try:
+            return dirpath.is_dir()
+        except OSError:
+            return None
+
+    def worker() -> None:
+        thread_id = threading.get_ident()
+        while True:
+            with condition:
+                while pending and is_hung(pending[0]):
+                    result.setdefault(pending.popleft(), None)
+                if not pending:
+                    condition.notify()
+                    return
+                dirpath = pending.popleft()
+                started[thread_id] = (dirpath, monotonic())
+
+            is_dir = check_dir(dirpath)
+
+            with condition:
+                del started[thread_id]
+                result.setdefault(dirpath, is_dir)
+                condition.notify()
+
+    def start_worker() -> None:
+        threading.Thread(target=worker, daemon=True).start()
+
+    total = len(pending)
+    max_threads = max(workers, 1) * 4
+    num_threads = min(max(workers, 1), total)
+    for _ in range(num_threads):
+        start_worker()
+
+    with condition:
+        while len(result) < total:
+            condition.wait(timeout / 2)
+
+            # Give up on checks which exceeded the timeout, along with the other
+            # paths on the same mount (or in the same parent directory), and
+            # replace the stuck threads so that the rest are still checked
+            now = monotonic()
+            for dirpath, start_time in list(started.values()):
+                if dirpath not in result and now - start_time > timeout:
+                    result[dirpath] = None
+                    if not hung_keys:
+                        mount_points.extend(get_mount_points())
+                    hung_keys.add(get_hang_key(dirpath, mount_points))
+                    if num_threads < max_threads:
+                        num_threads += 1
+                        start_worker()
+
+            stuck = sum(1 for path, _ in started.values() if path in result)
+            if pending and stuck >= num_threads:
+                while pending:
+                    result.setdefault(pending.popleft(), None)
+
+    return result
+
+
+def get_mount_points() -> List[str]:
+    """Return the mount points from /proc/self/mounts, longest first.
+
+    The mount table is read without touching the mounted file systems, so it
+    works even if some of them hang. An empty list is returned if it is not
+    available (e.g. on macOS and Windows).
+    """
+    try:
+        with open("/proc/self/mounts", "rb") as fp:
+            lines = fp.read().splitlines()
+    except OSError:
+        return []
+
+    mount_points = set()
+    for line in lines:
+        fields = line.split()
+        if len(fields) > 1:
+            # Whitespace in mount points is escaped in octal (e.g. \040)
+            mount_point = fields[1].decode(errors="replace")
+            mount_points.add(re.sub(r"\\([0-7]{3})", unescape_octal, mount_point))
+    return sorted(mount_points, key=len, reverse=True)
+
+
+def unescape_octal(match: "re.Match[str]") -> str:
+    return chr(int(match.group(1), 8))
+
+
+def get_hang_key(dirpath: Path, mount_points: List[str]) -> str:
+    """Return the mount point of the path, or its parent if it is on "/"."""
+    path = dirpath.as_posix()
+    for mount_point in mount_points:
+        if mount_point != "/" and (
+            path == mount_point or path.startswith(mount_point + "/")
+        ):
+            return mount_point
+    return dirpath.parent.as_posix()
@@ -1,16 +1,135 @@
-import json
+import os
+import re
+from contextlib import closing, contextmanager
 from pathlib import Path
-from typing import Dict, Set
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    cast,
+)
 
-from dtags.commons import normalize_tags
+from dtags.commons import (
+    STAT_CACHE_TTL,
+    StatCacheType,
+    is_windows,
+    normalize_tags,
+    reverse_map,
+)
 from dtags.exceptions import DtagsError
+from dtags.model import TagConfigType, TagMap, TagTable, to_tag_map
+
+if TYPE_CHECKING:  # pragma no cover
+    import mmap
+    import sqlite3
+
+    from dtags.query import QueryType
+
+try:
+    import fcntl
+except ImportError:  # pragma no cover
+    fcntl = None  # type: ignore
 
 CONFIG_ROOT = ".dtags"
 CONFIG_FILE = "config.json"
 COMP_FILE = "completion"  # used for tag name completion
+COMP_LOG_FILE = "completion.log"  # tag names added and removed since the above
 DEST_FILE = "destination"  # used for d command
+INDEX_FILE = "index.db"  # used for lazy tag lookups
+JOURNAL_FILE = "journal"  # used for incremental config updates
+LOCK_FILE = "lock"  # used to serialize config updates
+STAT_CACHE_FILE = "statcache"  # used to skip redundant directory checks
+FRECENCY_FILE = "frecency"  # used to pick destinations for ambiguous tags
+FRECENCY_LOCK_FILE = "frecency.lock"  # used to serialize frecency updates
+VISIT_LOG_FILE = "visits"  # appended to by d command fast paths in the shell
+OLD_VISIT_LOG_FILE = "visits.1"  # the above, once the shell finds it too large
+SH_LOOKUP_FILE = "lookup.sh"  # used for d command fast path in bash and zsh
+FISH_LOOKUP_FILE = "lookup.fish"  # used for d command fast path in fish
+SH_OVERLAY_FILE = "lookup-overlay.sh"  # tags changed since lookup.sh was saved
+FISH_OVERLAY_FILE = "lookup-overlay.fish"  # tags changed since lookup.fish was saved
+
+# Tags outside this pattern (e.g. unrepaired manual edits) are left to dtags-d
+LOOKUP_TAG_PATTERN = re.compile(r"[-a-zA-Z0-9]+")
+
+# The lookup scripts fill a table of each tag's directory between these: an
+# associative array in bash and zsh, and a variable per tag in fish (with "-"
+# in tags replaced by "_", which LOOKUP_TAG_PATTERN does not allow). Shells
+# without associative arrays (e.g. bash 3) stop at the header and use dtags-d.
+SH_LOOKUP_HEADER = (
+    "typeset -gA _DTAGS_LOOKUP 2> /dev/null || return 1\n_DTAGS_LOOKUP=(\n"
+)
+SH_LOOKUP_FOOTER = ")\n"
+FISH_LOOKUP_HEADER = (
+    "set -l names (set -n | string match -- '__dtags_lookup__*')\n"
+    "set -q names[1]; and set -e $names\n"
+)
+FISH_LOOKUP_FOOTER = ""
+
+# The overlays of the lookup scripts take precedence over them. They hold all
+# tags changed since the scripts were saved, with no directory if a tag is no
+# longer unambiguous.
+SH_OVERLAY_HEADER = (
+    "typeset -gA _DTAGS_OVERLAY 2> /dev/null || return 1\n_DTAGS_OVERLAY=(\n"
+)
+SH_OVERLAY_FOOTER = ")\n"
+FISH_OVERLAY_HEADER = (
+    "set -l names (set -n | string match -- '__dtags_overlay__*')\n"
+    "set -q names[1]; and set -e $names\n"
+)
+FISH_OVERLAY_FOOTER = ""
+
+SH_LOOKUP_ENTRY = "    [{tag}]={dest}\n"
+FISH_LOOKUP_ENTRY = "set -g __dtags_lookup__{name} {dest}\n"
+SH_OVERLAY_ENTRY = "    [{tag}]={dest}\n"
+FISH_OVERLAY_ENTRY = "set -g __dtags_overlay__{name} {dest}\n"
 
-ConfigType = Dict[str, Dict[Path, Set[str]]]
+SH_LOOKUP_SCRIPT = (SH_LOOKUP_FILE, SH_LOOKUP_HEADER, SH_LOOKUP_ENTRY, SH_LOOKUP_FOOTER)
+FISH_LOOKUP_SCRIPT = (
+    FISH_LOOKUP_FILE,
+    FISH_LOOKUP_HEADER,
+    FISH_LOOKUP_ENTRY,
+    FISH_LOOKUP_FOOTER,
+)
+SH_OVERLAY_SCRIPT = (
+    SH_OVERLAY_FILE,
+    SH_OVERLAY_HEADER,
+    SH_OVERLAY_ENTRY,
+    SH_OVERLAY_FOOTER,
+)
+FISH_OVERLAY_SCRIPT = (
+    FISH_OVERLAY_FILE,
+    FISH_OVERLAY_HEADER,
+    FISH_OVERLAY_ENTRY,
+    FISH_OVERLAY_FOOTER,
+)
+
+# The journal is compacted into the config file once it grows past this size
+JOURNAL_MAX_SIZE = 256 * 1024
+
+# The completion and lookup files are saved afresh, instead of being updated
+# incrementally, once their overlays grow past these sizes
+COMP_LOG_MAX_SIZE = 64 * 1024
+LOOKUP_OVERLAY_MAX_TAGS = 256
+
+# Parts of newline-delimited paths which Path(...).as_posix() would change
+# (e.g. "/x/", "/x//y", "/x/./y" and "./x")
+UNCLEAN_PATH_PARTS = ("//", "/./", "/.\n", "/\n", "\n./")
+
+# Bump this whenever tag normalization rules change, so that configs written
+# with older rules are re-normalized on the next load.
+CONFIG_VERSION = 1
+
+ConfigType = Dict[str, TagConfigType]
+FrecencyType = Dict[Path, Tuple[int, float]]  # dirpath -> visits, last visit
+ConfigDiffType = List[Tuple[Path, Set[str], Set[str]]]  # dirpath, added, deleted
 
 
 def get_file_path(filename: str) -> Path:
@@ -18,59 +137,926 @@ def get_file_path(filename: str) -> Path:
 
 
 def get_new_config() -> ConfigType:
-    return {"tags": {}}
+    return {"tags": TagMap()}
+
+
+# Number of nested lock_config_file calls holding the lock in this process
+lock_depth = 0
+
+
+@contextmanager
+def lock_config_file() -> Iterator[None]:
+    """Hold an exclusive lock on the config while it is saved.
+
+    The lock is advisory and only taken by dtags commands which update the
+    config. It can be nested, and it is not available on Windows.
+    """
+    global lock_depth
+
+    if lock_depth > 0:
+        lock_depth += 1
+        try:
+            yield
+        finally:
+            lock_depth -= 1
+        return
+
+    with lock_file(LOCK_FILE):
+        lock_depth = 1
+        try:
+            yield
+        finally:
+            lock_depth = 0
+
+
+@contextmanager
+def lock_frecency_file() -> Iterator[None]:
+    """Hold an exclusive lock on the frecency file while it is updated."""
+    with lock_file(FRECENCY_LOCK_FILE):
+        yield
+
+
+@contextmanager
+def lock_file(filename: str) -> Iterator[None]:
+    lock_file_path = get_file_path(filename)
+    lock_file_path.parent.mkdir(mode=0o755, exist_ok=True)
+
+    with open(lock_file_path, "a") as fp:
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        yield  # the lock is released when the file is closed
+
+
+@contextmanager
+def open_atomic(
+    file_path: Path, sync: bool = True, errors: Optional[str] = None
+) -> Iterator[IO[str]]:
+    """Open a temporary file for writing which replaces the file when closed.
+
+    Readers never see a partially written file. If sync is set, the data is
+    flushed to disk before the file is replaced.
+    """
+    temp_file_path = file_path.with_name(f".{file_path.name}.{os.getpid()}.tmp")
+    try:
+        with open(temp_file_path, "w", errors=errors) as fp:
+            yield fp
+            if sync:
+                fp.flush()
+                os.fsync(fp.fileno())
+        os.replace(temp_file_path, file_path)
+    except BaseException:
+        try:
+            temp_file_path.unlink()
+        except FileNotFoundError:  # pragma no cover
+            pass
+        raise
 
 
 def load_config_file() -> ConfigType:
+    """Load the config, creating or upgrading the config file if necessary."""
+    config, is_current = read_config_file()
+    if not is_current:
+        # Another process may have saved the config since it was read
+        with lock_config_file():
+            config, is_current = read_config_file()
+            if not is_current:
+                save_config_file(config)
+    return config
+
+
+def read_config_file() -> Tuple[ConfigType, bool]:
+    """Return the config and whether the config file is in the current format."""
+    import json
+
     config_file_path = get_file_path(CONFIG_FILE)
     try:
         with open(config_file_path, "r") as fp:
             config_data = json.load(fp)
 
     except FileNotFoundError:
-        new_data = get_new_config()
-        save_config_file(new_data)
-        return new_data
+        return get_new_config(), False
 
     except ValueError as err:  # pragma no cover
         raise DtagsError(f"Bad data in {config_file_path.as_posix()}: {err}")
     else:
-        tag_config = config_data["tags"]
-        return {
-            "tags": {
-                Path(dirpath): normalize_tags(tags)
-                for dirpath, tags in tag_config.items()
-            }
-        }
+        try:
+            tag_data = get_config_tag_data(config_data)
+            tag_items = normalize_config_items(tag_data)
+            config: ConfigType = {"tags": TagMap(TagTable(tag_items))}
+        except (AttributeError, TypeError, ValueError):
+            raise DtagsError(f"Bad data in {config_file_path.as_posix()}")
+        load_journal_file(config)
+
+        if config_data.get("version") == CONFIG_VERSION:
+            return config, True
+
+        table = to_tag_map(config["tags"]).table
+        config["tags"] = TagMap(
+            TagTable(
+                (dirpath, normalize_tags(tags)) for dirpath, tags in table.iter_items()
+            )
+        )
+        return config, False
+
+
+def load_config_snapshot() -> Tuple[ConfigType, str]:
+    """Return the config with its signature, to save changes with save_config_diffs.
+
+    The config is not locked, so that commands can prompt the user without
+    blocking others (e.g. scripts running tag -y).
+    """
+    while True:
+        try:
+            signature = get_config_signature()
+        except FileNotFoundError:
+            signature = ""  # the config file is created on load
+        config = load_config_file()
+        if get_config_signature() == signature:
+            return config, signature
+
+
+def save_config_diffs(
+    config: ConfigType, diffs: ConfigDiffType, signature: str
+) -> None:
+    """Save the config changed by the diffs since load_config_snapshot.
+
+    If another process saved the config in the meantime, the diffs are applied
+    to the latest config instead.
+    """
+    with lock_config_file():
+        if get_config_signature() != signature:
+            config = load_config_file()
+            diffs = apply_config_diffs(config, diffs)
+        if diffs:
+            save_config_file(config, diffs)
+
 
+def apply_config_diffs(config: ConfigType, diffs: ConfigDiffType) -> ConfigDiffType:
+    """Apply the diffs to the config and return those which changed anything."""
+    tag_config = config["tags"]
+    new_diffs: ConfigDiffType = []
+
+    for dirpath, add_tags, del_tags in diffs:
+        cur_tags = tag_config.get(dirpath, set())
+        add_tags = add_tags - cur_tags
+        del_tags = del_tags & cur_tags
+        if add_tags or del_tags:
+            new_diffs.append((dirpath, add_tags, del_tags))
+            tag_config[dirpath] = cur_tags.union(add_tags) - del_tags
+
+    return new_diffs
+
+
+def get_config_tag_data(config_data: Any) -> Dict[str, List[str]]:
+    """Return the tags of a config, or of a config exported with tags --json.
+
+    Exported configs ({dirpath: [tag, ...]}) have no version, so their tags
+    are normalized like those of old configs.
+    """
+    if not isinstance(config_data, dict):
+        raise ValueError(config_data)
+    if isinstance(config_data.get("tags"), dict):
+        tag_data = config_data["tags"]
+    elif "version" not in config_data:
+        tag_data = config_data
+    else:
+        raise ValueError(config_data)
+
+    if not all(type(tags) is list for tags in tag_data.values()):
+        raise ValueError(tag_data)
+    return cast(Dict[str, List[str]], tag_data)
+
+
+def normalize_config_items(
+    tag_data: Dict[str, List[str]],
+) -> Iterable[Tuple[str, Iterable[str]]]:
+    """Return the config items with keys normalized like Path objects.
+
+    Keys written by dtags are normalized already, so they are only checked
+    for unclean parts, and keys of the same directory (e.g. "/x" and "/x/") are
+    merged only if there are any unclean ones.
+    """
+    # The keys are joined to check them all with a few substring searches
+    if not is_windows:
+        keys = "\n" + "\n".join(tag_data) + "\n"
+        if not any(part in keys for part in UNCLEAN_PATH_PARTS):
+            return tag_data.items()
+
+    result: Dict[str, Set[str]] = {}
+    for dirpath, tags in tag_data.items():
+        result.setdefault(Path(dirpath).as_posix(), set()).update(tags)
+    return result.items()
+
+
+def load_journal_file(config: ConfigType) -> None:
+    """Apply the diffs recorded in the journal file to the config."""
+    import json
+
+    try:
+        with open(get_file_path(JOURNAL_FILE), "r") as fp:
+            signature = fp.readline().strip()
+            lines = fp.readlines()
+    except FileNotFoundError:
+        return
+
+    # The journal belongs to another config file (e.g. one replaced by hand)
+    if signature != get_file_signature(CONFIG_FILE) or not lines:
+        return
+
+    table = to_tag_map(config["tags"]).table
+    for line in lines:
+        try:
+            dirpath, add_tags, del_tags = json.loads(line)
+        except ValueError:  # pragma no cover
+            continue  # skip entries cut short by an interrupted write
+
+        tags = (table.get_tags(dirpath) or set()).union(add_tags).difference(del_tags)
+        if tags:
+            table.set_tags(dirpath, tags)
+        else:
+            table.remove(dirpath)
+
+    # New directories are appended to the table in journal order, which is
+    # fine since the config file is sorted again when the journal is compacted
+    config["tags"] = TagMap(table)
+
+
+def save_config_file(
+    config: ConfigType, diffs: Optional[ConfigDiffType] = None
+) -> None:
+    """Save the config file along with the completion, index and lookup files.
+
+    If the diffs that produced the config are given, they are appended to the
+    journal file instead and the other files are updated incrementally. The
+    journal is compacted into the config file once it outgrows JOURNAL_MAX_SIZE.
+    """
+    import json
 
-def save_config_file(config: ConfigType) -> None:
     config_file_path = get_file_path(CONFIG_FILE)
     config_file_path.parent.mkdir(mode=0o755, exist_ok=True)
+    prev_signature = get_config_signature() if config_file_path.exists() else None
+
+    if diffs is not None and prev_signature is not None and save_journal_file(diffs):
+        # The other files are updated from the index, so that saving a few
+        # diffs does not go through the whole config
+        save_index_file(config, diffs, prev_signature)
+        signature = get_config_signature()
+        update_completion_file(config, signature, diffs, prev_signature)
+        update_lookup_files(config, signature, diffs, prev_signature)
+        return
 
     config_data = {
+        "version": CONFIG_VERSION,
         "tags": {
-            dirpath.as_posix(): sorted(tags)
-            for dirpath, tags in config["tags"].items()
+            dirpath: sorted(tags)
+            for dirpath, tags in to_tag_map(config["tags"]).table.iter_items()
             if len(tags) > 0
-        }
+        },
     }
-    with open(config_file_path, "w") as fp:
+    with open_atomic(config_file_path) as fp:
         json.dump(config_data, fp, sort_keys=True, indent=2)
 
-    save_completion_file(config)
+    # The config file now includes all the diffs in the journal
+    remove_file(JOURNAL_FILE)
+
+    signature = get_config_signature()
+    save_completion_file(config, signature)
+    save_index_file(config, diffs, prev_signature)
+    save_lookup_files(config, signature)
+
+
+def save_journal_file(diffs: ConfigDiffType) -> bool:
+    """Append the diffs to the journal file, or return False if it is full."""
+    import json
 
+    journal_file_path = get_file_path(JOURNAL_FILE)
+    config_signature = get_file_signature(CONFIG_FILE)
+    try:
+        with open(journal_file_path, "r") as fp:
+            is_current = fp.readline().strip() == config_signature
+        journal_size = journal_file_path.stat().st_size
+    except FileNotFoundError:
+        is_current = False
+        journal_size = 0
+
+    if is_current and journal_size > JOURNAL_MAX_SIZE:
+        return False
+
+    lines = [
+        json.dumps([dirpath.as_posix(), sorted(add_tags), sorted(del_tags)]) + "\n"
+        for dirpath, add_tags, del_tags in diffs
+    ]
+    if is_current:
+        with open(journal_file_path, "a") as fp:
+            fp.writelines(lines)
+            fp.flush()
+            os.fsync(fp.fileno())
+    else:
+        with open_atomic(journal_file_path) as fp:
+            fp.write(config_signature + "\n")
+            fp.writelines(lines)
+
+    return True
+
+
+def remove_file(filename: str) -> None:
+    try:
+        get_file_path(filename).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def read_first_line(filename: str) -> Optional[str]:
+    try:
+        with open(get_file_path(filename), "r", errors="surrogateescape") as fp:
+            return fp.readline().rstrip("\n")
+    except FileNotFoundError:
+        return None
 
-def save_completion_file(config: ConfigType) -> None:
-    all_tags: Set[str] = set()
 
-    for tags in config["tags"].values():
-        all_tags.update(tags)
+def get_file_signature(filename: str) -> str:
+    stat = get_file_path(filename).stat()
+    return f"{stat.st_ino}:{stat.st_mtime_ns}:{stat.st_size}"
 
-    with open(get_file_path(COMP_FILE), "w") as fp:
-        fp.write(" ".join(all_tags))
+
+def get_config_signature() -> str:
+    """Return a value which changes whenever the config or the journal changes."""
+    signature = get_file_signature(CONFIG_FILE)
+    try:
+        return f"{signature}+{get_file_signature(JOURNAL_FILE)}"
+    except FileNotFoundError:
+        return signature
+
+
+def save_index_file(
+    config: ConfigType,
+    diffs: Optional[ConfigDiffType] = None,
+    prev_signature: Optional[str] = None,
+) -> None:
+    # SQLite is imported only by the commands which use the index, and may be
+    # missing altogether from some Python builds
+    try:
+        import sqlite3
+
+        from dtags import index
+    except ImportError:  # pragma no cover
+        return
+
+    try:
+        with closing(index.connect(get_file_path(INDEX_FILE))) as conn:
+            signature = get_config_signature()
+            if (
+                diffs is None
+                or prev_signature is None
+                or not index.apply_diffs(conn, diffs, signature, prev_signature)
+            ):
+                index.rebuild(conn, config["tags"], signature)
+    except sqlite3.Error:  # pragma no cover
+        pass  # The index is rebuilt on the next lookup
+
+
+def load_unique_dirpaths(tags: Iterable[str]) -> Optional[Dict[str, Optional[str]]]:
+    """Return the directory path of each tag in use from an up-to-date index.
+
+    Tags with several directories are mapped to None. None is returned if the
+    index is not in sync with the config file.
+    """
+    try:
+        import sqlite3
+
+        from dtags import index
+    except ImportError:  # pragma no cover
+        return None
+
+    try:
+        with closing(index.connect(get_file_path(INDEX_FILE))) as conn:
+            if index.get_signature(conn) != get_config_signature():
+                return None  # pragma no cover
+            return index.select_unique_dirpaths(conn, tags)
+    except sqlite3.Error:  # pragma no cover
+        return None
+
+
+def open_index_file() -> Optional["sqlite3.Connection"]:
+    """Return a connection to the index if it is in sync with the config file.
+
+    A stale index (e.g. after config.json was replaced by hand) is rebuilt
+    from the config file, along with the lookup scripts, while the config is
+    locked. None is returned if SQLite is not available.
+    """
+    try:
+        import sqlite3
+
+        from dtags import index
+    except ImportError:  # pragma no cover
+        return None
+
+    try:
+        signature = get_config_signature()
+    except FileNotFoundError:
+        return None
+    try:
+        conn = index.connect(get_file_path(INDEX_FILE))
+    except sqlite3.Error:  # pragma no cover
+        return None
+    try:
+        if index.get_signature(conn) != signature:
+            # The lock keeps other commands from saving the config between
+            # loading it and stamping the files built from it with its signature
+            with lock_config_file():
+                config = load_config_file()
+                signature = get_config_signature()
+                if index.get_signature(conn) != signature:
+                    index.rebuild(conn, config["tags"], signature)
+                    save_lookup_files(config, signature)
+    except sqlite3.Error:  # pragma no cover
+        conn.close()
+        return None
+    else:
+        return conn
+
+
+def load_dirpaths(tags: Optional[Iterable[str]] = None) -> Dict[str, Set[Path]]:
+    """Return the tag to directories mapping, optionally limited to given tags."""
+    conn = open_index_file()
+    if conn is None:
+        tag_to_dirpaths = reverse_map(load_config_file()["tags"])
+        if tags is None:
+            return tag_to_dirpaths
+        return {tag: tag_to_dirpaths[tag] for tag in tags if tag in tag_to_dirpaths}
+
+    from dtags import index
+
+    with closing(conn):
+        if tags is None:
+            return index.select_all_dirpaths(conn)
+        return index.select_dirpaths(conn, tags)
+
+
+def iter_config_tags() -> Iterator[Tuple[str, List[str]]]:
+    """Yield each directory path with its tag names, both in sorted order."""
+    table = to_tag_map(load_config_file()["tags"]).table
+    paths = table.paths
+
+    # Loaded configs are sorted already, so skip copying them to sort
+    if all(paths[num] < paths[num + 1] for num in range(len(paths) - 1)):
+        items = table.iter_items()
+    else:
+        items = iter(sorted(table.iter_items()))
+    for dirpath, tags in items:
+        yield dirpath, sorted(tags)
+
+
+def iter_tag_dirpaths(
+    tags: Optional[Iterable[str]] = None,
+) -> Iterator[Tuple[str, List[str]]]:
+    """Yield each tag with its directory paths, both in sorted order."""
+    conn = open_index_file()
+    if conn is None:
+        tag_to_dirpaths = load_dirpaths(tags)
+        for tag in sorted(tag_to_dirpaths):
+            yield tag, sorted(dirpath.as_posix() for dirpath in tag_to_dirpaths[tag])
+        return
+
+    from dtags import index
+
+    with closing(conn):
+        yield from index.iter_tag_dirpaths(conn, tags)
+
+
+def load_query_dirpaths(query: "QueryType") -> Set[Path]:
+    """Return the directories matching a parsed tag query.
+
+    The query is evaluated on the bitsets of directory IDs of its tags, kept in
+    the index (or built from the config if the index is not available). Path
+    objects are only created for the directories matched.
+    """
+    from dtags.query import evaluate_query, from_bitset, get_query_tags
+
+    tags = get_query_tags(query)
+    conn = open_index_file()
+    if conn is None:
+        table = to_tag_map(load_config_file()["tags"]).table
+        bits = evaluate_query(query, table.get_bitsets(tags), table.get_all_bits)
+        return {Path(table.paths[path_id]) for path_id in from_bitset(bits)}
+
+    from dtags import index
+
+    with closing(conn):
+        bits = evaluate_query(
+            query,
+            index.select_bitsets(conn, tags),
+            lambda: index.select_all_bits(conn),
+        )
+        return index.select_bitset_dirpaths(conn, bits)
+
+
+def find_similar_tags(
+    value: str, limit: int = 3, min_score: float = 0.2
+) -> List[Tuple[float, str]]:
+    """Return the tags most similar to the value from the trigram index.
+
+    Nothing is returned if the index is not available.
+    """
+    conn = open_index_file() if value else None
+    if conn is None:
+        return []
+
+    from dtags import index
+
+    with closing(conn):
+        return index.select_similar_tags(conn, value, limit, min_score)
+
+
+def load_tags(dirpaths: Iterable[Path]) -> Dict[Path, Set[str]]:
+    conn = open_index_file()
+    if conn is None:
+        tag_config = load_config_file()["tags"]
+        return {
+            dirpath: tag_config[dirpath]
+            for dirpath in dirpaths
+            if tag_config.get(dirpath)
+        }
+
+    from dtags import index
+
+    with closing(conn):
+        return index.select_tags(conn, dirpaths)
+
+
+def save_completion_file(config: ConfigType, signature: str) -> None:
+    """Save the tag names for shell completion, sorted and one per line.
+
+    The first line holds the signature of the config. Changes saved later are
+    appended to the completion log by update_completion_file.
+    """
+    table = to_tag_map(config["tags"]).table
+    all_tags = sorted({tag for _, tags in table.iter_items() for tag in tags})
+
+    with open_atomic(get_file_path(COMP_FILE), sync=False) as fp:
+        fp.write(f"# {signature}\n")
+        fp.write("\n".join(all_tags))
+    remove_file(COMP_LOG_FILE)
+
+
+def update_completion_file(
+    config: ConfigType,
+    signature: str,
+    diffs: ConfigDiffType,
+    prev_signature: str,
+) -> None:
+    """Append the tag names added and removed by the diffs to the completion log.
+
+    The log starts with the first line of the completion file, and each batch
+    of changes ends with the signature of the config. The completion file is
+    saved afresh if the log is not in sync with the previous config, or once
+    the log outgrows COMP_LOG_MAX_SIZE.
+    """
+    add_tags: Set[str] = set()
+    del_tags: Set[str] = set()
+    for _, added, deleted in diffs:
+        add_tags.update(added)
+        del_tags.update(deleted)
+
+    # Deleted tags may still be used by other directories
+    tag_to_dirpath = load_unique_dirpaths(del_tags) if del_tags else {}
+    if tag_to_dirpath is None:  # pragma no cover
+        return save_completion_file(config, signature)
+    del_tags.difference_update(tag_to_dirpath)
+
+    try:
+        with open(get_file_path(COMP_FILE), "rb") as fp:
+            stamp = fp.readline()
+    except FileNotFoundError:
+        return save_completion_file(config, signature)
+
+    # The log is in sync if it ends with the signature of the previous config
+    comp_log_path = get_file_path(COMP_LOG_FILE)
+    prev_stamp = f"\n# {prev_signature}\n".encode()
+    try:
+        with open(comp_log_path, "rb") as fp:
+            is_current = fp.readline() == stamp
+            log_size = fp.seek(0, os.SEEK_END)
+            fp.seek(max(log_size - len(prev_stamp), 0))
+            is_current = is_current and fp.read() == prev_stamp
+        data = b""
+    except FileNotFoundError:
+        is_current = b"\n" + stamp == prev_stamp
+        log_size = 0
+        data = stamp
+
+    data += "".join(
+        [f"+{tag}\n" for tag in sorted(add_tags)]
+        + [f"-{tag}\n" for tag in sorted(del_tags)]
+        + [f"# {signature}\n"]
+    ).encode()
+    if not is_current or log_size + len(data) > COMP_LOG_MAX_SIZE:
+        return save_completion_file(config, signature)
+
+    with open(comp_log_path, "ab") as fp:
+        fp.write(data)
+
+
+def find_completion_tags(prefix: str) -> List[str]:
+    """Return the tag names starting with the prefix, in sorted order.
+
+    The completion file is memory-mapped and binary searched, so only the
+    lines around the matches are read. Changes in the completion log (which
+    is small) are then applied to the matches.
+    """
+    import mmap
+
+    try:
+        with open(get_file_path(COMP_FILE), "rb") as fp:
+            stamp = fp.readline()
+            if os.fstat(fp.fileno()).st_size <= len(stamp):
+                lines = []
+            else:
+                with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    lines = search_lines(buf, len(stamp), prefix.encode())
+    except FileNotFoundError:
+        return []
+
+    tags = [line.decode(errors="replace") for line in lines]
+    changes = load_completion_log(stamp)
+    if not changes:
+        return tags
+
+    result = {tag for tag in tags if changes.get(tag, True)}
+    result.update(
+        tag for tag, added in changes.items() if added and tag.startswith(prefix)
+    )
+    return sorted(result)
+
+
+def load_completion_log(stamp: bytes) -> Dict[str, bool]:
+    """Return the tag names added (True) or removed (False) since the stamp.
+
+    Changes after the last signature are skipped, as their write may have
+    been interrupted.
+    """
+    try:
+        with open(get_file_path(COMP_LOG_FILE), "rb") as fp:
+            if fp.readline() != stamp:
+                return {}  # the log of an older completion file
+            lines = fp.read().decode(errors="replace").split("\n")
+    except FileNotFoundError:
+        return {}
+
+    changes: Dict[str, bool] = {}
+    pending: Dict[str, bool] = {}
+    for line in lines:
+        if line.startswith("#"):
+            changes.update(pending)
+            pending.clear()
+        elif line:
+            pending[line[1:]] = line[0] == "+"
+    return changes
+
+
+def search_lines(buf: "mmap.mmap", start: int, prefix: bytes) -> List[bytes]:
+    """Return the lines starting with the prefix from sorted lines in the buffer."""
+    # Find the first line which is not less than the prefix. Both lo and hi
+    # are always at the start of a line (or the end of the buffer).
+    lo, hi = start, len(buf)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        line_start = buf.rfind(b"\n", lo, mid) + 1 or lo
+        line_end = buf.find(b"\n", mid)
+        if line_end < 0:
+            line_end = len(buf)
+        if buf[line_start:line_end] < prefix:
+            lo = line_end + 1
+        else:
+            hi = line_start
+
+    result = []
+    while lo < len(buf):
+        line_end = buf.find(b"\n", lo)
+        if line_end < 0:
+            line_end = len(buf)
+        line = buf[lo:line_end]
+        if not line.startswith(prefix):
+            break
+        result.append(line)
+        lo = line_end + 1
+    return result
+
+
+def load_stat_cache() -> StatCacheType:
+    """Load the directories checked within STAT_CACHE_TTL seconds."""
+    from time import time
+
+    try:
+        with open(get_file_path(STAT_CACHE_FILE), "r", errors="surrogateescape") as fp:
+            fields = fp.read().split("\0")
+    except FileNotFoundError:
+        return {}
+
+    now = time()
+    cache: StatCacheType = {}
+    try:
+        for num in range(0, len(fields) - 2, 3):
+            checked_at = float(fields[num + 2])
+            if 0 <= now - checked_at < STAT_CACHE_TTL:
+                cache[fields[num]] = (fields[num + 1], checked_at)
+    except ValueError:  # pragma no cover
+        return {}
+    return cache
+
+
+def save_stat_cache(cache: StatCacheType) -> None:
+    # Fields are separated by NUL, which cannot appear in paths
+    stat_cache_file_path = get_file_path(STAT_CACHE_FILE)
+    stat_cache_file_path.parent.mkdir(mode=0o755, exist_ok=True)
+
+    with open_atomic(stat_cache_file_path, sync=False, errors="surrogateescape") as fp:
+        for path, (resolved, checked_at) in cache.items():
+            fp.write(f"{path}\0{resolved}\0{checked_at!r}\0")
+
+
+def load_frecency_file() -> FrecencyType:
+    try:
+        with open(get_file_path(FRECENCY_FILE), "r", errors="surrogateescape") as fp:
+            fields = fp.read().split("\0")
+    except FileNotFoundError:
+        return {}
+
+    frecency: FrecencyType = {}
+    try:
+        for num in range(0, len(fields) - 2, 3):
+            visits, visited_at = int(fields[num + 1]), float(fields[num + 2])
+            frecency[Path(fields[num])] = (visits, visited_at)
+    except ValueError:  # pragma no cover
+        return {}
+    return frecency
+
+
+def save_frecency_file(frecency: FrecencyType) -> None:
+    # Fields are separated by NUL, which cannot appear in paths
+    frecency_file_path = get_file_path(FRECENCY_FILE)
+    frecency_file_path.parent.mkdir(mode=0o755, exist_ok=True)
+
+    with open_atomic(frecency_file_path, sync=False, errors="surrogateescape") as fp:
+        for dirpath, (visits, visited_at) in frecency.items():
+            fp.write(f"{dirpath.as_posix()}\0{visits}\0{visited_at!r}\0")
+
+
+def load_visit_log() -> List[Tuple[Path, float]]:
+    """Load and remove the directories visited by the shell d function.
+
+    The shell function appends the time and the working directory to the log
+    whenever it changes directory by tag without running dtags-d, and moves
+    the log aside once it grows too large. Visits logged by older versions
+    have no time, so they are assumed to have happened when the log was last
+    modified. The logs are renamed before they are read so that concurrent
+    appends go to a new log and are never lost.
+    """
+    visits: List[Tuple[str, float]] = []
+    for filename in (OLD_VISIT_LOG_FILE, VISIT_LOG_FILE):
+        visit_log_path = get_file_path(filename)
+        temp_path = visit_log_path.with_name(f".{filename}.{os.getpid()}.tmp")
+        try:
+            os.replace(visit_log_path, temp_path)
+        except FileNotFoundError:
+            continue
+
+        try:
+            with open(temp_path, "r", errors="surrogateescape") as fp:
+                modified_at = os.fstat(fp.fileno()).st_mtime
+                lines = fp.read().splitlines()
+        finally:
+            temp_path.unlink()
+
+        for line in lines:
+            if line.startswith("/"):
+                visits.append((line, modified_at))
+                continue
+            visited_at, _, dirpath = line.partition(" ")
+            if dirpath.startswith("/") and visited_at.isdigit():
+                visits.append((dirpath, float(visited_at)))
+
+    # The shell logs logical paths, while tagged directories are resolved
+    resolved: Dict[str, Path] = {}
+    for dirpath, _ in visits:
+        if dirpath not in resolved:
+            resolved[dirpath] = Path(os.path.realpath(dirpath))
+    return [(resolved[dirpath], visited_at) for dirpath, visited_at in visits]
 
 
 def save_destination_file(dirpath: Path) -> None:
     with open(get_file_path(DEST_FILE), "w") as fp:
         fp.write(dirpath.as_posix())
+
+
+def save_lookup_files(config: ConfigType, signature: str) -> None:
+    """Save shell scripts that map unambiguous tags to their directories.
+
+    The activate scripts source these to change directories by tag without
+    starting dtags-d. The first line holds a stamp used to detect changes,
+    which is the signature of the config the scripts are built from. Changes
+    saved later go to the overlays saved by update_lookup_files.
+    """
+    tag_to_dirpath: Dict[str, Optional[str]] = {}  # None if there are several
+    for dirpath, tags in to_tag_map(config["tags"]).table.iter_items():
+        for tag in tags:
+            tag_to_dirpath[tag] = None if tag in tag_to_dirpath else dirpath
+    destinations = sorted(
+        (tag, dirpath)
+        for tag, dirpath in tag_to_dirpath.items()
+        if dirpath is not None and LOOKUP_TAG_PATTERN.fullmatch(tag)
+    )
+    save_lookup_scripts(
+        SH_LOOKUP_SCRIPT, FISH_LOOKUP_SCRIPT, destinations, f"# {signature}\n"
+    )
+    remove_file(SH_OVERLAY_FILE)
+    remove_file(FISH_OVERLAY_FILE)
+
+
+def update_lookup_files(
+    config: ConfigType,
+    signature: str,
+    diffs: ConfigDiffType,
+    prev_signature: str,
+) -> None:
+    """Save the overlays of the lookup scripts with the tags in the diffs.
+
+    The overlays hold the cases of all tags changed since the scripts were
+    saved, looked up in the index. They start with the signatures of the
+    config of the scripts and of the current config, followed by their tags.
+    The scripts are saved afresh if they or their overlays are not in sync
+    with the previous config, or once the overlays outgrow
+    LOOKUP_OVERLAY_MAX_TAGS.
+    """
+    base_stamp = read_first_line(SH_LOOKUP_FILE)
+    if base_stamp is None or read_first_line(FISH_LOOKUP_FILE) != base_stamp:
+        return save_lookup_files(config, signature)
+
+    stamp = f"{base_stamp} {prev_signature}"
+    try:
+        with open(get_file_path(SH_OVERLAY_FILE), "r") as fp:
+            overlay_stamp, overlay_tags = fp.readline(), fp.readline()
+    except FileNotFoundError:
+        overlay_stamp, overlay_tags = "", ""
+
+    if overlay_stamp == f"{stamp}\n" and read_first_line(FISH_OVERLAY_FILE) == stamp:
+        tags = set(overlay_tags[1:].split())
+    elif base_stamp == f"# {prev_signature}":
+        tags = set()
+    else:
+        return save_lookup_files(config, signature)
+
+    for _, add_tags, del_tags in diffs:
+        tags.update(add_tags | del_tags)
+    tags = {tag for tag in tags if LOOKUP_TAG_PATTERN.fullmatch(tag)}
+    tag_to_dirpath = None
+    if len(tags) <= LOOKUP_OVERLAY_MAX_TAGS:
+        tag_to_dirpath = load_unique_dirpaths(tags)
+    if tag_to_dirpath is None:
+        return save_lookup_files(config, signature)
+
+    # Tags without a single directory are left to dtags-d
+    save_lookup_scripts(
+        SH_OVERLAY_SCRIPT,
+        FISH_OVERLAY_SCRIPT,
+        [(tag, tag_to_dirpath.get(tag)) for tag in sorted(tags)],
+        f"{base_stamp} {signature}\n# {' '.join(sorted(tags))}\n",
+    )
+
+
+def save_lookup_scripts(
+    sh_script: Tuple[str, str, str, str],
+    fish_script: Tuple[str, str, str, str],
+    destinations: Sequence[Tuple[str, Optional[str]]],
+    stamp: str,
+) -> None:
+    """Save the lookup scripts (or their overlays) with an entry for each tag.
+
+    Each script is given as its file name, header, entry format and footer.
+    """
+    for (file_name, header, entry, footer), format_lookup in (
+        (sh_script, format_sh_lookup),
+        (fish_script, format_fish_lookup),
+    ):
+        file_path = get_file_path(file_name)
+        with open_atomic(file_path, sync=False, errors="surrogateescape") as fp:
+            fp.write(stamp)
+            fp.write(header)
+            fp.writelines(format_lookup(entry, tag, dest) for tag, dest in destinations)
+            fp.write(footer)
+
+
+def format_sh_lookup(entry: str, tag: str, dest: Optional[str]) -> str:
+    """Return the entry of a tag in lookup.sh (dest is None if it is ambiguous)."""
+    import shlex
+
+    return entry.format(tag=tag, dest=shlex.quote(dest or ""))
+
+
+def format_fish_lookup(entry: str, tag: str, dest: Optional[str]) -> str:
+    """Return the entry of a tag in lookup.fish (dest is None if it is ambiguous)."""
+    return entry.format(name=tag.replace("-", "_"), dest=quote_fish(dest or ""))
+
+
+def quote_fish(value: str) -> str:
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
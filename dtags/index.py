@@ -0,0 +1,424 @@
+import math
+import sqlite3
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple
+
+from dtags.query import from_bitset, to_bitset
+
+# Bump this whenever the schema changes, so that old indexes are rebuilt
+SCHEMA_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tags (
+    dirpath TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (dirpath, tag)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tags_by_tag ON tags (tag, dirpath);
+CREATE TABLE IF NOT EXISTS dirs (
+    id INTEGER PRIMARY KEY,
+    dirpath TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS bitsets (
+    tag TEXT PRIMARY KEY,
+    start INTEGER NOT NULL,
+    bits BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS trigrams (
+    trigram TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (trigram, tag)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS trigram_counts (
+    trigram TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+# Upper bound for the strings starting with a given prefix
+MAX_CHAR = chr(0x10FFFF)
+
+
+def connect(db_path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path.as_posix())
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def get_signature(conn: sqlite3.Connection) -> Optional[str]:
+    meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+    if meta.get("schema") != str(SCHEMA_VERSION):
+        return None
+    return meta.get("signature")
+
+
+def get_trigrams(value: str) -> Set[str]:
+    padded = f"  {value.lower()} "
+    return {padded[num : num + 3] for num in range(len(padded) - 2)}
+
+
+def rebuild(
+    conn: sqlite3.Connection,
+    tag_config: Mapping[Path, Set[str]],
+    signature: str,
+) -> None:
+    dirpaths = sorted(dirpath.as_posix() for dirpath in tag_config)
+    tag_to_ids: Dict[str, List[int]] = {}
+    for dir_id, dirpath in enumerate(dirpaths, start=1):
+        for tag in tag_config[Path(dirpath)]:
+            tag_to_ids.setdefault(tag, []).append(dir_id)
+
+    with conn:
+        conn.execute("DELETE FROM tags")
+        conn.execute("DELETE FROM dirs")
+        conn.execute("DELETE FROM bitsets")
+        conn.execute("DELETE FROM trigrams")
+        conn.execute("DELETE FROM trigram_counts")
+        conn.executemany(
+            "INSERT INTO tags (dirpath, tag) VALUES (?, ?)",
+            (
+                (dirpath.as_posix(), tag)
+                for dirpath, tags in tag_config.items()
+                for tag in tags
+            ),
+        )
+        conn.executemany(
+            "INSERT INTO dirs (id, dirpath) VALUES (?, ?)",
+            enumerate(dirpaths, start=1),
+        )
+        conn.executemany(
+            "INSERT INTO bitsets (tag, start, bits) VALUES (?, ?, ?)",
+            ((tag, *to_bytes(to_bitset(ids))) for tag, ids in tag_to_ids.items()),
+        )
+        insert_trigrams(conn, set().union(*tag_config.values()))
+        set_signature(conn, signature)
+
+
+def apply_diffs(
+    conn: sqlite3.Connection,
+    diffs: List[Tuple[Path, Set[str], Set[str]]],
+    signature: str,
+    prev_signature: str,
+) -> bool:
+    """Apply the diffs if the index is in sync with the previous config.
+
+    The write lock is taken before anything is read, so that another process
+    (e.g. one rebuilding the index) cannot change the index in between. False
+    is returned, and nothing is changed, if the index is not in sync.
+    """
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if get_signature(conn) != prev_signature:
+            return False
+
+        add_tags = set().union(*(add_tags for _, add_tags, _ in diffs))
+        new_tags = {tag for tag in add_tags if not has_tag(conn, tag)}
+
+        conn.executemany(
+            "INSERT OR IGNORE INTO tags (dirpath, tag) VALUES (?, ?)",
+            (
+                (dirpath.as_posix(), tag)
+                for dirpath, add_tags, _ in diffs
+                for tag in add_tags
+            ),
+        )
+        conn.executemany(
+            "DELETE FROM tags WHERE dirpath = ? AND tag = ?",
+            (
+                (dirpath.as_posix(), tag)
+                for dirpath, _, del_tags in diffs
+                for tag in del_tags
+            ),
+        )
+        del_tags = set().union(*(del_tags for _, _, del_tags in diffs))
+        old_tags = {tag for tag in del_tags if not has_tag(conn, tag)}
+
+        update_bitsets(conn, diffs)
+        insert_trigrams(conn, new_tags)
+        delete_trigrams(conn, old_tags)
+        set_signature(conn, signature)
+    return True
+
+
+def update_bitsets(
+    conn: sqlite3.Connection,
+    diffs: List[Tuple[Path, Set[str], Set[str]]],
+) -> None:
+    """Update the directory IDs and the tag bitsets for the diffs.
+
+    New directories get the next free ID, and directories left without tags
+    are dropped. IDs are not renumbered until the index is rebuilt, so the
+    bits of all other directories stay where they are.
+    """
+    tag_to_bits = select_bitsets(
+        conn, {tag for _, add_tags, del_tags in diffs for tag in add_tags | del_tags}
+    )
+    for dirpath, add_tags, del_tags in diffs:
+        if add_tags:
+            conn.execute(
+                "INSERT OR IGNORE INTO dirs (dirpath) VALUES (?)",
+                (dirpath.as_posix(),),
+            )
+        row = conn.execute(
+            "SELECT id FROM dirs WHERE dirpath = ?", (dirpath.as_posix(),)
+        ).fetchone()
+        if row is None:
+            continue
+        bit = 1 << row[0]
+        for tag in add_tags:
+            tag_to_bits[tag] = tag_to_bits.get(tag, 0) | bit
+        for tag in del_tags:
+            tag_to_bits[tag] = tag_to_bits.get(tag, 0) & ~bit
+        if del_tags:
+            conn.execute(
+                "DELETE FROM dirs WHERE id = ? AND NOT EXISTS "
+                "(SELECT 1 FROM tags WHERE dirpath = ?)",
+                (row[0], dirpath.as_posix()),
+            )
+
+    conn.executemany(
+        "INSERT OR REPLACE INTO bitsets (tag, start, bits) VALUES (?, ?, ?)",
+        ((tag, *to_bytes(bits)) for tag, bits in tag_to_bits.items() if bits),
+    )
+    conn.executemany(
+        "DELETE FROM bitsets WHERE tag = ?",
+        ((tag,) for tag, bits in tag_to_bits.items() if not bits),
+    )
+
+
+def to_bytes(bits: int) -> Tuple[int, bytes]:
+    """Return the bytes of a bitset from its first non-zero byte, and its offset.
+
+    Most tags are on a few directories, so their bitsets are mostly zeros.
+    """
+    start = ((bits & -bits).bit_length() - 1) // 8 if bits else 0
+    bits >>= start * 8
+    return start, bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+
+
+def from_bytes(start: int, data: bytes) -> int:
+    return int.from_bytes(data, "little") << start * 8
+
+
+def has_tag(conn: sqlite3.Connection, tag: str) -> bool:
+    rows = conn.execute("SELECT 1 FROM tags WHERE tag = ? LIMIT 1", (tag,))
+    return rows.fetchone() is not None
+
+
+def insert_trigrams(conn: sqlite3.Connection, tags: Iterable[str]) -> None:
+    # Rows are sorted so that bulk inserts append to the B-tree in order
+    rows = sorted((trigram, tag) for tag in tags for trigram in get_trigrams(tag))
+    counts = Counter(trigram for trigram, _ in rows)
+    conn.executemany("INSERT INTO trigrams (trigram, tag) VALUES (?, ?)", rows)
+    conn.executemany(
+        "INSERT OR IGNORE INTO trigram_counts (trigram, count) VALUES (?, 0)",
+        ((trigram,) for trigram in counts),
+    )
+    conn.executemany(
+        "UPDATE trigram_counts SET count = count + ? WHERE trigram = ?",
+        ((count, trigram) for trigram, count in counts.items()),
+    )
+
+
+def delete_trigrams(conn: sqlite3.Connection, tags: Iterable[str]) -> None:
+    rows = sorted((trigram, tag) for tag in tags for trigram in get_trigrams(tag))
+    counts = Counter(trigram for trigram, _ in rows)
+    conn.executemany("DELETE FROM trigrams WHERE trigram = ? AND tag = ?", rows)
+    conn.executemany(
+        "UPDATE trigram_counts SET count = count - ? WHERE trigram = ?",
+        ((count, trigram) for trigram, count in counts.items()),
+    )
+    conn.execute("DELETE FROM trigram_counts WHERE count <= 0")
+
+
+def set_signature(conn: sqlite3.Connection, signature: str) -> None:
+    conn.executemany(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+        [("schema", str(SCHEMA_VERSION)), ("signature", signature)],
+    )
+
+
+def select_all_dirpaths(conn: sqlite3.Connection) -> Dict[str, Set[Path]]:
+    result: Dict[str, Set[Path]] = {}
+
+    for tag, dirpath in conn.execute("SELECT tag, dirpath FROM tags ORDER BY tag"):
+        if tag in result:
+            result[tag].add(Path(dirpath))
+        else:
+            result[tag] = {Path(dirpath)}
+
+    return result
+
+
+def iter_tag_dirpaths(
+    conn: sqlite3.Connection,
+    tags: Optional[Iterable[str]] = None,
+) -> Iterator[Tuple[str, List[str]]]:
+    """Yield each tag with its directory paths, both in sorted order.
+
+    Rows are streamed from the database, one tag at a time.
+    """
+    from itertools import groupby
+
+    if tags is None:
+        rows = conn.execute("SELECT tag, dirpath FROM tags ORDER BY tag, dirpath")
+    else:
+        tags = sorted(tags)
+        rows = conn.execute(
+            "SELECT tag, dirpath FROM tags "
+            f"WHERE tag IN ({', '.join('?' * len(tags))}) ORDER BY tag, dirpath",
+            tags,
+        )
+    for tag, group in groupby(rows, key=lambda row: row[0]):
+        yield tag, [dirpath for _, dirpath in group]
+
+
+def select_dirpaths(
+    conn: sqlite3.Connection,
+    tags: Iterable[str],
+) -> Dict[str, Set[Path]]:
+    result: Dict[str, Set[Path]] = {}
+
+    for tag in tags:
+        rows = conn.execute("SELECT dirpath FROM tags WHERE tag = ?", (tag,))
+        dirpaths = {Path(dirpath) for dirpath, in rows}
+        if dirpaths:
+            result[tag] = dirpaths
+
+    return result
+
+
+def select_bitsets(conn: sqlite3.Connection, tags: Iterable[str]) -> Dict[str, int]:
+    """Return the bitset of directory IDs of each tag in use."""
+    tags = sorted(tags)
+    rows = conn.execute(
+        "SELECT tag, start, bits FROM bitsets "
+        f"WHERE tag IN ({', '.join('?' * len(tags))})",
+        tags,
+    )
+    return {tag: from_bytes(start, bits) for tag, start, bits in rows}
+
+
+def select_all_bits(conn: sqlite3.Connection) -> int:
+    """Return the bitset of the IDs of all directories."""
+    return to_bitset(dir_id for dir_id, in conn.execute("SELECT id FROM dirs"))
+
+
+def select_bitset_dirpaths(conn: sqlite3.Connection, bits: int) -> Set[Path]:
+    """Return the directory paths of the IDs in a bitset.
+
+    IDs are looked up in chunks, as older SQLite versions allow at most 999
+    parameters per statement.
+    """
+    result: Set[Path] = set()
+
+    dir_ids = from_bitset(bits)
+    for num in range(0, len(dir_ids), 500):
+        chunk = dir_ids[num : num + 500]
+        rows = conn.execute(
+            f"SELECT dirpath FROM dirs WHERE id IN ({', '.join('?' * len(chunk))})",
+            chunk,
+        )
+        result.update(Path(dirpath) for dirpath, in rows)
+
+    return result
+
+
+def select_unique_dirpaths(
+    conn: sqlite3.Connection,
+    tags: Iterable[str],
+) -> Dict[str, Optional[str]]:
+    """Return the directory path of each tag in use, or None if it has several.
+
+    Tags are looked up in chunks, as older SQLite versions allow at most 999
+    parameters per statement.
+    """
+    result: Dict[str, Optional[str]] = {}
+
+    tags = sorted(tags)
+    for num in range(0, len(tags), 500):
+        chunk = tags[num : num + 500]
+        rows = conn.execute(
+            "SELECT tag, MIN(dirpath), COUNT(*) FROM tags "
+            f"WHERE tag IN ({', '.join('?' * len(chunk))}) GROUP BY tag",
+            chunk,
+        )
+        for tag, dirpath, count in rows:
+            result[tag] = dirpath if count == 1 else None
+
+    return result
+
+
+def select_tags(
+    conn: sqlite3.Connection,
+    dirpaths: Iterable[Path],
+) -> Dict[Path, Set[str]]:
+    result: Dict[Path, Set[str]] = {}
+
+    for dirpath in dirpaths:
+        rows = conn.execute(
+            "SELECT tag FROM tags WHERE dirpath = ?", (dirpath.as_posix(),)
+        )
+        tags = {tag for tag, in rows}
+        if tags:
+            result[dirpath] = tags
+
+    return result
+
+
+def select_similar_tags(
+    conn: sqlite3.Connection,
+    value: str,
+    limit: int,
+    min_score: float,
+) -> List[Tuple[float, str]]:
+    """Return up to limit tags most similar to the value, with their scores.
+
+    Tags are scored by the Jaccard similarity of their trigrams, or by the
+    fraction typed if the value is their prefix, whichever is higher.
+    """
+    trigrams = get_trigrams(value)
+    scores: Dict[str, float] = {}
+
+    # A tag scoring at least min_score shares at least this many trigrams, so
+    # it must have one of the (len(trigrams) - shared + 1) rarest trigrams.
+    # Only those are probed, which skips trigrams common to many tags.
+    min_shared = max(math.ceil(min_score * len(trigrams)), 1)
+    counts = dict(
+        conn.execute(
+            "SELECT trigram, count FROM trigram_counts "
+            f"WHERE trigram IN ({', '.join('?' * len(trigrams))})",
+            sorted(trigrams),
+        ).fetchall()
+    )
+    rare_trigrams = sorted(trigrams, key=lambda t: (counts.get(t, 0), t))
+    rare_trigrams = rare_trigrams[: len(trigrams) - min_shared + 1]
+
+    rows = conn.execute(
+        "SELECT tag, COUNT(*) FROM trigrams "
+        f"WHERE trigram IN ({', '.join('?' * len(trigrams))}) AND tag IN ("
+        "  SELECT tag FROM trigrams "
+        f"  WHERE trigram IN ({', '.join('?' * len(rare_trigrams))})"
+        ") GROUP BY tag HAVING COUNT(*) >= ?",
+        (*sorted(trigrams), *rare_trigrams, min_shared),
+    )
+    for tag, shared in rows:
+        score = shared / (len(trigrams) + len(get_trigrams(tag)) - shared)
+        if score >= min_score:
+            scores[tag] = score
+
+    rows = conn.execute(
+        "SELECT DISTINCT tag FROM tags WHERE tag >= ? AND tag < ? "
+        "AND length(tag) * ? <= ? ORDER BY length(tag) LIMIT ?",
+        (value, value + MAX_CHAR, min_score, len(value), limit),
+    )
+    for (tag,) in rows:
+        scores[tag] = max(scores.get(tag, 0.0), len(value) / len(tag))
+
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    return [(score, tag) for tag, score in ranked[:limit]]
@@ -0,0 +1,197 @@
+from array import array
+from pathlib import Path
+from typing import (
+    Dict,
+    ItemsView,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    ValuesView,
+)
+
+from dtags.query import to_bitset
+
+TagConfigType = MutableMapping[Path, Set[str]]
+
+
+class TagTable:
+    """Directory tags with paths and tag names interned to integer IDs.
+
+    Each path and tag name is stored once as a string, and the tags of all
+    directories are kept as runs of tag IDs in one flat array (the start of
+    each run is in another), instead of a Path object and a set of strings per
+    directory. Directories changed after they were added are kept in a small
+    overlay, where None marks a removed directory.
+
+    The paths given to the constructor must be unique (e.g. JSON object keys).
+    """
+
+    __slots__ = ("paths", "tags", "tag_ids", "offsets", "members", "changes", "_ids")
+
+    def __init__(self, items: Iterable[Tuple[str, Iterable[str]]] = ()) -> None:
+        self.paths: List[str] = []
+        self.tags: List[str] = []
+        self.tag_ids: Dict[str, int] = {}
+        self.offsets = array("L", [0])
+        self.members = array("L")
+        self.changes: Dict[int, Optional[Tuple[int, ...]]] = {}
+        self._ids: Optional[Dict[str, int]] = None
+
+        for path, tags in items:
+            self.append(path, tags)
+
+    def __len__(self) -> int:
+        removed = sum(1 for tag_ids in self.changes.values() if tag_ids is None)
+        return len(self.paths) - removed
+
+    def intern_tags(self, tags: Iterable[str]) -> Tuple[int, ...]:
+        tag_ids = self.tag_ids
+        for tag in tags:
+            if tag not in tag_ids:
+                tag_ids[tag] = len(self.tags)
+                self.tags.append(tag)
+        return tuple(sorted(tag_ids[tag] for tag in tags))
+
+    def get_path_id(self, path: str) -> Optional[int]:
+        # The path lookup table is built on first use, since listing all
+        # directories (e.g. to save the config) does not need it
+        if self._ids is None:
+            self._ids = {path: num for num, path in enumerate(self.paths)}
+        return self._ids.get(path)
+
+    def get_tag_ids(self, path_id: int) -> Optional[Tuple[int, ...]]:
+        if path_id in self.changes:
+            return self.changes[path_id]
+        return tuple(self.members[self.offsets[path_id] : self.offsets[path_id + 1]])
+
+    def get_tags(self, path: str) -> Optional[Set[str]]:
+        path_id = self.get_path_id(path)
+        tag_ids = None if path_id is None else self.get_tag_ids(path_id)
+        return None if tag_ids is None else {self.tags[num] for num in tag_ids}
+
+    def set_tags(self, path: str, tags: Iterable[str]) -> None:
+        path_id = self.get_path_id(path)
+        if path_id is None:
+            self.append(path, tags)
+        else:
+            self.changes[path_id] = self.intern_tags(set(tags))
+
+    def append(self, path: str, tags: Iterable[str]) -> None:
+        if self._ids is not None:
+            self._ids[path] = len(self.paths)
+        self.paths.append(path)
+        self.members.extend(self.intern_tags(set(tags)))
+        self.offsets.append(len(self.members))
+
+    def remove(self, path: str) -> bool:
+        path_id = self.get_path_id(path)
+        if path_id is None or self.get_tag_ids(path_id) is None:
+            return False
+        self.changes[path_id] = None
+        return True
+
+    def iter_items(self) -> Iterator[Tuple[str, List[str]]]:
+        """Yield each directory path with its tag names, in insertion order."""
+        tags, paths = self.tags, self.paths
+        for path_id, tag_ids in self.iter_tag_ids():
+            yield paths[path_id], [tags[num] for num in tag_ids]
+
+    def iter_tag_ids(self) -> Iterator[Tuple[int, Sequence[int]]]:
+        """Yield the ID of each directory with its tag IDs, in insertion order."""
+        members, offsets, changes = self.members, self.offsets, self.changes
+        tag_ids: Optional[Sequence[int]]
+        for path_id in range(len(self.paths)):
+            if path_id in changes:
+                tag_ids = changes[path_id]
+                if tag_ids is None:
+                    continue
+            else:
+                tag_ids = members[offsets[path_id] : offsets[path_id + 1]]
+            yield path_id, tag_ids
+
+    def get_bitsets(self, tags: Iterable[str]) -> Dict[str, int]:
+        """Return the bitset of directory IDs of each given tag in use."""
+        tag_ids = {self.tag_ids[tag]: tag for tag in tags if tag in self.tag_ids}
+        path_ids: Dict[int, List[int]] = {tag_id: [] for tag_id in tag_ids}
+        for path_id, ids in self.iter_tag_ids():
+            for tag_id in ids:
+                if tag_id in path_ids:
+                    path_ids[tag_id].append(path_id)
+        return {tag_ids[num]: to_bitset(ids) for num, ids in path_ids.items() if ids}
+
+    def get_all_bits(self) -> int:
+        """Return the bitset of the IDs of all directories."""
+        return to_bitset(path_id for path_id, _ in self.iter_tag_ids())
+
+    def sort_paths(self) -> "TagTable":
+        """Return a compacted copy of the table with paths in sorted order."""
+        return TagTable(sorted(self.iter_items()))
+
+
+class TagMap(TagConfigType):
+    """Dictionary-like view of a TagTable keyed by Path objects.
+
+    This lets commands work with tags as before ({Path: {tag, ...}}), while
+    Path objects and tag sets are only created for the entries they touch.
+    """
+
+    __slots__ = ("table",)
+
+    def __init__(self, table: Optional[TagTable] = None) -> None:
+        self.table = TagTable() if table is None else table
+
+    def __getitem__(self, dirpath: Path) -> Set[str]:
+        tags = self.table.get_tags(dirpath.as_posix())
+        if tags is None:
+            raise KeyError(dirpath)
+        return tags
+
+    def __setitem__(self, dirpath: Path, tags: Set[str]) -> None:
+        self.table.set_tags(dirpath.as_posix(), tags)
+
+    def __delitem__(self, dirpath: Path) -> None:
+        if not self.table.remove(dirpath.as_posix()):
+            raise KeyError(dirpath)
+
+    def __iter__(self) -> Iterator[Path]:
+        return (Path(path) for path, _ in self.table.iter_items())
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def __repr__(self) -> str:
+        return f"TagMap({dict(self.items())!r})"
+
+    def items(self) -> ItemsView[Path, Set[str]]:
+        return TagItemsView(self)
+
+    def values(self) -> ValuesView[Set[str]]:
+        return TagValuesView(self)
+
+
+class TagItemsView(ItemsView[Path, Set[str]]):
+    _mapping: TagMap
+
+    def __iter__(self) -> Iterator[Tuple[Path, Set[str]]]:
+        for path, tags in self._mapping.table.iter_items():
+            yield Path(path), set(tags)
+
+
+class TagValuesView(ValuesView[Set[str]]):
+    _mapping: TagMap
+
+    def __iter__(self) -> Iterator[Set[str]]:
+        for _, tags in self._mapping.table.iter_items():
+            yield set(tags)
+
+
+def to_tag_map(tag_config: Mapping[Path, Set[str]]) -> TagMap:
+    if isinstance(tag_config, TagMap):
+        return tag_config
+    return TagMap(TagTable((d.as_posix(), tags) for d, tags in tag_config.items()))
@@ -0,0 +1,160 @@
+import re
+from typing import Any, Callable, Iterable, List, Mapping, Set, Tuple, Union
+
+from dtags.commons import normalize_tag
+from dtags.exceptions import DtagsError
+
+# A parsed query is a tag name, or a tuple of an operator and its operands:
+# ("!", query), ("&", query, query) or ("|", query, query)
+QueryType = Union[str, Tuple[Any, ...]]
+
+QUERY_OPERATORS = "&|!()"
+QUERY_TOKEN_PATTERN = re.compile(r"\s*(?:([&|!()])|([^&|!()\s]+))")
+
+
+def is_query(value: str) -> bool:
+    return any(char in value for char in QUERY_OPERATORS)
+
+
+def parse_query(value: str) -> QueryType:
+    """Parse a tag query such as "work & (python | go) & !archived".
+
+    The "!" operator binds tightest, then "&", then "|". Tag names are
+    normalized like everywhere else.
+    """
+    try:
+        tokens = tokenize_query(value)
+        query, pos = parse_or(tokens, 0)
+        if pos != len(tokens):
+            raise ValueError(tokens[pos])
+    except ValueError:
+        raise DtagsError(f"Invalid query: {value}")
+    return query
+
+
+def tokenize_query(value: str) -> List[str]:
+    tokens = []
+    for operator, tag in QUERY_TOKEN_PATTERN.findall(value):
+        if tag and not normalize_tag(tag):
+            raise ValueError(tag)
+        tokens.append(operator or normalize_tag(tag))
+    return tokens
+
+
+def parse_or(tokens: List[str], pos: int) -> Tuple[QueryType, int]:
+    query, pos = parse_and(tokens, pos)
+    while pos < len(tokens) and tokens[pos] == "|":
+        operand, pos = parse_and(tokens, pos + 1)
+        query = ("|", query, operand)
+    return query, pos
+
+
+def parse_and(tokens: List[str], pos: int) -> Tuple[QueryType, int]:
+    query, pos = parse_not(tokens, pos)
+    while pos < len(tokens) and tokens[pos] == "&":
+        operand, pos = parse_not(tokens, pos + 1)
+        query = ("&", query, operand)
+    return query, pos
+
+
+def parse_not(tokens: List[str], pos: int) -> Tuple[QueryType, int]:
+    if pos >= len(tokens):
+        raise ValueError("unexpected end of query")
+
+    token = tokens[pos]
+    if token == "!":
+        operand, pos = parse_not(tokens, pos + 1)
+        return ("!", operand), pos
+    if token == "(":
+        query, pos = parse_or(tokens, pos + 1)
+        if pos >= len(tokens) or tokens[pos] != ")":
+            raise ValueError("unbalanced parentheses")
+        return query, pos + 1
+    if token in QUERY_OPERATORS:
+        raise ValueError(token)
+    return token, pos + 1
+
+
+def get_query_tags(query: QueryType) -> Set[str]:
+    if isinstance(query, str):
+        return {query}
+    return set().union(*(get_query_tags(operand) for operand in query[1:]))
+
+
+def is_negation(query: QueryType) -> bool:
+    return not isinstance(query, str) and query[0] == "!"
+
+
+def to_bitset(ids: Iterable[int]) -> int:
+    """Return a bitset (an int) with the bits of the given IDs set.
+
+    The bits are set in a bytearray, so that building the bitset is linear in
+    the number of IDs instead of copying an int for each.
+    """
+    ids = list(ids)
+    if not ids:
+        return 0
+    data = bytearray(max(ids) // 8 + 1)
+    for num in ids:
+        data[num >> 3] |= 1 << (num & 7)
+    return int.from_bytes(data, "little")
+
+
+def from_bitset(bits: int) -> List[int]:
+    """Return the IDs of the bits set in a bitset, in ascending order."""
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    return [
+        pos * 8 + bit
+        for pos, byte in enumerate(data)
+        if byte
+        for bit in range(8)
+        if byte >> bit & 1
+    ]
+
+
+def evaluate_query(
+    query: QueryType,
+    tag_to_bits: Mapping[str, int],
+    get_all_bits: Callable[[], int],
+) -> int:
+    """Return the bitset of the directory IDs matching a parsed query.
+
+    Each tag maps to the bitset of its directory IDs, so &, | and ! run over
+    machine words instead of directories. The bitset of all directories is
+    only requested for negations which are not "and not" (e.g. "a | !b").
+    """
+    all_bits: List[int] = []  # requested on first use
+
+    def get_all_bits_once() -> int:
+        if not all_bits:
+            all_bits.append(get_all_bits())
+        return all_bits[0]
+
+    return evaluate_bitsets(query, tag_to_bits, get_all_bits_once)
+
+
+def evaluate_bitsets(
+    query: QueryType,
+    tag_to_bits: Mapping[str, int],
+    get_all_bits: Callable[[], int],
+) -> int:
+    if isinstance(query, str):
+        return tag_to_bits.get(query, 0)
+
+    operator, left, *right = query
+    if operator == "!":
+        return get_all_bits() & ~evaluate_bitsets(left, tag_to_bits, get_all_bits)
+    if operator == "&" and is_negation(left) != is_negation(right[0]):
+        # Evaluate "a & !b" as "a and not b", without all directories
+        left, right = sorted([left, right[0]], key=is_negation)
+        bits = evaluate_bitsets(left, tag_to_bits, get_all_bits)
+        if not bits:
+            return 0
+        return bits & ~evaluate_bitsets(right[1], tag_to_bits, get_all_bits)
+
+    bits = evaluate_bitsets(left, tag_to_bits, get_all_bits)
+    if operator == "&":
+        if not bits:
+            return 0
+        return bits & evaluate_bitsets(right[0], tag_to_bits, get_all_bits)
+    return bits | evaluate_bitsets(right[0], tag_to_bits, get_all_bits)
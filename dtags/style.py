@@ -1,6 +1,6 @@
 import sys
 from pathlib import Path
-from typing import Optional, Set
+from typing import Iterable, Optional, Set, Union
 
 TTY = sys.stdout.isatty()
 
@@ -18,15 +18,17 @@ def command(value: str, tty: bool = TTY) -> str:
     return f"{BOLD}{CMD_PREFIX} {value}{CLEAR}" if tty else f"{CMD_PREFIX} {value}"
 
 
-def path(value: Path, tty: bool = TTY) -> str:
-    return f"{BLUE}{value.as_posix()}{CLEAR}" if tty else value.as_posix()
+def path(value: Union[Path, str], tty: bool = TTY) -> str:
+    if isinstance(value, Path):
+        value = value.as_posix()
+    return f"{BLUE}{value}{CLEAR}" if tty else value
 
 
 def tag(value: str, tty: bool = TTY) -> str:
     return f"{BOLD}{TAG_PREFIX}{CLEAR}{value}" if tty else f"{TAG_PREFIX}{value}"
 
 
-def mapping(dirpath: Path, tags: Set[str], tty: bool = TTY) -> str:
+def mapping(dirpath: Union[Path, str], tags: Iterable[str], tty: bool = TTY) -> str:
     buffer = [path(dirpath)]
     if tty:
         buffer.extend(f"{BOLD}{TAG_PREFIX}{CLEAR}{t}" for t in sorted(tags))
@@ -36,6 +36,7 @@ setup(
     entry_points={
         "console_scripts": [
             "dtags-activate = dtags.commands.activate:execute",
+            "dtags-complete = dtags.commands.complete:execute",
             "dtags-d = dtags.commands.d:execute",
             "tag = dtags.commands.tag:execute",
             "untag = dtags.commands.untag:execute",
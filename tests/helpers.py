@@ -1,7 +1,7 @@
 import re
 from typing import List
 
-from dtags.files import COMP_FILE, DEST_FILE, get_file_path
+from dtags.files import COMP_FILE, DEST_FILE, find_completion_tags, get_file_path
 
 ANSI_ESCAPE = re.compile(r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
 
@@ -12,7 +12,8 @@ def clean_str(value: str) -> str:
 
 def load_completion() -> List[str]:
     with open(get_file_path(COMP_FILE)) as fp:
-        return sorted(tag for tag in fp.read().split(" ") if tag)
+        assert fp.readline().startswith("# ")  # stamp
+    return find_completion_tags("")
 
 
 def load_destination() -> str:
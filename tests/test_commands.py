@@ -1,12 +1,32 @@
+import io
+import json
+import os
 import shutil
+import subprocess
+import sys
+import time
 from string import whitespace
 from typing import List
 
-from dtags.commands import activate, d, run, tag, tags, untag
-from dtags.files import CONFIG_FILE, get_file_path
+import pytest
 
+from dtags import commons, files
+from dtags.commands import activate, complete, d, run, tag, tags, untag
+from dtags.files import (
+    CONFIG_FILE,
+    FISH_LOOKUP_FILE,
+    INDEX_FILE,
+    JOURNAL_FILE,
+    SH_LOOKUP_FILE,
+    get_file_path,
+)
+
+from .conftest import TEST_ROOT
 from .helpers import clean_str, load_completion, load_destination
 
+# A command which does not finish in time, with a child in its process group
+SLEEP = "sleep 10 & sleep 10"
+
 
 def normalize_str(value) -> List[str]:
     lines = value.splitlines(keepends=False) if isinstance(value, str) else value
@@ -245,7 +265,7 @@ def test_command_run(capsys, dir1, dir2, dir3):
     assert_stdout(capsys, "")
 
 
-def test_command_tags(capsys, dir1, dir2, dir3):
+def test_command_tags(capsys, dir1, dir2, dir3, monkeypatch):
     tag.execute([dir3.as_posix(), dir2.as_posix(), dir1.as_posix(), "-y"])
     assert_stdout(
         capsys,
@@ -367,6 +387,18 @@ def test_command_tags(capsys, dir1, dir2, dir3):
         }}
         """,
     )
+    tags.execute(["-r", "-t", "foo", dir1.name])
+    assert_stdout(
+        capsys,
+        f"""
+        @{dir1.name}
+          {dir1.as_posix()}
+        @foo
+          {dir1.as_posix()}
+          {dir2.as_posix()}
+          {dir3.as_posix()}
+        """,
+    )
     tags.execute(["-y", "--purge"])
     assert_stdout(
         capsys,
@@ -410,3 +442,1194 @@ def test_command_tags(capsys, dir1, dir2, dir3):
         capsys,
         "Nothing to clean",
     )
+
+    # Unreachable directories are reported but never cleaned
+    monkeypatch.setattr(tags, "check_dirs", lambda dirpaths: {dir3: None})
+    tags.execute(["--yes", "--clean"])
+    captured = capsys.readouterr()
+    assert normalize_str(captured.out) == ["Nothing to clean"]
+    assert normalize_str(captured.err) == [f"Skipped unreachable {dir3.as_posix()}"]
+
+
+def test_command_run_parallel(capsys, dir1, dir2, dir3):
+    tag.execute([dir3.as_posix(), dir2.as_posix(), dir1.as_posix(), "-y", "-t", "foo"])
+    assert_stdout(
+        capsys,
+        f"""
+        {dir1.as_posix()} +@foo
+        {dir2.as_posix()} +@foo
+        {dir3.as_posix()} +@foo
+        Tags saved successfully
+        """,
+    )
+    for directory in [dir1, dir2, dir3]:
+        (directory / f"{directory.name}.txt").touch()
+
+    run.execute(["-j", "0", "foo", "-c", "ls"])
+    assert_stderr(
+        capsys,
+        f"""
+        usage: {run.USAGE}
+        run: error: argument -j/--jobs: must be a positive integer
+        """,
+    )
+    run.execute(["-j", "3", "foo", "-c", "ls"])
+    assert_stdout(
+        capsys,
+        f"""
+        {dir1.as_posix()} @foo:
+        {dir1.name}.txt
+        {dir2.as_posix()} @foo:
+        {dir2.name}.txt
+        {dir3.as_posix()} @foo:
+        {dir3.name}.txt
+        """,
+    )
+    run.execute(["--jobs", "2", dir1.as_posix(), "-c", "foobar"])
+    out, err = capsys.readouterr()
+    assert normalize_str(out) == [f"{dir1.as_posix()} @foo:"]
+    assert normalize_str(err) == ["Invalid command: foobar"]
+
+
+def test_command_run_stream(capsys, dir1, dir2, dir3):
+    tag.execute([dir3.as_posix(), dir2.as_posix(), dir1.as_posix(), "-y", "-t", "foo"])
+    capsys.readouterr()
+
+    for directory in [dir1, dir2, dir3]:
+        (directory / f"{directory.name}-a.txt").touch()
+        (directory / f"{directory.name}-b.txt").touch()
+
+    run.execute(["-j", "2", "--stream", "foo", "-c", "ls"])
+    out, err = capsys.readouterr()
+    assert sorted(normalize_str(out)) == [
+        f"{directory.as_posix()}: {directory.name}-{suffix}.txt"
+        for directory in [dir1, dir2, dir3]
+        for suffix in ["a", "b"]
+    ]
+    assert err == ""
+
+    run.execute(["-s", dir1.as_posix(), "-c", "foobar"])
+    out, err = capsys.readouterr()
+    assert out == ""
+    assert normalize_str(err) == ["Invalid command: foobar"]
+
+
+def test_command_run_report(capsys, dir1, dir2, dir3):
+    tag.execute([dir3.as_posix(), dir2.as_posix(), dir1.as_posix(), "-y", "-t", "foo"])
+    capsys.readouterr()
+
+    for directory in [dir1, dir2, dir3]:
+        (directory / f"{directory.name}.txt").touch()
+
+    run.execute(["--report", "json", "-s", "foo", "-c", "ls"])
+    assert_stderr(
+        capsys,
+        f"""
+        usage: {run.USAGE}
+        run: error: argument --report: not allowed with argument -s/--stream
+        """,
+    )
+    run.execute(["--report", "json", "-j", "2", "foo", "-c", "ls"])
+    out, err = capsys.readouterr()
+    assert normalize_str(err) == [
+        line
+        for directory in [dir1, dir2, dir3]
+        for line in [f"{directory.as_posix()} @foo:", f"{directory.name}.txt"]
+    ]
+    report = json.loads(out)
+    assert report["command"] == ["ls"]
+    assert [entry["dir"] for entry in report["directories"]] == [
+        dir1.as_posix(),
+        dir2.as_posix(),
+        dir3.as_posix(),
+    ]
+    for directory, entry in zip([dir1, dir2, dir3], report["directories"]):
+        assert entry["tags"] == ["foo"]
+        assert entry["exit_code"] == 0
+        assert entry["error"] is None
+        assert entry["stdout_bytes"] == len(f"{directory.name}.txt\n")
+        assert entry["stderr_bytes"] == 0
+        assert entry["wall_time"] >= 0
+        assert entry["cpu_time"] == pytest.approx(
+            entry["user_time"] + entry["system_time"], abs=1e-5
+        )
+    summary = report["summary"]
+    assert summary["directories"] == 3
+    assert summary["failed"] == 0
+    assert summary["errors"] == 0
+    assert len(summary["slowest"]) == 3
+    assert summary["slowest"][0]["wall_time"] == max(
+        entry["wall_time"] for entry in report["directories"]
+    )
+
+    run.execute(["--report", "json", dir1.as_posix(), "-c", "ls", "missing"])
+    out, err = capsys.readouterr()
+    entry = json.loads(out)["directories"][0]
+    assert entry["exit_code"] != 0
+    assert entry["stdout_bytes"] == 0
+    assert entry["stderr_bytes"] > 0
+    assert "missing" in err
+
+    run.execute(["--report", "json", dir1.as_posix(), "-c", "foobar"])
+    out, err = capsys.readouterr()
+    report = json.loads(out)
+    assert report["directories"][0]["exit_code"] is None
+    assert report["directories"][0]["error"] == "Invalid command: foobar"
+    assert report["summary"]["errors"] == 1
+    assert normalize_str(err) == [
+        f"{dir1.as_posix()} @foo:",
+        "Invalid command: foobar",
+    ]
+
+
+def test_command_run_policies(capsys, dir1, dir2, dir3, monkeypatch):
+    monkeypatch.setattr(run, "RETRY_BACKOFF", 0.01)
+    tag.execute([dir3.as_posix(), dir2.as_posix(), dir1.as_posix(), "-y", "-t", "foo"])
+    capsys.readouterr()
+
+    run.execute(["--timeout", "0", "foo", "-c", "ls"])
+    assert_stderr(
+        capsys,
+        f"""
+        usage: {run.USAGE}
+        run: error: argument --timeout: must be a positive number
+        """,
+    )
+    run.execute(["--retries", "-1", "foo", "-c", "ls"])
+    assert_stderr(
+        capsys,
+        f"""
+        usage: {run.USAGE}
+        run: error: argument --retries: must be a non-negative integer
+        """,
+    )
+
+    # The whole process group is killed, including the background sleep
+    start_time = time.monotonic()
+    run.execute(["--timeout", "0.2", "-j", "2", "foo", "-c", "sh", "-c", SLEEP])
+    assert time.monotonic() - start_time < 5
+    out, err = capsys.readouterr()
+    assert normalize_str(err) == ["Timed out after 0.2s"] * 3
+
+    flaky = "echo x >> attempts.txt; test -f ok || { touch ok; exit 1; }"
+    for args in [[], ["-j", "2"], ["-s", "-j", "2"], ["--report", "json"]]:
+        run.execute([*args, "--retries", "2", "foo", "-c", "sh", "-c", flaky])
+        out, err = capsys.readouterr()
+        assert sorted(line for line in normalize_str(err) if "retrying" in line) == [
+            f"Exit code 1, retrying in 0.01s (attempt 2 of 3): {d.as_posix()}"
+            for d in [dir1, dir2, dir3]
+        ]
+        for directory in [dir1, dir2, dir3]:
+            assert (directory / "attempts.txt").read_text() == "x\nx\n"
+            (directory / "attempts.txt").unlink()
+            (directory / "ok").unlink()
+
+    run.execute(["--retries", "1", dir1.as_posix(), "-c", "sh", "-c", "exit 3"])
+    out, err = capsys.readouterr()
+    assert normalize_str(err) == [
+        f"Exit code 3, retrying in 0.01s (attempt 2 of 2): {dir1.as_posix()}"
+    ]
+
+    run.execute(["--fail-fast", "foo", "-c", "sh", "-c", "exit 1"])
+    out, err = capsys.readouterr()
+    assert normalize_str(out) == [f"{dir1.as_posix()} @foo:"]
+    assert normalize_str(err) == ["Skipped directories after a failure: 2"]
+
+    # Commands which cannot be started are failures too
+    exit_codes = []
+    monkeypatch.setattr(sys, "exit", exit_codes.append)
+    for args, max_failed in [
+        ([], 1),
+        (["-j", "2"], 2),  # the second job may start before the first fails
+        (["-s"], 1),
+        (["--report", "json"], 1),
+    ]:
+        run.execute([*args, "--fail-fast", "foo", "-c", "nonexistentcmd"])
+        out, err = capsys.readouterr()
+        errors = normalize_str(err)
+        failed = sum("Invalid command: nonexistentcmd" in line for line in errors)
+        assert 1 <= failed <= max_failed
+    run.execute(["foo", "-c", "nonexistentcmd"])
+    capsys.readouterr()
+    assert exit_codes == [1] * 5
+    monkeypatch.setattr(sys, "exit", lambda code: None)
+
+    # Running commands are killed after the first failure
+    fail_dir1 = f"if [ $PWD = {dir1.as_posix()} ]; then sleep 0.5; exit 1; fi; {SLEEP}"
+    for args in [["-j", "3"], ["-s", "-j", "3"], ["--report", "json", "-j", "3"]]:
+        start_time = time.monotonic()
+        run.execute([*args, "--fail-fast", "foo", "-c", "sh", "-c", fail_dir1])
+        assert time.monotonic() - start_time < 5
+        out, err = capsys.readouterr()
+        assert sum(line.endswith("Cancelled") for line in normalize_str(err)) == 2
+
+    run.execute(["--fail-fast", "-s", "-j", "2", "foo", "-c", "sh", "-c", fail_dir1])
+    out, err = capsys.readouterr()
+    assert normalize_str(err) == [
+        f"{dir2.as_posix()}: Cancelled",
+        "Skipped directories after a failure: 1",
+    ]
+
+
+def test_config_index(capsys, dir1, dir2, monkeypatch):
+    tag.execute([dir1.as_posix(), "-y", "-t", "foo"])
+    assert_stdout(
+        capsys,
+        f"""
+        {dir1.as_posix()} +@foo
+        Tags saved successfully
+        """,
+    )
+    assert get_file_path(INDEX_FILE).is_file()
+
+    d.execute(["foo"])
+    assert load_destination() == dir1.as_posix()
+
+    # Config files replaced by hand are picked up by the index
+    with open(get_file_path(CONFIG_FILE), "w") as fp:
+        json.dump({"tags": {dir2.as_posix(): ["bar", "foo"]}}, fp)
+
+    d.execute(["foo"])
+    assert load_destination() == dir2.as_posix()
+
+    run.execute(["foo", "-c", "ls"])
+    assert_stdout(capsys, f"{dir2.as_posix()} @bar @foo:")
+
+    # Lookups fall back to the config file if the index is not available
+    monkeypatch.setitem(sys.modules, "dtags.index", None)
+
+    d.execute(["bar"])
+    assert load_destination() == dir2.as_posix()
+
+    run.execute(["foo", "-c", "ls"])
+    assert_stdout(capsys, f"{dir2.as_posix()} @bar @foo:")
+
+
+def test_config_import(capsys, dir1, dir2):
+    tag.execute([dir1.as_posix(), dir2.as_posix(), "-y", "-t", "foo"])
+    tag.execute([dir2.as_posix(), "-y", "-t", "bar"])
+    capsys.readouterr()
+
+    # The output of tags --json can be copied over the config file
+    tags.execute(["--json"])
+    exported = capsys.readouterr().out
+    get_file_path(CONFIG_FILE).unlink()
+    with open(get_file_path(CONFIG_FILE), "w") as fp:
+        fp.write(exported)
+
+    tags.execute([])
+    assert_stdout(
+        capsys,
+        f"""
+        {dir1.as_posix()} @foo
+        {dir2.as_posix()} @bar @foo
+        """,
+    )
+    with open(get_file_path(CONFIG_FILE)) as fp:
+        assert json.load(fp) == {
+            "version": files.CONFIG_VERSION,
+            "tags": json.loads(exported),
+        }
+
+    for bad_data in [[], {"tags": {dir1.as_posix(): "foo"}}, {"version": 1}]:
+        with open(get_file_path(CONFIG_FILE), "w") as fp:
+            json.dump(bad_data, fp)
+        tags.execute([])
+        assert_stderr(capsys, f"Bad data in {get_file_path(CONFIG_FILE).as_posix()}")
+
+
+def test_command_tags_repair(capsys, dir1, dir2):
+    config_file_path = get_file_path(CONFIG_FILE)
+    config_file_path.parent.mkdir()
+
+    # Configs without a version are normalized and upgraded on load
+    with open(config_file_path, "w") as fp:
+        json.dump({"tags": {dir1.as_posix(): ["foo bar"]}}, fp)
+
+    tags.execute([])
+    assert_stdout(capsys, f"{dir1.as_posix()} @foo-bar")
+    with open(config_file_path) as fp:
+        assert json.load(fp) == {
+            "version": files.CONFIG_VERSION,
+            "tags": {dir1.as_posix(): ["foo-bar"]},
+        }
+
+    # Configs with the current version are trusted as they are
+    with open(config_file_path, "w") as fp:
+        json.dump(
+            {
+                "version": files.CONFIG_VERSION,
+                "tags": {dir1.as_posix(): ["foo bar"], dir2.as_posix(): ["baz"]},
+            },
+            fp,
+        )
+    tags.execute([])
+    assert_stdout(
+        capsys,
+        f"""
+        {dir1.as_posix()} @foo bar
+        {dir2.as_posix()} @baz
+        """,
+    )
+    tags.execute(["--fix", "--json"])
+    assert_stderr(
+        capsys,
+        f"""
+        usage: {tags.USAGE}
+        tags: error: argument -j/--json: not allowed with argument -f/--fix
+        """,
+    )
+    tags.execute(["--fix", "--reverse"])
+    assert_stderr(
+        capsys,
+        f"""
+        usage: {tags.USAGE}
+        tags: error: argument -r/--reverse: not allowed with argument -f/--fix
+        """,
+    )
+    tags.execute(["--fix", "--yes"])
+    assert_stdout(
+        capsys,
+        f"""
+        {dir1.as_posix()} +@foo-bar -@foo bar
+        Tags repaired successfully
+        """,
+    )
+    tags.execute([])
+    assert_stdout(
+        capsys,
+        f"""
+        {dir1.as_posix()} @foo-bar
+        {dir2.as_posix()} @baz
+        """,
+    )
+    tags.execute(["-f"])
+    assert_stdout(capsys, "Nothing to repair")
+
+    # Keys are normalized like paths, so the same directory is merged
+    with open(config_file_path, "w") as fp:
+        json.dump(
+            {
+                "version": files.CONFIG_VERSION,
+                "tags": {f"{dir1.as_posix()}/": ["foo"], f"{dir1.as_posix()}//": []},
+            },
+            fp,
+        )
+    tag.execute([dir1.as_posix(), "-y", "-t", "bar"])
+    assert_stdout(
+        capsys,
+        f"""
+        {dir1.as_posix()} +@bar
+        Tags saved successfully
+        """,
+    )
+    tags.execute([])
+    assert_stdout(capsys, f"{dir1.as_posix()} @bar @foo")
+
+
+def resolve_tags(*tags: str) -> List[str]:
+    """Return the destination of each tag from the d shell function's fast path."""
+    script = activate.BASH_ACTIVATE_SCRIPT + "".join(
+        f'_dtags_resolve {tag} && echo "${{_DTAGS_DEST}}" || echo -; ' for tag in tags
+    )
+    result = subprocess.run(
+        ["bash", "-c", script],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        env=dict(os.environ, HOME=TEST_ROOT.as_posix()),
+        check=True,
+    )
+    return result.stdout.split()
+
+
+def test_lookup_files(capsys, dir1, dir2):
+    tag.execute([dir1.as_posix(), dir2.as_posix(), "-y", "-t", "foo"])
+    tag.execute([dir1.as_posix(), "-y", "-t", "bar"])
+    capsys.readouterr()
+    files.save_config_file(files.load_config_file())
+
+    with open(get_file_path(SH_LOOKUP_FILE)) as fp:
+        lines = fp.read().splitlines()
+    assert lines[0] == f"# {files.get_config_signature()}"
+    assert lines[1:] == [
+        "typeset -gA _DTAGS_LOOKUP 2> /dev/null || return 1",
+        "_DTAGS_LOOKUP=(",
+        f"    [bar]={dir1.as_posix()}",
+        ")",
+    ]
+    with open(get_file_path(FISH_LOOKUP_FILE)) as fp:
+        lines = fp.read().splitlines()
+    assert lines[0] == f"# {files.get_config_signature()}"
+    assert lines[1:] == [
+        "set -l names (set -n | string match -- '__dtags_lookup__*')",
+        "set -q names[1]; and set -e $names",
+        f"set -g __dtags_lookup__bar '{dir1.as_posix()}'",
+    ]
+    assert not get_file_path(files.SH_OVERLAY_FILE).exists()
+    assert not get_file_path(files.FISH_OVERLAY_FILE).exists()
+    base_stamp = f"# {files.get_config_signature()}"
+
+    # Journaled changes go to the overlays, which hold the entries of all tags
+    # changed since the scripts were saved, instead of to the scripts
+    tag.execute([dir2.as_posix(), "-y", "-t", "bar", "baz"])
+    untag.execute([dir2.as_posix(), "-y", "-t", "foo"])
+    capsys.readouterr()
+    assert get_file_path(files.JOURNAL_FILE).exists()
+    with open(get_file_path(SH_LOOKUP_FILE)) as fp:
+        assert fp.readline() == f"{base_stamp}\n"
+    with open(get_file_path(files.SH_OVERLAY_FILE)) as fp:
+        lines = fp.read().splitlines()
+    assert lines == [
+        f"{base_stamp} {files.get_config_signature()}",
+        "# bar baz foo",
+        "typeset -gA _DTAGS_OVERLAY 2> /dev/null || return 1",
+        "_DTAGS_OVERLAY=(",
+        "    [bar]=''",
+        f"    [baz]={dir2.as_posix()}",
+        f"    [foo]={dir1.as_posix()}",
+        ")",
+    ]
+    with open(get_file_path(files.FISH_OVERLAY_FILE)) as fp:
+        lines = fp.read().splitlines()
+    assert lines[0] == f"{base_stamp} {files.get_config_signature()}"
+    assert lines[4:7] == [
+        "set -g __dtags_overlay__bar ''",
+        f"set -g __dtags_overlay__baz '{dir2.as_posix()}'",
+        f"set -g __dtags_overlay__foo '{dir1.as_posix()}'",
+    ]
+    assert resolve_tags("foo", "bar", "baz", "qux") == [
+        dir1.as_posix(),
+        "-",
+        dir2.as_posix(),
+        "-",
+    ]
+
+    # Overlays which are not in sync with the scripts are ignored
+    with open(get_file_path(SH_LOOKUP_FILE), "a") as fp:
+        fp.write("\n")
+    os.utime(get_file_path(SH_LOOKUP_FILE))
+    with open(get_file_path(files.SH_OVERLAY_FILE), "r+") as fp:
+        fp.write("# x")
+    assert resolve_tags("foo", "bar", "baz") == ["-", dir1.as_posix(), "-"]
+
+    # The scripts are saved afresh if they are not in sync, or once the
+    # overlays are full, and on compaction
+    tag.execute([dir2.as_posix(), "-y", "-t", "qux"])
+    capsys.readouterr()
+    assert not get_file_path(files.SH_OVERLAY_FILE).exists()
+    assert resolve_tags("foo", "bar", "baz", "qux") == [
+        dir1.as_posix(),
+        "-",
+        dir2.as_posix(),
+        dir2.as_posix(),
+    ]
+    untag.execute([dir2.as_posix(), "-y", "-t", "qux"])
+    capsys.readouterr()
+    assert get_file_path(files.SH_OVERLAY_FILE).exists()
+    assert resolve_tags("qux") == ["-"]
+
+    files.save_config_file(files.load_config_file())
+    assert not get_file_path(files.SH_OVERLAY_FILE).exists()
+    assert not get_file_path(files.FISH_OVERLAY_FILE).exists()
+    with open(get_file_path(SH_LOOKUP_FILE)) as fp:
+        lines = fp.read().splitlines()
+    assert lines[3:6] == [
+        f"    [baz]={dir2.as_posix()}",
+        f"    [foo]={dir1.as_posix()}",
+        ")",
+    ]
+    assert resolve_tags("foo", "bar", "baz") == [dir1.as_posix(), "-", dir2.as_posix()]
+
+    # Tags outside LOOKUP_TAG_PATTERN never reach the tables
+    assert resolve_tags("'foo[0]'", "'b*'", "'$(echo)'") == ["-", "-", "-"]
+
+
+def test_lookup_files_rebuild(capsys, dir1, dir2, monkeypatch):
+    tag.execute([dir1.as_posix(), "-y", "-t", "foo"])
+    capsys.readouterr()
+    get_file_path(INDEX_FILE).unlink()  # rebuilt by the next lookup
+
+    # Another command moves the tag while the index is being rebuilt
+    load_config_file = files.load_config_file
+    writers = []
+
+    def load_config_file_and_write():
+        config = load_config_file()
+        if not writers:
+            code = (
+                "from dtags.commands import tag, untag\n"
+                f"untag.execute([{dir1.as_posix()!r}, '-y', '-t', 'foo'])\n"
+                f"tag.execute([{dir2.as_posix()!r}, '-y', '-t', 'foo'])\n"
+            )
+            writers.append(
+                subprocess.Popen(
+                    [sys.executable, "-c", code],
+                    stdout=subprocess.DEVNULL,
+                    env=dict(os.environ, HOME=TEST_ROOT.as_posix()),
+                )
+            )
+            try:
+                writers[0].wait(timeout=1)  # blocked on the config lock
+            except subprocess.TimeoutExpired:
+                pass
+        return config
+
+    monkeypatch.setattr(files, "load_config_file", load_config_file_and_write)
+    d.execute(["foo"])
+    assert load_destination() == dir1.as_posix()
+    assert writers[0].wait(timeout=30) == 0
+    monkeypatch.setattr(files, "load_config_file", load_config_file)
+
+    # The lookup scripts are not left with the tag's old directory
+    assert resolve_tags("foo") == [dir2.as_posix()]
+    d.execute(["foo"])
+    assert load_destination() == dir2.as_posix()
+
+
+def test_config_journal(capsys, dir1, dir2, dir3, monkeypatch):
+    config_file_path = get_file_path(CONFIG_FILE)
+    journal_file_path = get_file_path(JOURNAL_FILE)
+
+    tag.execute([dir3.as_posix(), "-y", "-t", "foo"])
+    tag.execute([dir1.as_posix(), "-y", "-t", "foo", "bar"])
+    untag.execute([dir1.as_posix(), "-y", "-t", "foo"])
+    capsys.readouterr()
+
+    # Diffs are appended to the journal without rewriting the config file
+    with open(config_file_path) as fp:
+        assert json.load(fp)["tags"] == {}
+    with open(journal_file_path) as fp:
+        assert len(fp.readlines()) == 4
+
+    tags.execute([])
+    assert_stdout(
+        capsys,
+        f"""
+        {dir1.as_posix()} @bar
+        {dir3.as_posix()} @foo
+        """,
+    )
+    d.execute(["bar"])
+    assert load_destination() == dir1.as_posix()
+
+    # The journal is compacted into the config file once it is full
+    journal_max_size = files.JOURNAL_MAX_SIZE
+    monkeypatch.setattr(files, "JOURNAL_MAX_SIZE", 0)
+    tag.execute([dir2.as_posix(), "-y", "-t", "foo"])
+    capsys.readouterr()
+
+    assert not journal_file_path.exists()
+    with open(config_file_path) as fp:
+        assert json.load(fp)["tags"] == {
+            dir1.as_posix(): ["bar"],
+            dir2.as_posix(): ["foo"],
+            dir3.as_posix(): ["foo"],
+        }
+    monkeypatch.setattr(files, "JOURNAL_MAX_SIZE", journal_max_size)
+
+    # Journals of config files replaced by hand are discarded
+    untag.execute([dir2.as_posix(), "-y"])
+    capsys.readouterr()
+    assert journal_file_path.exists()
+
+    with open(config_file_path, "w") as fp:
+        json.dump({"version": files.CONFIG_VERSION, "tags": {}}, fp)
+
+    tags.execute([])
+    assert_stdout(capsys, "")
+
+    tag.execute([dir1.as_posix(), "-y", "-t", "baz"])
+    capsys.readouterr()
+    tags.execute([])
+    assert_stdout(capsys, f"{dir1.as_posix()} @baz")
+
+    tags.execute(["-y", "--purge"])
+    capsys.readouterr()
+    assert not journal_file_path.exists()
+
+
+def test_config_concurrent_writes(capsys, dir1, dir2):
+    tag.execute([dir2.as_posix(), "-y", "-t", "foo"])
+    capsys.readouterr()
+    files.save_config_file(files.load_config_file())  # start without a journal
+
+    # Concurrent tag commands must not overwrite each other's changes
+    processes = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "from dtags.commands.tag import execute; execute()",
+                dir1.as_posix(),
+                "-y",
+                "-t",
+                f"tag{num}",
+            ],
+            stdout=subprocess.DEVNULL,
+            env=dict(os.environ, HOME=TEST_ROOT.as_posix()),
+        )
+        for num in range(8)
+    ]
+    assert [process.wait() for process in processes] == [0] * 8
+
+    tags.execute(["--json"])
+    assert json.loads(capsys.readouterr().out) == {
+        dir1.as_posix(): [f"tag{num}" for num in range(8)],
+        dir2.as_posix(): ["foo"],
+    }
+    assert not list(get_file_path("").glob("*.tmp"))
+
+
+def test_config_prompt_unlocked(capsys, dir1, dir2, monkeypatch):
+    tag.execute([dir2.as_posix(), "-y", "-t", "foo"])
+    capsys.readouterr()
+
+    def run_tag(dirpath, tag_name):
+        # Another command saving the config while the user is being prompted
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "from dtags.commands.tag import execute; execute()",
+                dirpath.as_posix(),
+                "-y",
+                "-t",
+                tag_name,
+            ],
+            stdout=subprocess.DEVNULL,
+            env=dict(os.environ, HOME=TEST_ROOT.as_posix()),
+            timeout=30,
+            check=True,
+        )
+        return True
+
+    monkeypatch.setattr(tag, "prompt_user", lambda: run_tag(dir2, "bar"))
+    tag.execute([dir1.as_posix(), "-t", "foo"])
+    monkeypatch.setattr(untag, "prompt_user", lambda: run_tag(dir1, "baz"))
+    untag.execute([dir2.as_posix(), "-t", "foo"])
+    capsys.readouterr()
+
+    tags.execute(["--json"])
+    assert json.loads(capsys.readouterr().out) == {
+        dir1.as_posix(): ["baz", "foo"],
+        dir2.as_posix(): ["bar"],
+    }
+
+
+def test_config_lock_nested():
+    # New configs are saved under the lock, also by commands holding it already
+    with files.lock_config_file():
+        assert files.load_config_file() == files.get_new_config()
+        assert files.lock_depth == 1
+    assert files.lock_depth == 0
+    assert get_file_path(CONFIG_FILE).is_file()
+
+
+def test_stat_cache(capsys, dir1, dir2):
+    tag.execute([dir2.as_posix(), "-y", "-t", "foo"])
+    run.execute(["foo", dir1.as_posix(), "-c", "true"])
+    d.execute([dir1.as_posix()])
+    capsys.readouterr()
+
+    stat_cache = files.load_stat_cache()
+    assert set(stat_cache) == {dir1.as_posix(), dir2.as_posix()}
+
+    # Directories removed within the TTL are reported when the command is run
+    shutil.rmtree(dir2)
+    run.execute(["foo", "-c", "true"])
+    assert_stderr(capsys, f"Not a directory: {dir2.as_posix()}")
+
+    # Cleaning refreshes the cache
+    tags.execute(["--yes", "--clean"])
+    capsys.readouterr()
+    assert set(files.load_stat_cache()) == {dir1.as_posix()}
+
+
+def test_command_complete(capsys, dir1, dir2, monkeypatch):
+    complete.execute(["foo"])
+    assert_stdout(capsys, "")
+
+    tag.execute([dir1.as_posix(), dir2.as_posix(), "-y", "-t", "foo", "foobar", "bar"])
+    tag.execute([dir2.as_posix(), "-y", "-t", "fo", "baz"])
+    capsys.readouterr()
+    assert load_completion() == ["bar", "baz", "fo", "foo", "foobar"]
+
+    complete.execute([])
+    assert_stdout(capsys, ["bar", "baz", "fo", "foo", "foobar"])
+    complete.execute(["fo"])
+    assert_stdout(capsys, ["fo", "foo", "foobar"])
+    complete.execute(["foo"])
+    assert_stdout(capsys, ["foo", "foobar"])
+    complete.execute(["ba"])
+    assert_stdout(capsys, ["bar", "baz"])
+    complete.execute(["a"])
+    assert_stdout(capsys, "")
+    complete.execute(["zzz"])
+    assert_stdout(capsys, "")
+
+    complete.execute(["-h"])
+    assert "usage: " + complete.USAGE in capsys.readouterr().out
+
+    # Tags are removed from the index only when no directory uses them
+    untag.execute([dir1.as_posix(), "-y", "-t", "foo"])
+    untag.execute([dir2.as_posix(), "-y", "-t", "fo"])
+    capsys.readouterr()
+    assert load_completion() == ["bar", "baz", "foo", "foobar"]
+    untag.execute(["-y", "-t", "foo", "baz"])
+    capsys.readouterr()
+    assert load_completion() == ["bar", "foobar"]
+
+    # The index is rebuilt if it is out of sync with the config
+    with open(get_file_path(files.COMP_FILE), "w") as fp:
+        fp.write("# foo\nqux")
+    tag.execute([dir1.as_posix(), "-y", "-t", "baz"])
+    capsys.readouterr()
+    assert load_completion() == ["bar", "baz", "foobar"]
+
+    # Changes are appended to the completion log instead of the sorted file,
+    # which is saved afresh once the log is full
+    comp_log_path = get_file_path(files.COMP_LOG_FILE)
+    assert not comp_log_path.exists()
+    untag.execute(["-y", "-t", "bar"])
+    tag.execute([dir2.as_posix(), "-y", "-t", "bar", "qux"])
+    capsys.readouterr()
+    with open(get_file_path(files.COMP_FILE)) as fp:
+        stamp = fp.readline()
+        assert fp.read() == "bar\nbaz\nfoobar"
+    log_lines = comp_log_path.read_text().splitlines()
+    assert log_lines[0] == stamp.strip()
+    assert log_lines[-1] == f"# {files.get_config_signature()}"
+    assert [line for line in log_lines if not line.startswith("#")] == [
+        "-bar",
+        "+bar",
+        "+qux",
+    ]
+    assert load_completion() == ["bar", "baz", "foobar", "qux"]
+    complete.execute(["ba"])
+    assert_stdout(capsys, ["bar", "baz"])
+    complete.execute(["q"])
+    assert_stdout(capsys, ["qux"])
+
+    monkeypatch.setattr(files, "COMP_LOG_MAX_SIZE", 0)
+    untag.execute([dir2.as_posix(), "-y", "-t", "qux"])
+    capsys.readouterr()
+    assert not comp_log_path.exists()
+    with open(get_file_path(files.COMP_FILE)) as fp:
+        assert fp.read().split("\n")[1:] == ["bar", "baz", "foobar"]
+
+
+def test_command_complete_shell(capsys, dir1, dir2):
+    tag.execute([dir1.as_posix(), "-y", "-t", "foo", "foobar", "bar"])
+    capsys.readouterr()
+    bin_dir = TEST_ROOT / "bin"
+    bin_dir.mkdir()
+    calls_path = TEST_ROOT / "calls"
+    (bin_dir / "dtags-complete").write_text(
+        f"#!/bin/sh\necho \"$@\" >> {calls_path.as_posix()}\nexec {sys.executable} -c "
+        '"from dtags.commands.complete import execute; execute()" "$@"\n'
+    )
+    (bin_dir / "dtags-complete").chmod(0o755)
+
+    # Each TAB completes from a list of tag names kept in the shell
+    def complete_words(*commands):
+        script = activate.BASH_ACTIVATE_SCRIPT
+        for words in commands:
+            script += (
+                f"COMP_WORDS=({' '.join(words)}); COMP_CWORD={len(words) - 1}; "
+                f"COMPREPLY=(); _dtags_{words[0]}; "
+                f"printf '%s\\n' \"${{COMPREPLY[@]}}\" ---; "
+            )
+        result = subprocess.run(
+            ["bash", "-c", script],
+            check=True,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            env=dict(
+                os.environ,
+                HOME=TEST_ROOT.as_posix(),
+                PATH=f"{bin_dir.as_posix()}{os.pathsep}{os.environ['PATH']}",
+            ),
+        )
+        return [reply.split() for reply in result.stdout.split("---")[:-1]]
+
+    def count_calls():
+        calls = calls_path.read_text().splitlines() if calls_path.exists() else []
+        calls_path.write_text("")
+        return len(calls)
+
+    # Without changes since the completion file was saved, it is read directly
+    files.save_completion_file(files.load_config_file(), files.get_config_signature())
+    assert complete_words(
+        ["tag", "fo"],
+        ["d", "ba"],
+        ["run", "x", "foob"],
+        ["tags", "--rev"],
+    ) == [["foo", "foobar"], ["bar"], ["foobar"], ["--reverse"]]
+    assert count_calls() == 0
+
+    # Changes in the completion log are merged by dtags-complete, once per change
+    tag.execute([dir2.as_posix(), "-y", "-t", "baz"])
+    untag.execute([dir1.as_posix(), "-y", "-t", "foobar"])
+    capsys.readouterr()
+    assert get_file_path(files.COMP_LOG_FILE).exists()
+    assert complete_words(["tag", "fo"], ["d", "ba"], ["untag", "x", "b"]) == [
+        ["foo"],
+        ["bar", "baz"],
+        ["bar", "baz"],
+    ]
+    assert count_calls() == 1
+
+
+def test_command_complete_shell_cache(capsys, dir1):
+    tag.execute([dir1.as_posix(), "-y", "-t", "foo", "foobar"])
+    capsys.readouterr()
+    files.save_completion_file(files.load_config_file(), files.get_config_signature())
+    comp_path = get_file_path(files.COMP_FILE).as_posix()
+
+    # The completion file is read again only when its stamp changes
+    script = activate.BASH_ACTIVATE_SCRIPT + (
+        "COMP_WORDS=(d fo); COMP_CWORD=1; "
+        "_dtags_d; printf '%s\\n' \"${COMPREPLY[@]}\" ---; "
+        f"read -r stamp < {comp_path}; "
+        f"printf '%s\\nfoo\\nfoobaz\\n' \"$stamp\" > {comp_path}; "
+        "COMPREPLY=(); _dtags_d; printf '%s\\n' \"${COMPREPLY[@]}\" ---; "
+        f"printf '# new\\nfoo\\nfoobaz\\n' > {comp_path}; "
+        "COMPREPLY=(); _dtags_d; printf '%s\\n' \"${COMPREPLY[@]}\" ---; "
+    )
+    result = subprocess.run(
+        ["bash", "-c", script],
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        env=dict(os.environ, HOME=TEST_ROOT.as_posix()),
+    )
+    assert [reply.split() for reply in result.stdout.split("---")[:-1]] == [
+        ["foo", "foobar"],
+        ["foo", "foobar"],
+        ["foo", "foobaz"],
+    ]
+
+
+def test_search_lines():
+    lines = sorted(
+        f"{word}{num}" for word in ["a", "ab", "abc", "b"] for num in range(5)
+    )
+    buf = ("# stamp\n" + "\n".join(lines)).encode()
+    for prefix in ["", "a", "ab", "abc", "abc3", "abd", "b", "b4", "c", "0", "a1"]:
+        expected = [line.encode() for line in lines if line.startswith(prefix)]
+        assert files.search_lines(buf, len("# stamp\n"), prefix.encode()) == expected
+
+
+def test_command_d_subdir(capsys, dir1, dir2):
+    (dir1 / "foo" / "bar").mkdir(parents=True)
+    tag.execute([dir1.as_posix(), "-y", "-t", "foo"])
+    capsys.readouterr()
+
+    d.execute(["foo/foo"])
+    assert load_destination() == (dir1 / "foo").as_posix()
+    d.execute(["foo/foo/bar/"])
+    assert load_destination() == (dir1 / "foo" / "bar").as_posix()
+    d.execute(["-t", "foo/foo/bar/.."])
+    assert load_destination() == (dir1 / "foo").as_posix()
+
+    d.execute(["foo/baz"])
+    assert_stderr(capsys, "Invalid destination: foo/baz")
+    d.execute(["bar/foo"])
+    assert_stderr(capsys, "Invalid destination: bar/foo")
+
+
+def test_command_d_fd(capsys, dir1, monkeypatch):
+    tag.execute([dir1.as_posix(), "-y", "-t", "foo"])
+    capsys.readouterr()
+
+    read_fd, write_fd = os.pipe()
+    monkeypatch.setenv("DTAGS_DEST_FD", str(write_fd))
+    d.execute(["foo"])
+    os.close(write_fd)
+    with os.fdopen(read_fd) as fp:
+        assert fp.read() == dir1.as_posix()
+    assert not get_file_path(files.DEST_FILE).exists()
+
+    monkeypatch.setenv("DTAGS_DEST_FD", "foo")
+    d.execute(["foo"])
+    assert capsys.readouterr().err.startswith("Bad value for DTAGS_DEST_FD: foo")
+
+
+def test_command_d_frecency(capsys, dir1, dir2, dir3, monkeypatch):
+    tag.execute([dir1.as_posix(), dir2.as_posix(), dir3.as_posix(), "-y", "-t", "foo"])
+    capsys.readouterr()
+
+    # Without any visits to choose from, the user is prompted
+    choices = []
+    monkeypatch.setattr(
+        d, "prompt_user_selection", lambda dirpaths: choices.append(dirpaths) or dir2
+    )
+    d.execute(["foo"])
+    assert load_destination() == dir2.as_posix()
+    assert choices == [[dir1, dir2, dir3]]
+
+    # The most frequently and recently visited directory is chosen
+    d.execute(["foo"])
+    assert load_destination() == dir2.as_posix()
+    d.execute([dir3.as_posix()])
+    assert load_destination() == dir3.as_posix()
+    d.execute(["foo"])
+    assert load_destination() == dir2.as_posix()
+    assert len(choices) == 1
+
+    frecency = files.load_frecency_file()
+    assert list(frecency) == [dir3, dir2]
+    assert [visits for visits, _ in frecency.values()] == [1, 3]
+
+    # Recent visits weigh more than old ones
+    files.save_frecency_file({dir2: (3, frecency[dir2][1] - 86400), dir3: (1, 0.0)})
+    d.execute([dir3.as_posix()])
+    d.execute(["foo"])
+    assert load_destination() == dir3.as_posix()
+
+    # The user is always prompted with -i/--interactive
+    d.execute(["-i", "foo"])
+    assert load_destination() == dir2.as_posix()
+    assert len(choices) == 2
+
+    # Only the most frequently and recently visited directories are kept
+    monkeypatch.setattr(d, "FRECENCY_MAX_ENTRIES", 2)
+    d.execute([dir1.as_posix()])
+    assert set(files.load_frecency_file()) == {dir1, dir2}
+
+
+@pytest.mark.skipif(shutil.which("bash") is None, reason="requires bash")
+def test_command_d_frecency_shell(capsys, dir1, dir2, dir3):
+    tag.execute([dir1.as_posix(), dir2.as_posix(), dir3.as_posix(), "-y", "-t", "foo"])
+    tag.execute([dir1.as_posix(), "-y", "-t", "bar"])
+    tag.execute([dir2.as_posix(), "-y", "-t", "baz"])
+    capsys.readouterr()
+    link = TEST_ROOT / "link"
+    link.symlink_to(dir2)
+    start = int(time.time())
+
+    # Only visits by tag through the fast path of the shell function are
+    # logged, each with its time
+    script = activate.BASH_ACTIVATE_SCRIPT + (
+        f"d {dir3.as_posix()}; d bar; d baz; d bar/; d ..; d bar; d bar; d -"
+    )
+    subprocess.run(
+        ["bash", "-c", script],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        env=dict(os.environ, HOME=TEST_ROOT.as_posix()),
+    )
+    visit_log_path = get_file_path(files.VISIT_LOG_FILE)
+    visits = [line.split(" ", 1) for line in visit_log_path.read_text().splitlines()]
+    assert [dirpath for _, dirpath in visits] == [
+        dir1.as_posix(),
+        dir2.as_posix(),
+        dir1.as_posix(),
+        dir1.as_posix(),
+    ]
+    assert all(start <= int(visited_at) <= time.time() for visited_at, _ in visits)
+
+    # Logs moved aside by the shell and logs of older versions, which have no
+    # times, are folded into the visits recorded by dtags-d as well
+    with open(visit_log_path, "a") as fp:
+        fp.write(f"{link.as_posix()}\n")
+    with open(get_file_path(files.OLD_VISIT_LOG_FILE), "w") as fp:
+        fp.write(f"1000 {dir3.as_posix()}\n" * 5)
+
+    d.execute(["foo"])
+    assert load_destination() == dir1.as_posix()
+    frecency = files.load_frecency_file()
+    assert {dirpath: visits for dirpath, (visits, _) in frecency.items()} == {
+        dir1: 4,
+        dir2: 2,
+        dir3: 5,
+    }
+    assert frecency[dir3][1] == 1000.0
+    assert not visit_log_path.exists()
+    assert not get_file_path(files.OLD_VISIT_LOG_FILE).exists()
+    assert not list(get_file_path("").glob("*.tmp"))
+
+
+def test_command_d_frecency_concurrent(capsys, dir1):
+    tag.execute([dir1.as_posix(), "-y", "-t", "foo"])
+    capsys.readouterr()
+
+    # Concurrent d commands must not lose each other's visits
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-c", "from dtags.commands.d import execute; execute()"]
+            + ["foo"],
+            env=dict(os.environ, HOME=TEST_ROOT.as_posix()),
+        )
+        for _ in range(8)
+    ]
+    assert [process.wait() for process in processes] == [0] * 8
+    assert files.load_frecency_file()[dir1][0] == 8
+
+
+def test_command_d_fuzzy(capsys, dir1, dir2):
+    tag.execute([dir1.as_posix(), "-y", "-t", "my-project"])
+    tag.execute([dir2.as_posix(), "-y", "-t", "my-projects", "work"])
+    capsys.readouterr()
+
+    d.execute(["my-projcts"])
+    assert load_destination() == dir2.as_posix()
+    assert_stderr(capsys, "Using @my-projects")
+
+    d.execute(["wor"])
+    assert load_destination() == dir2.as_posix()
+    assert_stderr(capsys, "Using @work")
+
+    d.execute(["my-proj"])
+    assert load_destination() == dir1.as_posix()
+    assert_stderr(capsys, "Using @my-project")
+
+    # Tags which are equally similar are only suggested
+    tag.execute([dir1.as_posix(), "-y", "-t", "foo-bar", "foo-baz"])
+    capsys.readouterr()
+    d.execute(["foo-ba"])
+    assert_stderr(capsys, "Invalid destination: foo-ba (similar: @foo-bar, @foo-baz)")
+    d.execute(["qux"])
+    assert_stderr(capsys, "Invalid destination: qux")
+
+    run.execute(["wrk", "-c", "true"])
+    assert_stderr(capsys, "Unknown tag: wrk (similar: @work)")
+
+
+def test_command_tag_stdin(capsys, dir1, dir2, dir3, monkeypatch):
+    tag.execute(["--stdin", "-t", "foo"])
+    assert_stderr(
+        capsys,
+        f"""
+        usage: {tag.USAGE}
+        tag: error: argument --stdin: cannot prompt without -y/--yes
+        """,
+    )
+    lines = f"{dir1.as_posix()}\n\n{dir2.as_posix()}\n{dir1.as_posix()}\nfoobar\n"
+    monkeypatch.setattr(sys, "stdin", io.StringIO(lines))
+    tag.execute(["-y", "--stdin", dir3.as_posix(), "-t", "foo"])
+    assert_stdout(
+        capsys,
+        f"""
+        {dir1.as_posix()} +@foo
+        {dir2.as_posix()} +@foo
+        {dir3.as_posix()} +@foo
+        Tags saved successfully
+        """,
+    )
+    monkeypatch.setattr(sys, "stdin", io.StringIO(f"{dir1.as_posix()}\0"))
+    untag.execute(["-y", "--stdin", "-0"])
+    assert_stdout(
+        capsys,
+        f"""
+        {dir1.as_posix()} -@foo
+        Tags removed successfully
+        """,
+    )
+    # Empty input never removes tags from all directories
+    monkeypatch.setattr(sys, "stdin", io.StringIO(""))
+    untag.execute(["-y", "--stdin", "-t", "foo"])
+    assert_stdout(capsys, "Nothing to do")
+    assert load_completion() == ["foo"]
+
+
+def test_command_query(capsys, dir1, dir2, dir3, monkeypatch):
+    tag.execute([dir1.as_posix(), dir2.as_posix(), dir3.as_posix(), "-y", "-t", "work"])
+    tag.execute([dir1.as_posix(), dir2.as_posix(), "-y", "-t", "python"])
+    tag.execute([dir2.as_posix(), "-y", "-t", "archived"])
+    capsys.readouterr()
+
+    run.execute(["work & python & !archived", "-c", "ls"])
+    assert_stdout(capsys, f"{dir1.as_posix()} @python @work:")
+    run.execute(["archived | !python", dir1.as_posix(), "-c", "ls"])
+    assert_stdout(
+        capsys,
+        f"""
+        {dir1.as_posix()} @python @work:
+        {dir2.as_posix()} @archived @python @work:
+        {dir3.as_posix()} @work:
+        """,
+    )
+    run.execute(["work & (", "-c", "ls"])
+    assert_stderr(capsys, "Invalid query: work & (")
+
+    d.execute(["work & !python"])
+    assert load_destination() == dir3.as_posix()
+    d.execute(["work & foo"])
+    assert_stderr(capsys, "Invalid destination: work & foo")
+
+    tags.execute(["-t", "work & !archived", "foo"])
+    assert_stdout(
+        capsys,
+        f"""
+        {dir1.as_posix()} @python @work
+        {dir3.as_posix()} @work
+        """,
+    )
+    tags.execute(["-r", "-t", "python & !archived"])
+    assert_stdout(
+        capsys,
+        f"""
+        @python
+          {dir1.as_posix()}
+        """,
+    )
+    tags.execute(["--json", "-t", "archived | !work"])
+    assert json.loads(capsys.readouterr().out) == {
+        dir2.as_posix(): ["archived", "python", "work"]
+    }
+
+    # Queries are evaluated on the config if the index is not available
+    untag.execute([dir1.as_posix(), "-y", "-t", "python"])
+    capsys.readouterr()
+    monkeypatch.setitem(sys.modules, "dtags.index", None)
+
+    run.execute(["archived | !python", "-c", "ls"])
+    assert_stdout(
+        capsys,
+        f"""
+        {dir1.as_posix()} @work:
+        {dir2.as_posix()} @archived @python @work:
+        {dir3.as_posix()} @work:
+        """,
+    )
+    d.execute(["python & !archived"])
+    assert_stderr(capsys, "Invalid destination: python & !archived")
+
+
+def test_command_tags_streaming(capsys, dir1, dir2, dir3, monkeypatch):
+    tags.execute(["--json"])
+    assert capsys.readouterr().out == "{}\n"
+    tags.execute(["--json", "--reverse"])
+    assert capsys.readouterr().out == "{}\n"
+
+    tag.execute([dir1.as_posix(), dir2.as_posix(), "-y", "-t", "foo", "bar"])
+    tag.execute([dir3.as_posix(), "-y", "-t", "bar", 'qu"x'])
+    capsys.readouterr()
+
+    # Output is written in batches, and matches json.dumps exactly
+    monkeypatch.setattr(commons, "OUTPUT_BUFFER_SIZE", 16)
+    for args in [["--json"], ["--json", "--reverse"], ["--json", "-t", "foo"]]:
+        tags.execute(args)
+        output = capsys.readouterr().out
+        assert output == json.dumps(json.loads(output), indent=2, sort_keys=True) + "\n"
+
+    tags.execute(["--ndjson"])
+    assert_stdout(
+        capsys,
+        f"""
+        {{"dir": "{dir1.as_posix()}", "tags": ["bar", "foo"]}}
+        {{"dir": "{dir2.as_posix()}", "tags": ["bar", "foo"]}}
+        {{"dir": "{dir3.as_posix()}", "tags": ["bar", "qu-x"]}}
+        """,
+    )
+    tags.execute(["--ndjson", "--reverse", "-t", "qu-x"])
+    assert_stdout(capsys, f'{{"tag": "qu-x", "dirs": ["{dir3.as_posix()}"]}}')
+    tags.execute(["--ndjson", "--json"])
+    assert_stderr(
+        capsys,
+        f"""
+        usage: {tags.USAGE}
+        tags: error: argument -n/--ndjson: not allowed with argument -j/--json
+        """,
+    )
@@ -1,11 +1,23 @@
+import io
+import shutil
+import threading
+from pathlib import Path
 from string import punctuation
 
+from dtags import commons
 from dtags.commons import (
+    check_dirs,
+    get_hang_key,
+    is_dir,
     normalize_dir,
     normalize_dirs,
+    normalize_dirs_parallel,
     normalize_tag,
     normalize_tags,
+    read_values,
     reverse_map,
+    slugify_tag,
+    update_stat_cache,
 )
 
 
@@ -26,6 +38,30 @@ def test_normalize_dir(dir1, dir2):
     assert normalize_dir("foobar") is None
 
 
+def test_normalize_dir_cache(dir1, dir2, monkeypatch):
+    cache = {}
+    assert normalize_dir(dir1.as_posix(), cache) == dir1
+    assert normalize_dir("foobar", cache) is None
+    assert is_dir(dir2, cache) is True
+    assert is_dir(dir2 / "foobar", cache) is False
+    assert set(cache) == {dir1.as_posix(), dir2.as_posix()}
+
+    # Cached directories are trusted until the TTL expires
+    shutil.rmtree(dir1)
+    shutil.rmtree(dir2)
+    assert normalize_dir(dir1.as_posix(), cache) == dir1
+    assert is_dir(dir2, cache) is True
+
+    monkeypatch.setattr(commons, "STAT_CACHE_TTL", 0)
+    assert normalize_dir(dir1.as_posix(), cache) is None
+    assert is_dir(dir2, cache) is False
+    assert cache == {}
+
+    dir1.mkdir()
+    update_stat_cache(cache, {dir1: True, dir2: False, dir2 / "foo": None})
+    assert list(cache) == [dir1.as_posix()]
+
+
 def test_normalize_dirs(dir1, dir2):
     assert normalize_dirs(None) == set()
     assert normalize_dirs([]) == set()
@@ -47,6 +83,22 @@ def test_normalize_tag():
     assert normalize_tag("FoO_BaR") == "FoO-BaR"
     assert normalize_tag("1234567") == "1234567"
     assert normalize_tag("1foobar") == "1foobar"
+    assert normalize_tag("-foo--bar-") == "foo-bar"
+    assert normalize_tag("café") == "cafe"
+
+
+def test_normalize_tag_fast_path():
+    values = ["foo", "Foo-Bar", "a-1-b", "-foo", "foo-", "foo--bar", "--", "", "1"]
+    values += ["foo bar", "foo_bar", "föö", "&amp;", "#39", "foo\n", "日本"]
+    for value in values:
+        assert normalize_tag(value) == slugify_tag(value)
+
+    slugify_tag.cache_clear()
+    normalize_tag("foo-bar")
+    assert slugify_tag.cache_info().currsize == 0
+    normalize_tag("foo bar")
+    normalize_tag("foo bar")
+    assert slugify_tag.cache_info().hits == 1
 
 
 def test_normalize_tags():
@@ -54,3 +106,72 @@ def test_normalize_tags():
     assert normalize_tags([]) == set()
     assert normalize_tags(["dir1", "dir2"]) == {"dir1", "dir2"}
     assert normalize_tags(["dir1", punctuation]) == {"dir1"}
+
+
+def test_check_dirs(dir1, dir2, dir3, monkeypatch):
+    assert check_dirs([]) == {}
+    assert check_dirs([dir1, dir2, dir1 / "foo"]) == {
+        dir1: True,
+        dir2: True,
+        dir1 / "foo": False,
+    }
+    is_dir = Path.is_dir
+    released = threading.Event()
+
+    def fake_is_dir(path: Path) -> bool:
+        if path.parent == dir2:
+            released.wait()  # simulate a hung mount
+        elif path == dir3:
+            raise OSError("stale file handle")
+        return is_dir(path)
+
+    monkeypatch.setattr(Path, "is_dir", fake_is_dir)
+    try:
+        dirpaths = [dir1 / "foo", dir2 / "mnt", dir3, dir1]
+        assert check_dirs(dirpaths, timeout=0.2, workers=1) == {
+            dir1 / "foo": False,
+            dir2 / "mnt": None,
+            dir3: None,
+            dir1: True,
+        }
+        # Only the paths next to a hung one are skipped, not everything after it
+        hung = [dir2 / f"hung{i}" for i in range(20)]
+        missing = [dir1 / f"missing{i}" for i in range(5)]
+        result = check_dirs(hung + [dir1] + missing, timeout=0.2, workers=1)
+        assert result == {
+            **dict.fromkeys(hung),
+            dir1: True,
+            **{path: False for path in missing},
+        }
+    finally:
+        released.set()
+
+
+def test_get_hang_key():
+    mount_points = ["/mnt/nfs share", "/mnt", "/"]
+    assert get_hang_key(Path("/mnt/nfs share/a/b"), mount_points) == "/mnt/nfs share"
+    assert get_hang_key(Path("/mnt/nfs"), mount_points) == "/mnt"
+    assert get_hang_key(Path("/home/foo/bar"), mount_points) == "/home/foo"
+    assert get_hang_key(Path("/home/foo/bar"), []) == "/home/foo"
+
+
+def test_normalize_dirs_parallel(dir1, dir2, dir3, monkeypatch):
+    link = dir1 / "link"
+    link.symlink_to(dir2)
+    values = [dir1.as_posix(), f"{dir3.as_posix()}/", link.as_posix()]
+    values += [f"{dir1.as_posix()}/../{dir2.name}", "foobar", dir1.as_posix()]
+    expected = {dir1, dir2, dir3}
+    assert normalize_dirs_parallel(values) == expected
+    assert normalize_dirs_parallel(values) == normalize_dirs(values)
+
+    monkeypatch.setattr(commons, "NORMALIZE_DIRS_CHUNK_SIZE", 1)
+    assert normalize_dirs_parallel(values, workers=4) == expected
+    assert normalize_dirs_parallel([]) == set()
+
+
+def test_read_values(monkeypatch):
+    monkeypatch.setattr(commons, "READ_CHUNK_SIZE", 3)
+    assert list(read_values(io.StringIO("foo\n\nbar baz\n"))) == ["foo", "bar baz"]
+    assert list(read_values(io.StringIO("a\nb\0c\0"), null=True)) == ["a\nb", "c"]
+    assert list(read_values(io.StringIO("foo"))) == ["foo"]
+    assert list(read_values(io.StringIO(""))) == []
@@ -0,0 +1,96 @@
+from contextlib import closing
+
+from dtags import index
+
+from .conftest import TEST_ROOT
+
+
+def test_index(dir1, dir2, dir3):
+    with closing(index.connect(TEST_ROOT / "index.db")) as conn:
+        assert index.get_signature(conn) is None
+        assert index.select_all_dirpaths(conn) == {}
+
+        index.rebuild(conn, {dir1: {"foo", "bar"}, dir2: {"foo"}}, "1")
+        assert index.get_signature(conn) == "1"
+        assert index.select_all_dirpaths(conn) == {
+            "bar": {dir1},
+            "foo": {dir1, dir2},
+        }
+        assert index.select_dirpaths(conn, ["foo", "baz"]) == {"foo": {dir1, dir2}}
+        assert index.select_tags(conn, [dir1, dir3]) == {dir1: {"foo", "bar"}}
+
+        diffs = [(dir1, {"baz"}, {"foo"}), (dir3, {"foo"}, set())]
+        assert index.apply_diffs(conn, diffs, "2", "1")
+        assert index.get_signature(conn) == "2"
+
+        # Diffs are not applied to an index which is not in sync
+        assert not index.apply_diffs(conn, [(dir1, {"qux"}, set())], "3", "1")
+        assert index.get_signature(conn) == "2"
+        assert index.select_all_dirpaths(conn) == {
+            "bar": {dir1},
+            "baz": {dir1},
+            "foo": {dir2, dir3},
+        }
+        assert index.select_tags(conn, [dir1, dir2, dir3]) == {
+            dir1: {"bar", "baz"},
+            dir2: {"foo"},
+            dir3: {"foo"},
+        }
+        assert_bitsets(conn)
+
+        # Directories without tags are dropped, and keep the IDs of the others
+        dir_ids = dict(conn.execute("SELECT dirpath, id FROM dirs"))
+        diffs = [(dir2, set(), {"foo"}), (dir1, set(), {"bar"})]
+        assert index.apply_diffs(conn, diffs, "3", "2")
+        assert dict(conn.execute("SELECT dirpath, id FROM dirs")) == {
+            dir1.as_posix(): dir_ids[dir1.as_posix()],
+            dir3.as_posix(): dir_ids[dir3.as_posix()],
+        }
+        assert_bitsets(conn)
+
+        index.rebuild(conn, {}, "4")
+        assert index.get_signature(conn) == "4"
+        assert index.select_all_dirpaths(conn) == {}
+        assert index.select_all_bits(conn) == 0
+
+
+def assert_bitsets(conn):
+    # The bitsets of the tags match the directories in the tags table
+    tag_to_dirpaths = index.select_all_dirpaths(conn)
+    tag_to_bits = index.select_bitsets(conn, [*tag_to_dirpaths, "qux"])
+    assert tag_to_bits.keys() == tag_to_dirpaths.keys()
+    for tag, bits in tag_to_bits.items():
+        assert index.select_bitset_dirpaths(conn, bits) == tag_to_dirpaths[tag]
+    all_dirpaths = index.select_bitset_dirpaths(conn, index.select_all_bits(conn))
+    assert all_dirpaths == set().union(*tag_to_dirpaths.values())
+
+
+def test_index_similar_tags(dir1, dir2):
+    def select_similar_tags(value, limit=3, min_score=0.2):
+        return [
+            tag for _, tag in index.select_similar_tags(conn, value, limit, min_score)
+        ]
+
+    with closing(index.connect(TEST_ROOT / "index.db")) as conn:
+        tag_config = {dir1: {"my-project", "work"}, dir2: {"my-projects", "home"}}
+        index.rebuild(conn, tag_config, "1")
+
+        assert select_similar_tags("my-projct") == ["my-project", "my-projects"]
+        assert select_similar_tags("MY-PROJECTS") == ["my-projects", "my-project"]
+        assert select_similar_tags("my-proj", limit=1) == ["my-project"]
+        assert select_similar_tags("wor") == ["work"]
+        assert select_similar_tags("hoem") == ["home"]
+        assert select_similar_tags("foo") == []
+        assert select_similar_tags("hoem", min_score=0.5) == []
+
+        # Trigrams of tags are removed only when no directory uses them
+        diffs = [(dir1, {"homework"}, {"my-project", "work"})]
+        assert index.apply_diffs(conn, diffs, "2", "1")
+        assert index.apply_diffs(conn, [(dir2, set(), {"home"})], "3", "2")
+        assert select_similar_tags("work") == ["homework"]
+        assert select_similar_tags("my-projct") == ["my-projects"]
+        assert select_similar_tags("hoem") == []
+
+        # Indexes built with an older schema are considered stale
+        conn.execute("UPDATE meta SET value = '1' WHERE key = 'schema'")
+        assert index.get_signature(conn) is None
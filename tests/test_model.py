@@ -0,0 +1,54 @@
+from pathlib import Path
+
+import pytest
+
+from dtags.model import TagMap, TagTable, to_tag_map
+
+
+def test_tag_table():
+    table = TagTable([("/a", ["foo", "bar"]), ("/b", []), ("/c", ["foo"])])
+    assert sorted(table.tags) == ["bar", "foo"]
+    assert len(table) == 3
+    assert table.get_tags("/a") == {"foo", "bar"}
+    assert table.get_tags("/b") == set()
+    assert table.get_tags("/d") is None
+
+    table.set_tags("/a", ["baz"])
+    table.set_tags("/d", ["foo", "foo"])
+    assert table.remove("/c") is True
+    assert table.remove("/c") is False
+    assert table.remove("/e") is False
+    assert len(table) == 3
+    assert list(table.iter_items()) == [("/a", ["baz"]), ("/b", []), ("/d", ["foo"])]
+
+    # Each path and tag name is stored once, whatever the number of changes
+    assert table.paths == ["/a", "/b", "/c", "/d"]
+    assert sorted(table.tags) == ["bar", "baz", "foo"]
+
+    compacted = table.sort_paths()
+    assert compacted.paths == ["/a", "/b", "/d"]
+    assert compacted.changes == {}
+    assert list(compacted.iter_items()) == list(table.iter_items())
+
+
+def test_tag_map(dir1, dir2, dir3):
+    tag_map = TagMap(TagTable([(dir1.as_posix(), ["foo"]), (dir2.as_posix(), [])]))
+    assert tag_map == {dir1: {"foo"}, dir2: set()}
+    assert tag_map[dir1] == {"foo"}
+    assert tag_map.get(dir3) is None
+    assert dir2 in tag_map and dir3 not in tag_map
+    assert list(tag_map) == [dir1, dir2]
+    assert list(tag_map.values()) == [{"foo"}, set()]
+
+    tag_map[dir3] = {"bar"}
+    tag_map[dir1] = tag_map[dir1] | {"baz"}
+    del tag_map[dir2]
+    with pytest.raises(KeyError):
+        del tag_map[dir2]
+    with pytest.raises(KeyError):
+        tag_map[dir2]
+    assert len(tag_map) == 2
+    assert dict(tag_map.items()) == {dir1: {"foo", "baz"}, dir3: {"bar"}}
+
+    assert to_tag_map(tag_map) is tag_map
+    assert to_tag_map({Path("/foo"): {"bar"}}) == {Path("/foo"): {"bar"}}
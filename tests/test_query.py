@@ -0,0 +1,73 @@
+import pytest
+
+from dtags.exceptions import DtagsError
+from dtags.query import (
+    evaluate_query,
+    from_bitset,
+    get_query_tags,
+    is_query,
+    parse_query,
+    to_bitset,
+)
+
+
+def test_parse_query():
+    assert is_query("work & python") is True
+    assert is_query("work") is False
+    assert parse_query("foo") == "foo"
+    assert parse_query(" Foo_Bar ") == "Foo-Bar"
+    assert parse_query("a | b & !c") == ("|", "a", ("&", "b", ("!", "c")))
+    assert parse_query("(a|b)&c") == ("&", ("|", "a", "b"), "c")
+    assert parse_query("!!a & b & c") == ("&", ("&", ("!", ("!", "a")), "b"), "c")
+
+    for value in ["", "&", "a &", "a b", "(a", "a)", "()", "a & ()", "a & !", "a | %"]:
+        with pytest.raises(DtagsError) as err:
+            parse_query(value)
+        assert str(err.value) == f"Invalid query: {value}"
+
+
+def test_query_tags():
+    assert get_query_tags(parse_query("a & (b | !c)")) == {"a", "b", "c"}
+    assert get_query_tags(parse_query("a")) == {"a"}
+
+
+def test_bitsets():
+    assert to_bitset([]) == 0
+    assert to_bitset([0, 3, 9]) == 0b1000001001
+    assert from_bitset(0) == []
+    assert from_bitset(0b1000001001) == [0, 3, 9]
+    assert from_bitset(to_bitset(range(0, 1000, 7))) == list(range(0, 1000, 7))
+
+
+def test_evaluate_query():
+    tag_to_bits = {
+        "work": to_bitset([1, 2, 3]),
+        "python": to_bitset([1, 2, 4]),
+        "archived": to_bitset([2]),
+    }
+    all_bits = to_bitset([1, 2, 3, 4])
+    calls = []
+
+    def get_all_bits():
+        calls.append(None)
+        return all_bits
+
+    def evaluate(value, tag_to_bits=tag_to_bits):
+        bits = evaluate_query(parse_query(value), tag_to_bits, get_all_bits)
+        return from_bitset(bits)
+
+    assert evaluate("work") == [1, 2, 3]
+    assert evaluate("work & python") == [1, 2]
+    assert evaluate("work & python & !archived") == [1]
+    assert evaluate("!python & work") == [3]
+    assert evaluate("work & foo") == []
+    assert evaluate("archived | foo") == [2]
+    assert evaluate("work & !(python | foo)") == [3]
+
+    # All directories are only requested for negations which are not "and not",
+    # and at most once per query
+    assert calls == []
+    assert evaluate("!work | !python | archived") == [2, 3, 4]
+    assert calls == [None]
+    assert evaluate("!python & !work") == []
+    assert evaluate("!foo", {}) == [1, 2, 3, 4]
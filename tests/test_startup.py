@@ -0,0 +1,102 @@
+import os
+import subprocess
+import sys
+from typing import Set
+
+import pytest
+
+from dtags.commands import tag
+from dtags.commons import get_version
+
+from .conftest import TEST_ROOT
+from .helpers import load_destination
+
+# Modules behind the console_scripts entry points in setup.py
+ENTRY_POINTS = ["activate", "complete", "d", "run", "tag", "tags", "untag"]
+
+# Modules which are too slow to import on every shell command
+SLOW_MODULES = {"distutils", "pkg_resources", "setuptools"}
+
+# Modules which must be imported only on the code paths that need them
+LAZY_MODULES = {
+    "argparse",
+    "concurrent.futures",
+    "json",
+    "selectors",
+    "shlex",
+    "slugify",
+    "sqlite3",
+    "subprocess",
+}
+
+requires_importtime = pytest.mark.skipif(
+    sys.version_info < (3, 7), reason="-X importtime requires Python 3.7+"
+)
+
+
+def run_python(code: str) -> str:
+    return subprocess.check_output(
+        [sys.executable, "-c", code],
+        universal_newlines=True,
+        env=dict(os.environ, HOME=TEST_ROOT.as_posix()),
+    )
+
+
+def get_imported_modules(code: str) -> Set[str]:
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        env=dict(os.environ, HOME=TEST_ROOT.as_posix()),
+        check=True,
+    )
+    return {
+        line.rsplit("|", 1)[-1].strip()
+        for line in process.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+
+
+@requires_importtime
+@pytest.mark.parametrize("name", ENTRY_POINTS)
+def test_startup_imports(name):
+    baseline = get_imported_modules("pass")
+    modules = get_imported_modules(f"import dtags.commands.{name}") - baseline
+    assert f"dtags.commands.{name}" in modules
+    assert modules & SLOW_MODULES == set()
+    assert modules & LAZY_MODULES == set()
+
+
+@requires_importtime
+def test_startup_imports_d(capsys, dir1):
+    tag.execute([dir1.as_posix(), "-y", "-t", "foo"])
+    capsys.readouterr()
+
+    baseline = get_imported_modules("pass")
+    for dest, lazy_modules in [
+        ("foo", LAZY_MODULES - {"sqlite3"}),  # tags are looked up in the index
+        (dir1.as_posix(), LAZY_MODULES),
+    ]:
+        modules = get_imported_modules(
+            f"from dtags.commands.d import execute; execute([{dest!r}])"
+        )
+        assert modules - baseline & (SLOW_MODULES | lazy_modules) == set()
+        assert load_destination() == dir1.as_posix()
+
+
+@requires_importtime
+def test_startup_imports_version():
+    # The version is looked up only when -v/--version is given
+    modules = get_imported_modules("from dtags.commands.tag import execute")
+    parser_modules = get_imported_modules(
+        "from dtags.commons import get_argparser; get_argparser('tag', '', '')"
+    )
+    assert "dtags.version" not in modules | parser_modules
+
+
+@pytest.mark.parametrize("name", ENTRY_POINTS)
+def test_startup_version(name):
+    output = run_python(
+        f"from dtags.commands.{name} import execute\n" f"execute(['--version'])\n"
+    )
+    assert output.strip() == get_version()
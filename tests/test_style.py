@@ -15,6 +15,7 @@ def test_style_path(dir1, dir2):
     assert clean_str(s.path(dir2, tty=False)) == dir2.as_posix()
     assert clean_str(s.path(dir1, tty=True)) == dir1.as_posix()
     assert clean_str(s.path(dir2, tty=True)) == dir2.as_posix()
+    assert clean_str(s.path(dir1.as_posix(), tty=True)) == dir1.as_posix()
 
 
 def test_style_command():